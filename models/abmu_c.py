@@ -59,6 +59,11 @@ class ABMU(StandaloneTask):
 
     attachments   = ['spectral_distribution.csv', 'reflectance.png', 'transmittance.png', 'absorptance.png']
 
+    def estimatedCost(self):
+        """Cost grows with the number of samples taken at each 5nm wavelength step."""
+        start, end = self.wavelengths.value
+        return self.nSamples.value * ((end - start) / 5 + 1)
+
     def executableParameters(self):
         if self.surfaceOfIncidence.value == "Abaxial":
             angleIn = 180 - self.angleOfIncidence.value
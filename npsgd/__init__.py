@@ -1,7 +1,8 @@
 """Package containing helper modules for all NPSGD daemons."""
 
 __all__ = [
-    "config", "confirmation_map", "email_manager", 
-    "matlab_task", "model_manager", "model_task",
-    "standalone_task", "task_queue", "text_helpers", "ui_modules"
+    "child_process", "config", "confirmation_map", "confirmation_token", "confirmed_codes", "email_manager", 
+    "matlab_engine", "matlab_task", "model_cache", "model_manager", "model_metadata", "model_task",
+    "resource_usage", "result_spool", "standalone_server", "standalone_task",
+    "task_queue", "task_record", "text_helpers", "ui_modules", "worker_registry"
 ]
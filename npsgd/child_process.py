@@ -0,0 +1,197 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module for streaming the output of model subprocesses.
+
+Model runs can be very chatty, so rather than buffering everything a child
+prints (and copying it into the daemon log) output is streamed line by line
+into a size-capped log file per task. Only the last few lines are kept in
+memory, for failure emails and diagnostics.
+
+Children are also started in their own process group so that a task that
+times out or is cancelled can be killed along with anything it spawned, and
+can be pinned to the cores of the worker's slot, reniced and rlimited so that
+several workers can share a host without trampling one another.
+"""
+import os
+import time
+import glob
+import ctypes
+import signal
+import logging
+import resource
+import threading
+import subprocess
+import collections
+import ctypes.util
+from config import config
+
+slotCpus = None
+"""Cores this worker's model subprocesses are pinned to (None for no pinning)."""
+
+def setWorkerSlot(slot):
+    """Pins model subprocesses of this worker to the cores of a slot (see cpusPerSlot)."""
+    global slotCpus
+    if config.cpusPerSlot <= 0:
+        return
+
+    cpuCount = os.sysconf("SC_NPROCESSORS_ONLN")
+    first    = slot * config.cpusPerSlot
+    slotCpus = sorted(set((first + i) % cpuCount for i in xrange(config.cpusPerSlot)))
+    logging.info("Worker slot %d pins model subprocesses to cores %s", slot, slotCpus)
+
+def affinitySetter(cpus):
+    """Returns a function pinning the calling process to a list of cores via sched_setaffinity."""
+    libc   = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    bits   = 8 * ctypes.sizeof(ctypes.c_ulong)
+    cpuSet = (ctypes.c_ulong * (1024 / bits))()
+    for cpu in cpus:
+        cpuSet[cpu / bits] |= 1 << (cpu % bits)
+
+    def setAffinity():
+        if libc.sched_setaffinity(0, ctypes.sizeof(cpuSet), ctypes.byref(cpuSet)) != 0:
+            raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+
+    return setAffinity
+
+def spawn(args, cpuTimeLimit=None, memoryLimit=None, cpus=None, niceness=0, **kwargs):
+    """Starts a subprocess in a new process group, applying the given isolation.
+
+    The child gets at most cpuTimeLimit seconds of cpu and memoryLimit megabytes
+    of address space, runs only on the given cores and is niced by niceness.
+    Takes the same keyword arguments as subprocess.Popen.
+    """
+    setAffinity = affinitySetter(cpus) if cpus else None
+    def setupChild():
+        os.setsid()
+        if cpuTimeLimit:
+            resource.setrlimit(resource.RLIMIT_CPU, (int(cpuTimeLimit), int(cpuTimeLimit) + 5))
+        if memoryLimit:
+            memoryBytes = int(memoryLimit) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memoryBytes, memoryBytes))
+        if setAffinity != None:
+            setAffinity()
+        if niceness > 0:
+            os.nice(niceness)
+
+    return subprocess.Popen(args, preexec_fn=setupChild, close_fds=True, **kwargs)
+
+def killProcessGroup(process, graceSeconds=5):
+    """Terminates a child and everything it started, escalating to SIGKILL after graceSeconds."""
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            #Not a group leader (or already gone), settle for the process itself
+            try:
+                os.kill(process.pid, sig)
+            except OSError:
+                return
+
+        deadline = time.time() + graceSeconds
+        while process.returncode == None and time.time() < deadline:
+            time.sleep(0.1)
+
+        if process.returncode != None:
+            return
+
+class TaskLogFile(object):
+    """Append-only log file that rotates through backupCount old copies once it reaches maxBytes."""
+
+    def __init__(self, path, maxBytes, backupCount):
+        self.path        = path
+        self.maxBytes    = maxBytes
+        self.backupCount = backupCount
+        self.file        = open(self.path, 'a')
+        self.size        = self.file.tell()
+
+    def write(self, data):
+        if self.maxBytes > 0 and self.size > 0 and self.size + len(data) > self.maxBytes:
+            self.rotate()
+
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for i in xrange(self.backupCount - 1, 0, -1):
+            source = "%s.%d" % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d" % (self.path, i + 1))
+
+        if self.backupCount > 0:
+            os.rename(self.path, "%s.1" % self.path)
+
+        self.file = open(self.path, 'w')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+class TaskOutput(object):
+    """Destination for all subprocess output of a task (thread safe).
+
+    Every line goes to the task's log file and into a bounded tail per
+    stream, and is then handed to lineCallback(stream, line) as it arrives.
+    """
+
+    def __init__(self, path, tailLines, lineCallback=None):
+        self.path         = path
+        self.lineCallback = lineCallback
+        self.logFile      = TaskLogFile(path, config.taskLogMaxBytes, config.taskLogBackupCount)
+        self.tails        = {
+            "stdout": collections.deque(maxlen=tailLines),
+            "stderr": collections.deque(maxlen=tailLines)
+        }
+        self.lock = threading.Lock()
+
+    def line(self, stream, line):
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        if not line.endswith("\n"):
+            line += "\n"
+
+        with self.lock:
+            self.logFile.write("[%s] %s" % (stream, line))
+            self.tails[stream].append(line)
+
+        if self.lineCallback != None:
+            self.lineCallback(stream, line)
+
+    def tail(self, stream):
+        with self.lock:
+            return "".join(self.tails[stream])
+
+    def follow(self, stream, pipe):
+        """Starts a thread copying lines from a pipe until it closes, returning the thread."""
+        return followPipe(pipe, lambda line: self.line(stream, line))
+
+    def close(self):
+        with self.lock:
+            self.logFile.close()
+
+def followPipe(pipe, lineCallback):
+    """Starts a thread passing each line read from a pipe to lineCallback, returning the thread."""
+    def readLines():
+        for line in iter(pipe.readline, ""):
+            lineCallback(line)
+        pipe.close()
+
+    thread = threading.Thread(target=readLines)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def taskLogPath(task):
+    return os.path.join(config.taskLogDirectory, "%s_%s_%s.log" % (task.short_name, task.taskId, task.visibleId))
+
+def pruneTaskLogs():
+    """Removes task logs (and their rotated copies) older than taskLogMaxAge hours."""
+    oldTime = time.time() - config.taskLogMaxAge * 3600
+    for path in glob.glob(os.path.join(config.taskLogDirectory, "*.log*")):
+        try:
+            if os.path.getmtime(path) < oldTime:
+                os.remove(path)
+        except OSError, e:
+            logging.warning("Unable to prune task log: %s", e)
@@ -65,10 +65,26 @@ class Config(object):
         self.confirmTemplatePath      = config.get('npsgd', 'confirmTemplatePath')
         self.confirmedTemplatePath    = config.get('npsgd', 'confirmedTemplatePath')
         self.confirmTimeout           = datetime.timedelta(minutes=config.getint('npsgd', 'confirmTimeout'))
+        self.confirmTimeoutSeconds    = 60 * config.getint('npsgd', 'confirmTimeout')
+        self.confirmationMode         = self.optional(config, "npsgd", "confirmationMode", "map")
+        self.confirmExpireInterval    = self.optional(config, "npsgd", "confirmExpireInterval", 60, "getint")
+        self.confirmedCodeBucket      = self.optional(config, "npsgd", "confirmedCodeBucket", 3600, "getint")
+        self.confirmedCodeBloomCapacity  = self.optional(config, "npsgd", "confirmedCodeBloomCapacity", 0, "getint")
+        self.confirmedCodeBloomErrorRate = self.optional(config, "npsgd", "confirmedCodeBloomErrorRate", 0.001, "getfloat")
         self.maxJobFailures           = config.getint("npsgd", "maxJobFailures")
         self.keepAliveInterval        = config.getint("npsgd", "keepAliveInterval")
         self.keepAliveTimeout         = config.getint("npsgd", "keepAliveTimeout")
+        self.progressStallTimeout     = self.optional(config, "npsgd", "progressStallTimeout", 0, "getint")
+        self.leaseRestoreGrace        = self.optional(config, "npsgd", "leaseRestoreGrace", self.keepAliveTimeout, "getint")
+        self.workerFailureThreshold   = self.optional(config, "npsgd", "workerFailureThreshold", 0.5, "getfloat")
+        self.workerQuarantineTime     = self.optional(config, "npsgd", "workerQuarantineTime", 600, "getint")
+        self.speculationFactor        = self.optional(config, "npsgd", "speculationFactor", 3.0, "getfloat")
+        self.speculationMinRuns       = self.optional(config, "npsgd", "speculationMinRuns", 5, "getint")
         self.modelScanInterval        = config.getint("npsgd", "modelScanInterval")
+        self.modelVersionGrace        = self.optional(config, "npsgd", "modelVersionGrace", 3600, "getint")
+        self.modelCollectInterval     = self.optional(config, "npsgd", "modelCollectInterval", 600, "getint")
+        self.strandedTaskTimeout      = self.optional(config, "npsgd", "strandedTaskTimeout", 600, "getint")
+        self.lazyModelImports         = self.optional(config, "npsgd", "lazyModelImports", True, "getboolean")
         self.queueServerAddress       = config.get("npsgd", "queueServerAddress")
         self.queueServerPort          = config.getint("npsgd", "queueServerPort")
         self.modelDirectory           = config.get("npsgd", "modelDirectory")
@@ -79,6 +95,23 @@ class Config(object):
         self.listModelsTemplatePath   = config.get("npsgd", 'listModelsTemplatePath')
         self.advertisedRoot           = config.get("npsgd", "advertisedRoot")
         self.alreadyConfirmedTemplatePath    = config.get('npsgd', 'alreadyConfirmedTemplatePath')
+        self.bundleCostThreshold      = self.optional(config, "npsgd", "bundleCostThreshold", 0.0, "getfloat")
+        self.maxBundleSize            = self.optional(config, "npsgd", "maxBundleSize", 1, "getint")
+        self.taskLogDirectory         = self.optional(config, "npsgd", "taskLogDirectory",
+                os.path.join(os.path.dirname(self.queueFile), "task_logs"))
+        self.taskLogMaxBytes          = self.optional(config, "npsgd", "taskLogMaxBytes", 1048576, "getint")
+        self.taskLogBackupCount       = self.optional(config, "npsgd", "taskLogBackupCount", 2, "getint")
+        self.taskLogMaxAge            = self.optional(config, "npsgd", "taskLogMaxAge", 72, "getint")
+        self.outputTailLines          = self.optional(config, "npsgd", "outputTailLines", 40, "getint")
+        self.resultSpoolDirectory     = self.optional(config, "npsgd", "resultSpoolDirectory",
+                os.path.join(os.path.dirname(self.queueFile), "result_spool"))
+        self.resultSpoolMaxBackoff    = self.optional(config, "npsgd", "resultSpoolMaxBackoff", 60, "getint")
+        self.resultSpoolMaxAge        = self.optional(config, "npsgd", "resultSpoolMaxAge", 72, "getint")
+        self.modelMetadataDirectory   = self.optional(config, "npsgd", "modelMetadataDirectory",
+                os.path.join(os.path.dirname(self.queueFile), "model_metadata"))
+        self.modelCacheDirectory      = self.optional(config, "npsgd", "modelCacheDirectory",
+                os.path.join(os.path.dirname(self.queueFile), "model_cache"))
+        self.modelCacheSize           = self.optional(config, "npsgd", "modelCacheSize", 20, "getint")
 
         if not os.path.exists(self.htmlTemplateDirectory):
             raise ConfigError("HTML template directory '%s' does not exist" % self.htmlTemplateDirectory)
@@ -89,6 +122,15 @@ class Config(object):
         if not os.path.exists(self.latexTemplateDirectory):
             raise ConfigError("Latex template directory '%s' does not exist" % self.latexTemplateDirectory)
 
+        if self.confirmationMode not in ["map", "token"]:
+            raise ConfigError("Unknown confirmationMode '%s' (expected map or token)" % self.confirmationMode)
+
+        if self.confirmedCodeBucket <= 0:
+            raise ConfigError("confirmedCodeBucket must be positive")
+
+        if self.confirmExpireInterval <= 0:
+            raise ConfigError("confirmExpireInterval must be positive")
+
         if not os.path.exists(self.modelDirectory):
             raise ConfigError("Model directory '%s' does not exist" % self.modelDirectory)
 
@@ -108,8 +150,52 @@ class Config(object):
         self.latexResultTemplate      = tLoader.load(self.latexResultTemplatePath)
 
         self.loadEmail(config)
+        self.loadMatlab(config)
+        self.loadIsolation(config)
+        self.loadSupervisor(config)
         self.checkIntegrity()
 
+    def optional(self, config, section, option, default, getter="get"):
+        """Reads an option that older config files may lack, falling back to a default."""
+        if config.has_option(section, option):
+            return getattr(config, getter)(section, option)
+        else:
+            return default
+
+    def loadMatlab(self, config):
+        self.matlabPoolSize      = self.optional(config, "Matlab", "poolSize", 0, "getint")
+        self.matlabMaxEngineRuns = self.optional(config, "Matlab", "maxEngineRuns", 50, "getint")
+        self.matlabEngineTimeout = self.optional(config, "Matlab", "engineTimeout", 3600, "getint")
+        self.matlabLicenseSeats  = self.optional(config, "Matlab", "licenseSeats", 0, "getint")
+
+    def loadIsolation(self, config):
+        self.cpusPerSlot        = self.optional(config, "Isolation", "cpusPerSlot", 0, "getint")
+        self.modelNice          = self.optional(config, "Isolation", "modelNice", 0, "getint")
+        self.postProcessingNice = self.optional(config, "Isolation", "postProcessingNice", 10, "getint")
+        self.memoryLimit        = self.optional(config, "Isolation", "memoryLimit", 0, "getint")
+        self.cpuTimeLimit       = self.optional(config, "Isolation", "cpuTimeLimit", 0, "getint")
+        self.wallTimeLimit      = self.optional(config, "Isolation", "wallTimeLimit", 0, "getint")
+
+        #Per-model overrides live in sections named after the model, e.g. [Model abmu_c]
+        self.modelSettings = {}
+        for section in config.sections():
+            if section.startswith("Model "):
+                self.modelSettings[section[len("Model "):].strip()] = dict(config.items(section))
+
+    def modelSetting(self, modelName, option, default=None):
+        """Returns an option from a model's [Model <short_name>] section, or default if it has none."""
+        return self.modelSettings.get(modelName, {}).get(option.lower(), default)
+
+    def loadSupervisor(self, config):
+        self.minWorkers         = self.optional(config, "Supervisor", "minWorkers", 1, "getint")
+        self.maxWorkers         = self.optional(config, "Supervisor", "maxWorkers", 5, "getint")
+        self.scaleInterval      = self.optional(config, "Supervisor", "scaleInterval", 10, "getint")
+        self.scaleUpDelay       = self.optional(config, "Supervisor", "scaleUpDelay", 0, "getint")
+        self.scaleDownDelay     = self.optional(config, "Supervisor", "scaleDownDelay", 300, "getint")
+        self.backlogPerWorker   = self.optional(config, "Supervisor", "backlogPerWorker", 0.0, "getfloat")
+        self.workerLogDirectory = self.optional(config, "Supervisor", "workerLogDirectory",
+                os.path.dirname(self.queueFile))
+
     def loadEmail(self, config):
         self.smtpUsername = config.get("email", "smtpUsername")
         self.smtpPassword = config.get("email", "smtpPassword")
@@ -6,6 +6,7 @@ import random
 import string
 import logging
 import threading
+import collections
 from datetime import datetime
 from config import config
 
@@ -15,8 +16,8 @@ class ConfirmationEntry(object):
         self.expiryTime = datetime.now() + config.confirmTimeout
         self.request    = request
 
-    def expired(self):
-        return datetime.now() >= self.expiryTime
+    def expired(self, now=None):
+        return (now or datetime.now()) >= self.expiryTime
 
 class ExistingCodeError(RuntimeError): pass
 class ConfirmationMap(object):
@@ -24,47 +25,79 @@ class ConfirmationMap(object):
 
     Essentially this is a wrapped hash from code string -> request with some
     helper methods to expire old confirmation entries.
+
+    Every entry expires confirmTimeout after it was put in, so entries also go
+    in a queue in the order they expire. Expiring k entries only looks at
+    those k (and at entries already confirmed, which are skipped), leaving
+    confirmations themselves a hash lookup.
     """
     def __init__(self):
         self.codeToRequest = {}
+        self.expiryOrder   = collections.deque() #(code, entry) pairs, soonest to expire first
+        self.expiredCount  = 0
         self.codeLength    = 16
         self.lock          = threading.RLock()
 
     def getRequestsWithCodes(self):
-        return [(code,c.request) for code,c in self.codeToRequest.iteritems()]
+        with self.lock:
+            return [(code,c.request) for code,c in self.codeToRequest.iteritems()]
 
     def putRequestWithCode(self, request, code):
         with self.lock:
             if code in self.codeToRequest:
                 raise ExistingCodeError("%s already exists in map", code)
 
-            self.codeToRequest[code] = ConfirmationEntry(request)
+            self.addEntry(code, ConfirmationEntry(request))
     
     def putRequest(self, request):
         code = self.generateCode()
         with self.lock:
-            self.codeToRequest[code] = ConfirmationEntry(request)
+            self.addEntry(code, ConfirmationEntry(request))
 
         return code
 
+    def addEntry(self, code, entry):
+        self.codeToRequest[code] = entry
+        self.expiryOrder.append((code, entry))
+
     def getRequest(self, code):
         with self.lock:
-            if code in self.codeToRequest:
-                request = self.codeToRequest[code].request
-                del self.codeToRequest[code]
-                return request
-            else:
-                raise KeyError("Code does not exist")
+            entry = self.codeToRequest.pop(code, None)
+
+        #Entries may outlive their expiry until the next expireConfirmations
+        if entry == None or entry.expired():
+            raise KeyError("Code does not exist")
+
+        return entry.request
 
     def expireConfirmations(self):
-        """Expire old confirmations - meant to be called at a regular rate."""
+        """Expire old confirmations - meant to be called at a regular rate.
+
+        Logs a summary of what expired and returns how many did.
+        """
+
+        now     = datetime.now()
+        expired = 0
+        with self.lock:
+            while len(self.expiryOrder) > 0 and self.expiryOrder[0][1].expired(now):
+                code, entry = self.expiryOrder.popleft()
+                if self.codeToRequest.get(code) is entry:
+                    del self.codeToRequest[code]
+                    expired += 1
+
+            #Confirmed entries are only dropped from the queue once they reach its head
+            if len(self.expiryOrder) > 2 * len(self.codeToRequest) + 1024:
+                self.expiryOrder = collections.deque(e for e in self.expiryOrder if self.codeToRequest.get(e[0]) is e[1])
+
+            self.expiredCount += expired
+
+        if expired > 0:
+            logging.info("Expired %d confirmations, %d remain", expired, len(self.codeToRequest))
+        return expired
 
+    def stats(self):
         with self.lock:
-            delKeys = [k for (k,v) in self.codeToRequest.iteritems() if v.expired()]
-            if len(delKeys) > 0:
-                logging.info("Expiring %d confirmations" % (len(delKeys)))
-                for k in delKeys:
-                    del self.codeToRequest[k]
+            return {"pending": len(self.codeToRequest), "expired": self.expiredCount}
 
     def generateCode(self):
         return "".join(random.choice(string.letters + string.digits)\
@@ -0,0 +1,144 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module used within the queue daemon for stateless confirmation codes.
+
+With confirmationMode = token the queue stores nothing for a request until
+it is confirmed. The confirmation code itself carries the task: its dict,
+compactly encoded and compressed, and an expiry time, signed with an HMAC
+under requestSecret. Confirming the code checks the signature and expiry
+and queues the task it holds. Codes are signed, not encrypted, so anyone
+with the link can read the task (its owner already can, from the email).
+
+All that is kept is the signatures of codes confirmed recently, so that a
+code can't be confirmed twice (see ConfirmedTokens). As the queue can't
+tell which model versions unconfirmed tokens refer to, superseded versions
+are kept for at least confirmTimeout in this mode (see ModelScannerThread).
+"""
+import hmac
+import json
+import time
+import zlib
+import base64
+import hashlib
+import logging
+import threading
+
+class ConfirmationTokenError(RuntimeError): pass
+
+signatureLength = 16
+
+def encodeBase64(data):
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+def decodeBase64(data):
+    return base64.urlsafe_b64decode(str(data) + "=" * (-len(data) % 4))
+
+def signature(payload, secret):
+    return hmac.new(secret, payload, hashlib.sha256).digest()[:signatureLength]
+
+def sameSignature(a, b):
+    """Compares signatures in time independent of where they differ (hmac.compare_digest needs Python 2.7.7)."""
+    if len(a) != len(b):
+        return False
+
+    difference = 0
+    for x, y in zip(a, b):
+        difference |= ord(x) ^ ord(y)
+    return difference == 0
+
+def isToken(code):
+    """True if a confirmation code is a token rather than a confirmation map code."""
+    return "." in code
+
+def encodeToken(taskDict, expiryTime, secret):
+    """Returns a confirmation token for a task dict (see ModelTask.asDict), valid until expiryTime."""
+    parameters = [[p["name"], p["value"]] for p in taskDict["modelParameters"].itervalues()]
+    fields     = [int(expiryTime), taskDict["modelName"], taskDict["modelVersion"], taskDict["taskId"],
+            taskDict["visibleId"], taskDict["emailAddress"], parameters]
+
+    payload = encodeBase64(zlib.compress(json.dumps(fields, separators=(",", ":")), 9))
+    return "%s.%s" % (payload, encodeBase64(signature(payload, secret)))
+
+def decodeToken(token, secret, now=None):
+    """Returns the (task dict, expiry time) a token holds, raising ConfirmationTokenError if it is forged or expired."""
+    try:
+        payload, tokenSignature = str(token).split(".")
+        tokenSignature = decodeBase64(tokenSignature)
+    except (ValueError, TypeError, UnicodeError):
+        raise ConfirmationTokenError("Malformed confirmation token")
+
+    if not sameSignature(tokenSignature, signature(payload, secret)):
+        raise ConfirmationTokenError("Bad confirmation token signature")
+
+    try:
+        expiryTime, modelName, modelVersion, taskId, visibleId, emailAddress, parameters = \
+                json.loads(zlib.decompress(decodeBase64(payload)))
+    except (ValueError, TypeError, zlib.error):
+        raise ConfirmationTokenError("Undecodable confirmation token")
+
+    if (now if now != None else time.time()) >= expiryTime:
+        raise ConfirmationTokenError("Confirmation token expired")
+
+    taskDict = {
+        "emailAddress":    emailAddress,
+        "taskId":          taskId,
+        "visibleId":       visibleId,
+        "failureCount":    0,
+        "modelName":       modelName,
+        "modelVersion":    modelVersion,
+        "modelParameters": dict((name, {"name": name, "value": value}) for name, value in parameters)
+    }
+    return (taskDict, expiryTime)
+
+def tokenKey(token):
+    """Returns the short part of a token identifying it, for remembering that it was confirmed."""
+    return str(token).split(".")[-1]
+
+class ConfirmedTokens(object):
+    """Keys of tokens confirmed that haven't expired yet (thread safe).
+
+    Expired tokens can't be confirmed again anyway, so they are forgotten.
+    The set only ever holds the tokens confirmed within confirmTimeout.
+    """
+
+    def __init__(self, pruneInterval=60):
+        self.expiryTimes   = {}
+        self.pruneInterval = pruneInterval
+        self.nextPrune     = 0
+        self.lock          = threading.Lock()
+
+    def add(self, key, expiryTime, now=None):
+        """Remembers a confirmed token, returning False if it was confirmed before."""
+        now = now if now != None else time.time()
+        with self.lock:
+            if now >= self.nextPrune:
+                self.prune(now)
+
+            if key in self.expiryTimes:
+                return False
+
+            self.expiryTimes[key] = expiryTime
+            return True
+
+    def prune(self, now):
+        expired = [k for (k, expiryTime) in self.expiryTimes.iteritems() if expiryTime <= now]
+        for k in expired:
+            del self.expiryTimes[k]
+
+        if len(expired) > 0:
+            logging.info("Forgot %d expired confirmation tokens", len(expired))
+        self.nextPrune = now + self.pruneInterval
+
+    def __len__(self):
+        return len(self.expiryTimes)
+
+    def asDict(self):
+        with self.lock:
+            return dict(self.expiryTimes)
+
+    @classmethod
+    def fromDict(cls, dictionary):
+        confirmedTokens = cls()
+        confirmedTokens.expiryTimes.update(dictionary)
+        return confirmedTokens
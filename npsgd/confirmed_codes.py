@@ -0,0 +1,149 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module used within the queue daemon for remembering confirmed codes.
+
+Users often click a confirmation link more than once. Once a code has been
+confirmed it leaves the confirmation map, so the queue remembers confirmed
+codes to tell the user "already confirmed" instead of "not found". Nobody
+clicks a link after it would have expired anyway, so codes are only
+remembered for confirmTimeout. They are kept in time buckets (one per
+confirmedCodeBucket seconds) so that forgetting old codes is just dropping
+old buckets.
+
+Buckets are sets of codes or, with confirmedCodeBloomCapacity set, Bloom
+filters of that capacity. A false positive only turns a "not found" into
+an "already confirmed" for a bogus code, so this is where memory can be
+traded for exactness.
+"""
+import math
+import time
+import struct
+import hashlib
+import threading
+import collections
+
+class BloomFilter(object):
+    """Fixed size Bloom filter of strings, sized for capacity entries at errorRate."""
+
+    def __init__(self, capacity, errorRate):
+        self.capacity  = capacity
+        self.errorRate = errorRate
+        self.bitCount  = max(8, int(math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2)))
+        self.hashCount = max(1, int(round(float(self.bitCount) / capacity * math.log(2))))
+        self.bits      = bytearray((self.bitCount + 7) // 8)
+        self.count     = 0
+
+    def indexes(self, key):
+        #Double hashing: k indexes from two halves of one digest
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bitCount for i in xrange(self.hashCount)]
+
+    def add(self, key):
+        for i in self.indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self.indexes(key))
+
+    def __len__(self):
+        return self.count
+
+    def falsePositiveRate(self):
+        """Estimates the chance of a false positive from the share of bits set."""
+        setBits = sum(bin(b).count("1") for b in self.bits)
+        return (float(setBits) / self.bitCount) ** self.hashCount
+
+    def asDict(self):
+        return {
+            "capacity":  self.capacity,
+            "errorRate": self.errorRate,
+            "bits":      str(self.bits),
+            "count":     self.count
+        }
+
+    @classmethod
+    def fromDict(cls, dictionary):
+        bloomFilter = cls(dictionary["capacity"], dictionary["errorRate"])
+        bloomFilter.bits  = bytearray(dictionary["bits"])
+        bloomFilter.count = dictionary["count"]
+        return bloomFilter
+
+class ConfirmedCodes(object):
+    """Codes confirmed within the last lifetime seconds (thread safe).
+
+    Codes may be remembered for up to bucketSeconds longer than lifetime.
+    With bloomCapacity 0 buckets are exact sets.
+    """
+
+    def __init__(self, lifetime, bucketSeconds, bloomCapacity=0, bloomErrorRate=0.001):
+        self.lifetime       = lifetime
+        self.bucketSeconds  = bucketSeconds
+        self.bloomCapacity  = bloomCapacity
+        self.bloomErrorRate = bloomErrorRate
+        self.buckets        = collections.deque() #[endTime, codes] pairs, oldest first
+        self.lock           = threading.Lock()
+
+    def newBucket(self):
+        if self.bloomCapacity > 0:
+            return BloomFilter(self.bloomCapacity, self.bloomErrorRate)
+        return set()
+
+    def expire(self, now):
+        while len(self.buckets) > 0 and self.buckets[0][0] + self.lifetime <= now:
+            self.buckets.popleft()
+
+    def add(self, code, now=None):
+        now = now if now != None else time.time()
+        with self.lock:
+            self.expire(now)
+            if len(self.buckets) == 0 or self.buckets[-1][0] <= now:
+                endTime = (math.floor(now / self.bucketSeconds) + 1) * self.bucketSeconds
+                self.buckets.append([endTime, self.newBucket()])
+
+            self.buckets[-1][1].add(code)
+
+    def contains(self, code, now=None):
+        now = now if now != None else time.time()
+        with self.lock:
+            self.expire(now)
+            return any(code in codes for (endTime, codes) in self.buckets)
+
+    def __contains__(self, code):
+        return self.contains(code)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(codes) for (endTime, codes) in self.buckets)
+
+    def falsePositiveRate(self):
+        """Estimated chance that a code never confirmed is reported as confirmed."""
+        with self.lock:
+            missRate = 1.0
+            for endTime, codes in self.buckets:
+                if isinstance(codes, BloomFilter):
+                    missRate *= 1.0 - codes.falsePositiveRate()
+
+            return 1.0 - missRate
+
+    def stats(self):
+        return {
+            "size":                len(self),
+            "buckets":             len(self.buckets),
+            "false_positive_rate": self.falsePositiveRate()
+        }
+
+    def asDict(self):
+        with self.lock:
+            return {"buckets": [(endTime, codes.asDict() if isinstance(codes, BloomFilter) else list(codes)) \
+                    for (endTime, codes) in self.buckets]}
+
+    def loadDict(self, dictionary, now=None):
+        """Restores buckets saved with asDict, keeping those that haven't expired."""
+        with self.lock:
+            for endTime, codes in dictionary["buckets"]:
+                codes = BloomFilter.fromDict(codes) if isinstance(codes, dict) else set(codes)
+                self.buckets.append([endTime, codes])
+
+            self.expire(now if now != None else time.time())
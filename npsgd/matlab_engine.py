@@ -0,0 +1,280 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module containing a pool of persistent Matlab interpreters.
+
+Starting matlab (and checking out a license) takes many seconds, which
+dominates the run time of short models. Workers instead keep a few interpreters
+warm and feed each task's script into one of them. Tasks are isolated from one
+another by clearing the workspace and switching the working directory before
+every run.
+
+The pool only relies on the interpreter reading commands from stdin and
+supporting disp/try/catch, so it can be exercised against a stand-in script
+in place of matlab (see tests/fake_matlab.py).
+"""
+import os
+import time
+import uuid
+import Queue
+import atexit
+import select
+import logging
+import tempfile
+import threading
+import subprocess
+import child_process
+from config import config
+
+class MatlabEngineError(RuntimeError): pass
+
+def matlabQuote(string):
+    """Quotes a string for inclusion as a Matlab string literal."""
+    return "'%s'" % string.replace("'", "''")
+
+class MatlabEngine(object):
+    """A single long-lived Matlab interpreter.
+
+    Each run is wrapped in a try/catch and followed by a unique marker line so
+    that we know where the output of one task ends and whether it succeeded.
+    """
+
+    def __init__(self, command, timeout=0):
+        self.command       = command
+        self.timeout       = timeout
+        self.process       = None
+        self.runs          = 0
+        self.buffer        = ""
+        self.homeDirectory = tempfile.gettempdir()
+        self.stopTimeout   = 10
+
+    def isAlive(self):
+        return self.process != None and self.process.poll() == None
+
+    def start(self):
+        logging.info("Starting matlab engine '%s'", " ".join(self.command))
+        self.process = child_process.spawn(self.command, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                cwd=self.homeDirectory, cpus=child_process.slotCpus, niceness=config.modelNice)
+        self.runs   = 0
+        self.buffer = ""
+
+        #Swallow the start-up banner so it doesn't end up in the first task's output
+        marker = self.newMarker()
+        self.send("%s\n" % self.markerCode(marker, ""))
+        self.readUntil(marker)
+
+    def stop(self):
+        """Asks the interpreter to exit, killing it if it doesn't within stopTimeout."""
+        if self.process == None:
+            return
+
+        process = self.process
+        self.process = None
+        try:
+            if process.poll() == None:
+                process.stdin.write("exit;\n")
+                process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+        deadline = time.time() + self.stopTimeout
+        while process.poll() == None and time.time() < deadline:
+            time.sleep(0.1)
+
+        if process.poll() == None:
+            logging.warning("Matlab engine %d did not exit, killing it", process.pid)
+            try:
+                process.kill()
+            except OSError:
+                pass
+            process.wait()
+
+    def newMarker(self):
+        return "NPSGD_MARKER_%s" % uuid.uuid4().hex
+
+    def markerCode(self, marker, status):
+        """Matlab code printing a marker line.
+
+        The marker is split in two so that an interpreter echoing its input
+        can't be mistaken for having printed it.
+        """
+        half = len(marker) / 2
+        return "disp([%s %s]);" % (matlabQuote(marker[:half]), matlabQuote("%s %s" % (marker[half:], status)))
+
+    def send(self, code):
+        try:
+            self.process.stdin.write(code)
+            self.process.stdin.flush()
+        except (IOError, OSError), e:
+            raise MatlabEngineError("Unable to write to matlab engine: %s" % e)
+
+    def readLine(self):
+        """Reads a line of output ("" at the end of it).
+
+        Raises MatlabEngineError if the engine prints nothing for timeout
+        seconds (if set), so that a hung engine can't hold a worker forever.
+        """
+        while "\n" not in self.buffer:
+            if self.timeout > 0:
+                ready, unused, unused = select.select([self.process.stdout], [], [], self.timeout)
+                if len(ready) == 0:
+                    raise MatlabEngineError("Matlab engine printed nothing for %ds" % self.timeout)
+
+            data = os.read(self.process.stdout.fileno(), 4096)
+            if data == "":
+                line, self.buffer = self.buffer, ""
+                return line
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split("\n", 1)
+        return line + "\n"
+
+    def readUntil(self, marker, outputCallback=None):
+        """Reads output lines up to (not including) the line containing marker.
+
+        Lines are passed to outputCallback as they arrive if one is given,
+        otherwise they are collected. Returns a tuple of the collected lines
+        and the remainder of the marker line.
+        """
+        lines = []
+        while True:
+            line = self.readLine()
+            if line == "":
+                raise MatlabEngineError("Matlab engine exited unexpectedly (code %s)" % self.process.wait())
+
+            stripped = line.rstrip("\r\n")
+            #Matlab may prefix output with its '>>' prompt
+            markerIndex = stripped.find(marker)
+            if markerIndex >= 0:
+                return lines, stripped[markerIndex + len(marker):].strip()
+
+            if outputCallback != None:
+                outputCallback(line)
+            else:
+                lines.append(line)
+
+    def run(self, workingDirectory, scriptDirectory, scriptFunction, parameterCode, outputCallback=None):
+        """Runs a script in a freshly cleared workspace.
+
+        Returns a tuple (succeeded, output) where output is everything the
+        script printed, unless it was streamed to outputCallback instead.
+        """
+        if not self.isAlive():
+            self.start()
+
+        self.runs += 1
+        marker = self.newMarker()
+        code = "\n".join([
+            "clear variables; clear global;",
+            "npsgdSavedPath = path;",
+            "cd(%s);" % matlabQuote(workingDirectory),
+            "try",
+            parameterCode,
+            "path(%s, path);" % matlabQuote(scriptDirectory),
+            "%s;" % scriptFunction,
+            self.markerCode(marker, "ok"),
+            "catch npsgdError",
+            "disp(npsgdError.message);",
+            self.markerCode(marker, "error"),
+            "end",
+            "path(npsgdSavedPath);",
+            "cd(%s);" % matlabQuote(self.homeDirectory),
+            self.markerCode(marker, "end"),
+            ""])
+
+        self.send(code)
+        #Reaching the end marker without a status means matlab couldn't even parse the script
+        succeeded = False
+        output    = []
+        while True:
+            lines, status = self.readUntil(marker, outputCallback)
+            output.extend(lines)
+            if status == "end":
+                return succeeded, "".join(output)
+
+            succeeded = (status == "ok")
+
+class MatlabEnginePool(object):
+    """Fixed-size pool of Matlab engines (thread safe).
+
+    Engines are started lazily and recycled after maxRuns runs or whenever a run
+    fails, so that a crashed or polluted interpreter never serves another task.
+    """
+
+    def __init__(self, command, size, maxRuns, timeout=0):
+        self.maxRuns = maxRuns
+        self.engines = [MatlabEngine(command, timeout) for i in xrange(size)]
+        self.idle    = Queue.Queue()
+        for engine in self.engines:
+            self.idle.put(engine)
+
+    def run(self, workingDirectory, scriptDirectory, scriptFunction, parameterCode, outputCallback=None):
+        return self.runMany([(workingDirectory, scriptDirectory, scriptFunction, parameterCode)], [outputCallback])[0]
+
+    def runMany(self, jobs, outputCallbacks=None, watchers=None):
+        """Runs several scripts back to back on a single engine.
+
+        Each job is a (workingDirectory, scriptDirectory, scriptFunction, parameterCode)
+        tuple, optionally with a matching output callback and watcher. A watcher
+        is told about the engine process for the duration of its job (see
+        ModelTask.watchProcess) so that it can kill the engine to abort the job,
+        and its clock (see ModelTask.startClock) only runs during its job.
+        Returns a list of (succeeded, output) tuples, one per job.
+        """
+        if outputCallbacks == None:
+            outputCallbacks = [None] * len(jobs)
+        if watchers == None:
+            watchers = [None] * len(jobs)
+
+        engine = self.idle.get(True)
+        try:
+            results = []
+            for job, outputCallback, watcher in zip(jobs, outputCallbacks, watchers):
+                try:
+                    if not engine.isAlive():
+                        engine.start()
+
+                    process = engine.process
+                    if watcher != None:
+                        watcher.startClock()
+                        watcher.watchProcess(process)
+                    try:
+                        succeeded, output = engine.run(*job, outputCallback=outputCallback)
+                    finally:
+                        if watcher != None:
+                            watcher.unwatchProcess(process)
+                            watcher.stopClock()
+                except Exception:
+                    engine.stop()
+                    raise
+
+                if not succeeded:
+                    logging.info("Recycling matlab engine after a failed run")
+                    engine.stop()
+                elif engine.runs >= self.maxRuns:
+                    logging.info("Recycling matlab engine after %d runs", engine.runs)
+                    engine.stop()
+
+                results.append((succeeded, output))
+
+            return results
+        finally:
+            self.idle.put(engine)
+
+    def shutdown(self):
+        for engine in self.engines:
+            engine.stop()
+
+enginePool     = None
+enginePoolLock = threading.Lock()
+def getEnginePool():
+    """Returns the worker's engine pool, creating it on first use."""
+    global enginePool
+    with enginePoolLock:
+        if enginePool == None:
+            enginePool = MatlabEnginePool([config.matlabPath, "-nodisplay"],
+                    config.matlabPoolSize, config.matlabMaxEngineRuns, config.matlabEngineTimeout)
+            atexit.register(enginePool.shutdown)
+
+    return enginePool
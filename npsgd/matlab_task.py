@@ -5,7 +5,7 @@
 """Module containing classes relating to Matlab modelling tasks."""
 import os
 import logging
-import subprocess
+import matlab_engine
 from model_task import ModelTask
 from config import config
 
@@ -21,22 +21,88 @@ class MatlabTask(ModelTask):
 
     abstractModel = "MatlabTask"
 
+    #Bundles run back to back on one warm engine when the engine pool is enabled
+    supportsBundling = True
+
+    @classmethod
+    def concurrencyLimits(cls):
+        """All matlab models share the license seats (see licenseSeats in the config)."""
+        seats = config.matlabLicenseSeats if config.matlabLicenseSeats > 0 else None
+        return super(MatlabTask, cls).concurrencyLimits() + [("matlab", seats, None)]
+
     #Must specify matlab script
 
-    def runModel(self):
+    def matlabJob(self):
+        """Returns (workingDirectory, scriptDirectory, scriptFunction, parameterCode) for this task."""
         matlabBase = os.path.dirname(self.matlabScript)
         matlabFun  = os.path.basename(self.matlabScript).rsplit(".",1)[0]
+        paramCode  = "\n".join(p.asMatlabCode() for p in self.modelParameters)
+
+        return (self.workingDirectory, matlabBase, matlabFun, paramCode)
+
+    def matlabOutputCallback(self):
+        """Returns a callback streaming pooled engine output (stdout and stderr merged) to the task log."""
+        output = self.taskOutput()
+        return lambda line: output.line("stdout", line)
+
+    def runModel(self):
+        if config.matlabPoolSize > 0:
+            self.runModelInEngine()
+        else:
+            self.runModelInProcess()
+
+    def runModelInEngine(self):
+        """Runs the matlab script in one of the worker's persistent matlab engines."""
+
+        job = self.matlabJob()
+        output = self.taskOutput()
+        logging.info("Running matlab script '%s' in a pooled engine with parameters:\n %s", job[2], job[3])
+        try:
+            [(succeeded, unused)] = matlab_engine.getEnginePool().runMany([job],
+                    [self.matlabOutputCallback()], [self])
+        except matlab_engine.MatlabEngineError:
+            self.checkCancelled()
+            raise
+        self.stdout = output.tail("stdout")
+        logging.info("Matlab output was written to '%s'", output.path)
 
-        paramCode = "\n".join(p.asMatlabCode() for p in self.modelParameters)
+        if not succeeded:
+            logging.warning("Matlab failed, last output was: --------\n%s\n-----", self.stdout)
+            raise MatlabError("Matlab script '%s' raised an error" % self.matlabScript)
+        logging.info("Matlab all done!")
+
+    @classmethod
+    def runModelBundle(cls, tasks):
+        """Runs a bundle of tasks back to back on a single pooled engine."""
+
+        if config.matlabPoolSize <= 0 or len(tasks) == 1:
+            return super(MatlabTask, cls).runModelBundle(tasks)
+
+        jobs = [task.matlabJob() for task in tasks]
+        outputCallbacks = [task.matlabOutputCallback() for task in tasks]
+        logging.info("Running bundle of %d matlab tasks in a pooled engine", len(tasks))
+        errors = []
+        for task, (succeeded, unused) in zip(tasks, matlab_engine.getEnginePool().runMany(jobs, outputCallbacks, tasks)):
+            task.stdout = task.taskOutput().tail("stdout")
+            if succeeded:
+                errors.append(None)
+            else:
+                errors.append(MatlabError("Matlab script '%s' raised an error" % task.matlabScript))
+
+        return errors
+
+    def runModelInProcess(self):
+        """Runs the matlab script in a freshly launched matlab process."""
+
+        workingDirectory, matlabBase, matlabFun, paramCode = self.matlabJob()
         io = "%s;\npath('%s', path);\n%s;\nexit;\n" % (paramCode, matlabBase, matlabFun)
 
         logging.info("Opening matlab with script:\n %s", io)
-        mProcess = subprocess.Popen([config.matlabPath, "-nodisplay"], stdin=subprocess.PIPE, 
-                cwd=self.workingDirectory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = mProcess.communicate(io)
-        logging.info("Stdout was: --------\n%s\n-----",  stdout)
-        logging.info("Stderr was: --------\n%s\n-----",  stderr)
-
-        if mProcess.returncode != 0:
-            raise MatlabError("Bad return code %s from matlab" % mProcess.returncode)
+        returnCode = self.runProcess([config.matlabPath, "-nodisplay"], input=io,
+                limitResources=True, cwd=self.workingDirectory)
+        logging.info("Matlab output was written to '%s'", self.taskOutput().path)
+
+        if returnCode != 0:
+            logging.warning("Matlab failed, last output was: --------\n%s\n-----", self.outputTail())
+            raise MatlabError("Bad return code %s from matlab" % returnCode)
         logging.info("Matlab all done!")
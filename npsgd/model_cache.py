@@ -0,0 +1,122 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module used within workers for keeping model source fetched from the queue.
+
+A model version is the md5 of its file (mixed with the versions of the model
+files it imports), so a worker can only run tasks whose model source it has
+byte for byte. Rather than waiting for every host's model directory to be
+updated, workers that see queued tasks for a version they lack fetch its
+source from the queue, which serves it by version. Fetched files are checked
+against their versions before they are used and kept here, so that restarts
+don't need to fetch them again. Only the modelCacheSize most recently used
+model versions are kept.
+"""
+import os
+import glob
+import pickle
+import hashlib
+import logging
+import threading
+from model_manager import fileVersion
+from model_metadata import FileMetadata
+
+class ModelBundleError(RuntimeError): pass
+
+def verifyFiles(files):
+    """Checks that fetched model files (FileMetadata, those imported first) match their versions."""
+    versions = {}
+    for fileMetadata in files:
+        dependencyVersions = []
+        for importName, version in fileMetadata.dependencies:
+            if versions.get(importName) != version:
+                raise ModelBundleError("Model file '%s' imports '%s' version '%s', which wasn't sent before it" % \
+                        (fileMetadata.importName, importName, version))
+            dependencyVersions.append(version)
+
+        actualVersion = fileVersion(hashlib.md5(fileMetadata.source).hexdigest(), dependencyVersions)
+        if actualVersion != fileMetadata.version:
+            raise ModelBundleError("Model file '%s' should be version '%s' but is '%s'" % \
+                    (fileMetadata.importName, fileMetadata.version, actualVersion))
+
+        versions[fileMetadata.importName] = fileMetadata.version
+
+class ModelSourceCache(object):
+    """Directory of fetched model source, one bundle of files per model version (thread safe).
+
+    Bundles (pickled lists of FileMetadata) sit next to the source files they
+    refer to, which are shared between bundles. Bundles are evicted least
+    recently used first, along with the files no remaining bundle needs.
+    """
+
+    def __init__(self, directory, maxBundles):
+        self.directory  = directory
+        self.maxBundles = maxBundles
+        self.lock       = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def bundlePath(self, name, version):
+        return os.path.join(self.directory, "%s-%s.bundle" % (name, version))
+
+    def sourcePath(self, importName, version):
+        return os.path.join(self.directory, "%s-%s.py" % (importName, version))
+
+    def get(self, name, version):
+        """Returns the cached files of a model version, or None if we don't have them."""
+        path = self.bundlePath(name, version)
+        with self.lock:
+            try:
+                with open(path, "rb") as f:
+                    files = pickle.load(f)
+                verifyFiles(files)
+            except IOError:
+                return None
+            except Exception, e:
+                logging.warning("Dropping bad cached model bundle %s: %s", path, e)
+                os.remove(path)
+                return None
+
+            os.utime(path, None)
+            return files
+
+    def put(self, name, version, files):
+        """Caches the verified files of a model version, returning them with their local paths."""
+        verifyFiles(files)
+        with self.lock:
+            cached = []
+            for fileMetadata in files:
+                path = self.sourcePath(fileMetadata.importName, fileMetadata.version)
+                self.writeFile(path, fileMetadata.source)
+                cached.append(FileMetadata(fileMetadata.importName, path, fileMetadata.version,
+                    fileMetadata.source, fileMetadata.dependencies, None))
+
+            self.writeFile(self.bundlePath(name, version), pickle.dumps(cached, pickle.HIGHEST_PROTOCOL))
+            self.prune()
+
+        logging.info("Cached model '%s' version '%s' (%d files)", name, version, len(cached))
+        return cached
+
+    def writeFile(self, path, data):
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+
+    def prune(self):
+        """Evicts the least recently used bundles beyond maxBundles, and source files left unused."""
+        bundles = sorted(glob.glob(os.path.join(self.directory, "*.bundle")), key=os.path.getmtime)
+        for path in bundles[:max(0, len(bundles) - self.maxBundles)]:
+            logging.info("Evicting cached model bundle %s", path)
+            os.remove(path)
+
+        used = set()
+        for path in glob.glob(os.path.join(self.directory, "*.bundle")):
+            try:
+                with open(path, "rb") as f:
+                    used.update(fileMetadata.path for fileMetadata in pickle.load(f))
+            except Exception:
+                logging.warning("Unreadable cached model bundle %s", path)
+
+        for path in glob.glob(os.path.join(self.directory, "*.py")):
+            if path not in used:
+                os.remove(path)
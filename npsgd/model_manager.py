@@ -5,13 +5,28 @@
 import os
 import sys
 import imp
+import ast
 import glob
+import time
 import hashlib
 import inspect
+import json
+import socket
+import urllib
+import httplib
+import urllib2
 import logging
 import threading
 from npsgd.config import config
+
+try:
+    import pyinotify
+    from pyinotify import ProcessEvent
+except ImportError:
+    pyinotify = None
 from model_task import ModelTask
+from model_parameters import ValidationError
+import model_metadata
 
 class InvalidModelError(RuntimeError): pass
 class ModelManager(object):
@@ -19,12 +34,16 @@ class ModelManager(object):
     
     This essentially takes the form of hash from (modelName, modelVersion) to 
     the actual model classes (from modules). This class is thread safe.
+
+    Old versions are unloaded once they have been superseded for a while and
+    no task refers to them any more (see collectGarbage).
     """
 
     def __init__(self):
         self.modelLock = threading.RLock()
         self.models = {}
         self.latestVersions = {}
+        self.supersededTimes = {}
 
     def modelNames(self):
         with self.modelLock:
@@ -42,6 +61,55 @@ class ModelManager(object):
         with self.modelLock:
             return self.models[(name, version)]
 
+    def getExecutionModel(self, name, version):
+        """Like getModel, but returns the class that actually runs the model (importing its code on first use)."""
+        model = self.getModel(name, version)
+        try:
+            return model_metadata.executionClass(model)
+        except model_metadata.ModelMetadataError, e:
+            raise InvalidModelError(str(e))
+
+    def sourceBundle(self, name, version):
+        """Returns the source of a model version's file and of the model files it imports, those first.
+
+        These are model_metadata.FileMetadata, for serving to workers that lack the version.
+        """
+        model = self.getModel(name, version)
+        try:
+            return model_metadata.fileBundle(model.__module__, version)
+        except model_metadata.ModelMetadataError, e:
+            raise InvalidModelError(str(e))
+
+    def migrateTaskDict(self, taskDict):
+        """Rebuilds a task for the latest version of its model, raising InvalidModelError if that can't take it.
+
+        The latest version must take parameters of the same names and types as
+        the task's version (if we still know it, otherwise just the same
+        names), and the task's values are validated again on the way.
+        """
+        name    = taskDict["modelName"]
+        version = taskDict["modelVersion"]
+        with self.modelLock:
+            if name not in self.latestVersions:
+                raise InvalidModelError("No versions of model '%s'" % name)
+            latest   = self.latestVersions[name]
+            previous = self.models.get((name, version))
+
+        if latest.version == version:
+            raise InvalidModelError("Model '%s' version '%s' is already the latest" % (name, version))
+
+        if previous != None and previous.parameterSignature() != latest.parameterSignature():
+            raise InvalidModelError("Model '%s' version '%s' takes different parameters than version '%s'" % \
+                    (name, latest.version, version))
+
+        if set(taskDict["modelParameters"].keys()) != set(p.name for p in latest.parameters):
+            raise InvalidModelError("Task parameters don't match those of model '%s' version '%s'" % (name, latest.version))
+
+        try:
+            return latest.fromDict(dict(taskDict, modelVersion=latest.version))
+        except (ValidationError, ValueError, TypeError), e:
+            raise InvalidModelError("Task parameters are invalid for model '%s' version '%s': %s" % (name, latest.version, e))
+
     def getModelFromTaskDict(self, taskDict):
         name    = taskDict["modelName"]
         version = taskDict["modelVersion"]
@@ -56,8 +124,12 @@ class ModelManager(object):
         with self.modelLock:
             return (name, version) in self.models
 
-    def addModel(self, cls, version):
-        """Add a model to th hash, provided it is well formed."""
+    def addModel(self, cls, version, latest=True):
+        """Add a model to th hash, provided it is well formed.
+
+        Versions that aren't the latest (e.g. fetched for stranded tasks) are
+        added as already superseded.
+        """
         #Ignore abstract models
         if not hasattr(cls, 'abstractModel') or cls.abstractModel == cls.__name__:
             return
@@ -77,9 +149,48 @@ class ModelManager(object):
         cls.version = version
         with self.modelLock:
             self.models[(cls.short_name, version)] = cls
-            self.latestVersions[cls.short_name] = cls
+            if not latest and cls.short_name in self.latestVersions:
+                self.supersededTimes[(cls.short_name, version)] = time.time()
+            else:
+                if cls.short_name in self.latestVersions:
+                    self.supersededTimes[(cls.short_name, self.latestVersions[cls.short_name].version)] = time.time()
+                self.latestVersions[cls.short_name] = cls
+                self.supersededTimes.pop((cls.short_name, version), None)
+
             logging.info("Found and loaded model '%s', version '%s'", cls.short_name, cls.version)
 
+    def collectGarbage(self, referencedVersions, graceSeconds):
+        """Unloads model versions superseded over graceSeconds ago that aren't in referencedVersions.
+
+        referencedVersions holds the (name, version) pairs that queued,
+        processing or unconfirmed tasks still use. The latest version of a
+        model is never unloaded. Returns the unloaded pairs.
+        """
+        oldTime = time.time() - graceSeconds
+        with self.modelLock:
+            unloaded = [key for key, supersededTime in self.supersededTimes.iteritems() \
+                    if supersededTime < oldTime and key not in referencedVersions]
+
+            for key in unloaded:
+                del self.supersededTimes[key]
+                cls = self.models.pop(key, None)
+                if cls == None:
+                    continue
+
+                #Only drop the module if it hasn't been replaced by a newer load already
+                module = sys.modules.get(cls.__module__)
+                if module != None and getattr(module, cls.__name__, None) is cls:
+                    del sys.modules[cls.__module__]
+
+                if not any(c.__module__ == cls.__module__ and c.version == cls.version for c in self.models.itervalues()):
+                    model_metadata.forgetExecution(cls.__module__, cls.version)
+
+        if len(unloaded) > 0:
+            logging.info("Unloaded %d unreferenced old model versions: %s", len(unloaded),
+                    ", ".join("%s-%s" % key for key in unloaded))
+
+        return unloaded
+
     def getModelVersion(self, cls):
         sourceCode = inspect.getsource(inspect.getmodule(cls))
         m = hashlib.md5()
@@ -87,62 +198,347 @@ class ModelManager(object):
         return m.hexdigest()
 
 
-def loadMembers(mod, version):
+def loadMembers(mod, version, latest=True):
     """Steps through all classes in a given module and loads those that are NPSGD models."""
     global modelManager
     for name, obj in inspect.getmembers(mod):
         if inspect.isclass(obj) and obj.__module__ == mod.__name__ and issubclass(obj, ModelTask):
-            modelManager.addModel(obj, version)
+            modelManager.addModel(obj, version, latest)
+
+def fileVersion(digest, dependencyVersions):
+    """Returns the version of a model file given the md5 of its source and the versions of the model files it imports."""
+    if len(dependencyVersions) == 0:
+        return digest
+
+    return hashlib.md5(digest + "".join(dependencyVersions)).hexdigest()
+
+class ModelFile(object):
+    """What the scanner knows about a single python file in the model directory."""
+
+    def __init__(self, importName, path):
+        self.importName   = importName
+        self.path         = path
+        self.mtime        = None
+        self.size         = None
+        self.digest       = None
+        self.dependencies = []
+        self.version      = None
+        self.source       = None
+
+def importedNames(source):
+    """Returns the names of all modules imported by python source (without importing anything)."""
+    names = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module != None:
+            names.add(node.module.split(".")[0])
+
+    return names
+
+class ModelScanner(object):
+    """Incremental loader of the models in a directory.
+
+    Files are only rehashed when their modification time or size changes, and
+    only re-imported when their contents (or those of a model file they
+    import, e.g. abmb_c importing abmu_c) changed. A file's version is the md5
+    of its source, mixed with the versions of the model files it imports, so
+    that editing a shared module gives its dependents new versions too.
+
+    With lazyModelImports, model files aren't imported here at all; stand-in
+    classes are built from their metadata instead (see model_metadata).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files     = {}
+        self.cache     = model_metadata.MetadataCache(config.modelMetadataDirectory) \
+                if config.lazyModelImports else None
+
+    def listFiles(self):
+        return dict((os.path.basename(path).rsplit(".", 1)[0], path)
+                for path in glob.glob("%s/*.py" % self.directory))
+
+    def changedFiles(self, paths, candidates):
+        """Rehashes candidates whose mtime or size changed, returning the names whose contents changed."""
+        changed = set()
+        for importName in candidates:
+            path = paths[importName]
+            try:
+                stat = os.stat(path)
+                if importName in self.files and \
+                        (self.files[importName].mtime, self.files[importName].size) == (stat.st_mtime, stat.st_size):
+                    continue
+
+                with open(path) as f:
+                    source = f.read()
+            except (IOError, OSError), e:
+                logging.warning("Unable to read model file '%s': %s", path, e)
+                continue
+
+            modelFile = self.files.setdefault(importName, ModelFile(importName, path))
+            modelFile.mtime, modelFile.size = stat.st_mtime, stat.st_size
+            digest = hashlib.md5(source).hexdigest()
+            if digest == modelFile.digest:
+                continue
+
+            modelFile.digest = digest
+            modelFile.source = source
+            try:
+                modelFile.dependencies = sorted(importedNames(source) & set(paths))
+            except SyntaxError:
+                modelFile.dependencies = []
+            changed.add(importName)
+
+        return changed
+
+    def loadOrder(self, names):
+        """Orders names so that model files come after the model files they import."""
+        order   = []
+        visited = set()
+        def visit(importName):
+            if importName in visited:
+                return
+            visited.add(importName)
+            for dependency in self.files[importName].dependencies:
+                if dependency in self.files:
+                    visit(dependency)
+            if importName in names:
+                order.append(importName)
+
+        for importName in sorted(names):
+            visit(importName)
+
+        return order
+
+    def version(self, modelFile):
+        return fileVersion(modelFile.digest, [self.files[d].version for d in modelFile.dependencies if d in self.files])
+
+    def scan(self, hints=None):
+        """Loads new and changed models.
+
+        If hints is given (import names from filesystem events), only those
+        files are checked for changes, otherwise all of them are.
+        """
+        startTime = time.time()
+        paths     = self.listFiles()
+        for importName in self.files.keys():
+            if importName not in paths:
+                del self.files[importName]
 
-def setupModels():
-    """Attempts to do the initial load of all models. Must be called on script startup.
+        candidates = paths.keys() if hints == None else [n for n in hints if n in paths]
+        changed    = self.changedFiles(paths, candidates)
+
+        #Everything importing a changed file needs reloading too
+        reload = set(changed)
+        while True:
+            dependents = set(n for n, f in self.files.iteritems() if reload.intersection(f.dependencies))
+            if dependents.issubset(reload):
+                break
+            reload.update(dependents)
+
+        files = []
+        for importName in self.loadOrder(reload):
+            modelFile = self.files[importName]
+            modelFile.version = self.version(modelFile)
+            files.append(model_metadata.FileMetadata(importName, modelFile.path, modelFile.version, modelFile.source,
+                [(d, self.files[d].version) for d in modelFile.dependencies if d in self.files], None))
+
+        self.loadFiles(files)
+
+        elapsed = time.time() - startTime
+        if len(reload) > 0:
+            logging.info("Model scan took %.3fs: checked %d files, %d changed, reloaded %d",
+                    elapsed, len(candidates), len(changed), len(reload))
+        else:
+            logging.debug("Model scan took %.3fs: checked %d files, none changed", elapsed, len(candidates))
+
+    def loadFiles(self, files, latest=True):
+        """Loads the models of files (FileMetadata, in load order) as the latest versions or old ones.
+
+        With lazyModelImports stand-ins are added, extracting the metadata of
+        uncached files in one go, otherwise the files are imported right away.
+        """
+        if self.cache == None:
+            for fileMetadata in files:
+                model_metadata.rememberFile(fileMetadata)
+                try:
+                    if latest:
+                        module = imp.load_source(fileMetadata.importName, fileMetadata.path)
+                    else:
+                        #Old versions get modules of their own, loading over the latest one's would change its globals
+                        module = model_metadata.executionModule(fileMetadata.importName, fileMetadata.version, register=False)
+                    loadMembers(module, fileMetadata.version, latest)
+                except Exception:
+                    logging.exception("Unable to load model from '%s'" % fileMetadata.importName)
+            return
+
+        metadata = [self.cache.get(f.importName, f.version) for f in files]
+        missing  = [f.importName for f, m in zip(files, metadata) if m == None]
+        if len(missing) > 0:
+            #Extract everything given, so the files see each other's versions when they import each other
+            logging.info("Extracting model metadata from %s", missing)
+            try:
+                extracted = model_metadata.extractFiles([(f.importName, f.path) for f in files])
+            except (model_metadata.ModelMetadataError, OSError), e:
+                logging.error("Unable to extract model metadata: %s", e)
+                extracted = {}
+
+            for i, fileMetadata in enumerate(files):
+                if metadata[i] != None:
+                    continue
+
+                classes = extracted.get(fileMetadata.importName, "no metadata extracted")
+                if isinstance(classes, basestring):
+                    logging.error("Unable to load model from '%s': %s", fileMetadata.importName, classes)
+                    continue
+
+                fileMetadata.classes = classes
+                metadata[i] = fileMetadata
+                self.cache.put(fileMetadata)
+
+        for fileMetadata in metadata:
+            if fileMetadata == None:
+                continue
+            try:
+                for cls in model_metadata.standInClasses(fileMetadata):
+                    modelManager.addModel(cls, fileMetadata.version, latest)
+            except Exception:
+                logging.exception("Unable to load model from '%s'" % fileMetadata.importName)
+
+modelScanner = None
+def setupModels(hints=None):
+    """Loads all new or changed models. Must be called on script startup.
     
     This method scans the the model directory and finds all python scripts available.
     It computes a hash of the scripts (i.e. a 'version') then attempts to load all
-    NPSGD models held within, using the version previously configured.
+    NPSGD models held within, using the version previously configured. Later
+    calls only reload what changed since (see ModelScanner).
     """
+    global modelScanner
     if config.modelDirectory not in sys.path:
         sys.path.append(config.modelDirectory)
-    t = 0
+
+    if modelScanner == None:
+        modelScanner = ModelScanner(config.modelDirectory)
+
     try:
         sys.dont_write_bytecode = True
-        for pyfile in glob.glob("%s/*.py" % config.modelDirectory):
-            importName = os.path.basename(pyfile).rsplit(".", 1)[0]
-            t += 1
-            try:
-                m = hashlib.md5()
-                with open(pyfile) as f:
-                    m.update(f.read())
+        modelScanner.scan(hints)
+    finally:
+        sys.dont_write_bytecode = False
 
-                version = m.hexdigest()
-                module = imp.load_source(importName, pyfile)
-                loadMembers(module, version)
-            except Exception:
-                logging.exception("Unable to load model from '%s'" % importName)
-                continue
+def loadModelFiles(files):
+    """Loads model files fetched from elsewhere (FileMetadata, in load order) as old versions."""
+    global modelScanner
+    if modelScanner == None:
+        modelScanner = ModelScanner(config.modelDirectory)
+
+    try:
+        sys.dont_write_bytecode = True
+        modelScanner.loadFiles(files, latest=False)
     finally:
         sys.dont_write_bytecode = False
 
+class ModelEventHandler(ProcessEvent if pyinotify else object):
+    """Collects the import names of model files touched according to inotify."""
+
+    def my_init(self):
+        self.names = set()
+
+    def process_default(self, event):
+        if event.name.endswith(".py"):
+            self.names.add(event.name.rsplit(".", 1)[0])
+
+def queueReferencedVersions():
+    """Asks the queue which model versions its tasks refer to, returning None if it can't be reached."""
+    try:
+        response = urllib2.urlopen("http://%s:%s/client_model_references?%s" % (config.queueServerAddress,
+            config.queueServerPort, urllib.urlencode({"secret": config.requestSecret})))
+        return set(tuple(key) for key in json.load(response)["response"])
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError, KeyError), e:
+        logging.warning("Unable to get referenced model versions from the queue: %s", e)
+        return None
+
 class ModelScannerThread(threading.Thread):
-    """Thread for periodically loading new versions of models."""
-    def __init__(self):
+    """Thread for loading new versions of models as they appear.
+
+    With pyinotify installed, the thread sleeps until the model directory
+    changes. Otherwise it polls every modelScanInterval seconds, which only
+    costs a stat per file (see ModelScanner).
+
+    Every modelCollectInterval seconds it also unloads old model versions
+    that referencedVersions() (a set of (name, version) pairs, or None if
+    unknown) says are no longer in use.
+    """
+    def __init__(self, referencedVersions):
         threading.Thread.__init__(self)
         self.done = threading.Event()
         self.daemon = True
+        self.referencedVersions = referencedVersions
+        self.lastCollect = time.time()
 
     def run(self):
+        if pyinotify != None:
+            self.watchDirectory()
+
         while True:
             self.done.wait(config.modelScanInterval)
             if self.done.isSet():
                 break
             logging.debug("Model scanner thread scanning for models")
             setupModels()
+            self.collectIfDue()
+
+    def collectIfDue(self):
+        if config.modelVersionGrace <= 0 or time.time() - self.lastCollect < config.modelCollectInterval:
+            return
+
+        self.lastCollect = time.time()
+        graceSeconds = config.modelVersionGrace
+        if config.confirmationMode == "token":
+            #Unconfirmed requests only exist in their tokens, which we can't see: keep versions until those expire
+            graceSeconds = max(graceSeconds, config.confirmTimeoutSeconds)
+
+        try:
+            referenced = self.referencedVersions()
+            if referenced != None:
+                modelManager.collectGarbage(referenced, graceSeconds)
+        except Exception:
+            #Losing this thread would also stop new model versions from loading
+            logging.exception("Unable to unload old model versions, trying again later")
+
+    def watchDirectory(self):
+        handler  = ModelEventHandler()
+        manager  = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, handler, timeout=config.modelScanInterval * 1000)
+        manager.add_watch(config.modelDirectory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+        logging.info("Watching model directory '%s' with inotify", config.modelDirectory)
+
+        while not self.done.isSet():
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+
+            if len(handler.names) > 0:
+                names, handler.names = handler.names, set()
+                logging.debug("Model scanner thread reloading changed models %s", sorted(names))
+                setupModels(names)
+
+            self.collectIfDue()
+
+        notifier.stop()
 
 modelScannerThread = None
-def startScannerThread():
-    """Start the dynamic model loader, loading models as they are modified."""
+def startScannerThread(referencedVersions=queueReferencedVersions):
+    """Start the dynamic model loader, loading models as they are modified.
+
+    Old versions are unloaded once referencedVersions() no longer lists them
+    (by default the queue is asked, see queueReferencedVersions).
+    """
     global modelScannerThread
-    modelScannerThread = ModelScannerThread()
+    modelScannerThread = ModelScannerThread(referencedVersions)
     modelScannerThread.start()
 
 modelManager = ModelManager()
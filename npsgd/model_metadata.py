@@ -0,0 +1,369 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module for knowing about models without importing their code.
+
+Importing a model module can be expensive (abmu_c pulls in matplotlib), yet
+the web and queue daemons only need a model's names, parameters and a few
+cheap methods such as estimatedCost. Model files are therefore imported once
+per version in a throwaway subprocess that records what each model class
+holds. Records are cached on disk by version, and daemons build light
+stand-in classes from them. A model's real module is only imported the first
+time one of its other methods is used (or a worker asks for the class that
+runs it, see executionClass).
+"""
+import os
+import sys
+import imp
+import types
+import pickle
+import inspect
+import logging
+import tempfile
+import textwrap
+import threading
+import subprocess
+from config import config
+
+class ModelMetadataError(RuntimeError): pass
+class ClassMetadata(object):
+    """What a daemon needs to know about a single model class.
+
+    attributes holds the picklable class attributes the model defines (or
+    inherits from other models), methods the names of everything else it
+    defines. portableMethods maps the names of metadataMethods that only use
+    cheap globals to their source and those globals (see portableSource).
+    """
+
+    def __init__(self, className, baseModule, baseName):
+        self.className       = className
+        self.baseModule      = baseModule
+        self.baseName        = baseName
+        self.attributes      = {}
+        self.methods         = []
+        self.portableMethods = {}
+
+class FileMetadata(object):
+    """Metadata of every model class in one version of a model file."""
+
+    def __init__(self, importName, path, version, source, dependencies, classes):
+        self.importName   = importName
+        self.path         = path
+        self.version      = version
+        self.source       = source
+        self.dependencies = dependencies
+        self.classes      = classes
+
+class CheapModules(object):
+    """Modules a daemon has loaded anyway: npsgd's own and whatever was imported before the models."""
+
+    def __init__(self):
+        self.preloaded = set(sys.modules.keys())
+
+    def __contains__(self, name):
+        return name in self.preloaded or name == "npsgd" or str(name).startswith("npsgd.")
+
+def globalReference(value, cheapModules):
+    """Describes how to find a global again without importing anything expensive, or returns None."""
+    if isinstance(value, types.ModuleType):
+        if value.__name__ in cheapModules:
+            return ("module", value.__name__)
+    elif isinstance(value, (int, long, float, str, unicode, bool, type(None))):
+        return ("value", value)
+    elif getattr(value, "__module__", None) in cheapModules and value.__module__ in sys.modules and \
+            getattr(sys.modules[value.__module__], getattr(value, "__name__", ""), None) is value:
+        return ("object", value.__module__, value.__name__)
+
+    return None
+
+def codeNames(code):
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names.update(codeNames(constant))
+
+    return names
+
+def portableSource(function, cheapModules):
+    """Returns (source, globals) for a plain function that only uses cheap globals, otherwise None."""
+    if function.func_closure != None:
+        return None
+
+    references = {}
+    for name in codeNames(function.func_code):
+        if name not in function.func_globals:
+            continue
+        reference = globalReference(function.func_globals[name], cheapModules)
+        if reference == None:
+            return None
+        references[name] = reference
+
+    try:
+        return (textwrap.dedent(inspect.getsource(function)), references)
+    except (IOError, TypeError):
+        return None
+
+def extractClass(cls, cheapModules):
+    """Records a model class, flattening the model classes it inherits from onto its npsgd base."""
+    modelClasses = [c for c in cls.__mro__ if c.__module__ not in cheapModules]
+    base         = [c for c in cls.__mro__ if c.__module__ in cheapModules][0]
+    metadata     = ClassMetadata(cls.__name__, base.__module__, base.__name__)
+
+    for modelClass in reversed(modelClasses):
+        for name, value in modelClass.__dict__.iteritems():
+            if name in ["__module__", "__dict__", "__weakref__", "compiledSchema"]:
+                continue
+
+            metadata.attributes.pop(name, None)
+            metadata.portableMethods.pop(name, None)
+            if name in metadata.methods:
+                metadata.methods.remove(name)
+
+            if isinstance(value, types.FunctionType):
+                metadata.methods.append(name)
+                if name in cls.metadataMethods:
+                    source = portableSource(value, cheapModules)
+                    if source != None:
+                        metadata.portableMethods[name] = source
+                continue
+
+            try:
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                metadata.attributes[name] = value
+            except Exception:
+                metadata.methods.append(name)
+
+    return metadata
+
+def extract(files, outputPath):
+    """Imports model files ([(importName, path)], in load order) and pickles their metadata to outputPath.
+
+    This runs in a child process (see extractFiles), so anything the models
+    import dies with it. Files that fail to import map to an error string.
+    """
+    from npsgd.model_task import ModelTask
+    cheapModules = CheapModules()
+    results      = {}
+    for importName, path in files:
+        try:
+            module = imp.load_source(importName, path)
+            results[importName] = [extractClass(obj, cheapModules) for name, obj in inspect.getmembers(module) \
+                    if inspect.isclass(obj) and obj.__module__ == importName and issubclass(obj, ModelTask)]
+        except Exception, e:
+            logging.exception("Unable to extract model metadata from '%s'", path)
+            results[importName] = "%s: %s" % (e.__class__.__name__, e)
+
+    with open(outputPath, "wb") as f:
+        pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+
+def extractFiles(files):
+    """Extracts the metadata of model files in a subprocess, returning {importName: classes or error}."""
+    packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([packageRoot, config.modelDirectory] + \
+            [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]),
+            PYTHONDONTWRITEBYTECODE="1")
+
+    handle, outputPath = tempfile.mkstemp(suffix=".metadata")
+    os.close(handle)
+    try:
+        #Models may print when imported, which is of no use to anyone here
+        with open(os.devnull, "w") as devnull:
+            process = subprocess.Popen([sys.executable, "-m", "npsgd.model_metadata", outputPath] + \
+                    ["%s=%s" % f for f in files], env=environment, stdout=devnull, close_fds=True)
+        if process.wait() != 0:
+            raise ModelMetadataError("Model metadata extraction exited with code %d" % process.returncode)
+
+        with open(outputPath, "rb") as f:
+            return pickle.load(f)
+    finally:
+        os.remove(outputPath)
+
+class MetadataCache(object):
+    """On disk cache of file metadata, one pickle per model file version."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def cachePath(self, importName, version):
+        return os.path.join(self.directory, "%s-%s.metadata" % (importName, version))
+
+    def get(self, importName, version):
+        try:
+            with open(self.cachePath(importName, version), "rb") as f:
+                return pickle.load(f)
+        except IOError:
+            return None
+        except Exception:
+            logging.exception("Unreadable model metadata for '%s' version '%s', extracting it again", importName, version)
+            return None
+
+    def put(self, fileMetadata):
+        path = self.cachePath(fileMetadata.importName, fileMetadata.version)
+        temporaryPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporaryPath, "wb") as f:
+            pickle.dump(fileMetadata, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporaryPath, path)
+
+knownFiles       = {}
+executionModules = {}
+executionLock    = threading.RLock()
+
+def rememberFile(fileMetadata):
+    """Keeps the source of a model file version around, for importing it later or serving it to workers."""
+    with executionLock:
+        knownFiles[(fileMetadata.importName, fileMetadata.version)] = fileMetadata
+
+def fileBundle(importName, version):
+    """Returns a model file version and every model file it imports (at their versions), those first."""
+    bundle = []
+    with executionLock:
+        def visit(key):
+            if key not in knownFiles:
+                raise ModelMetadataError("No source for model file '%s' version '%s'" % key)
+            fileMetadata = knownFiles[key]
+            if fileMetadata in bundle:
+                return
+            for dependency in fileMetadata.dependencies:
+                visit(tuple(dependency))
+            bundle.append(fileMetadata)
+
+        visit((importName, version))
+
+    return bundle
+
+def runModule(fileMetadata, dependencies):
+    """Executes a model file in a fresh module, returning it.
+
+    While it runs, sys.modules maps the import names of the model files it
+    imports to dependencies ({importName: module}), so its imports bind the
+    versions it was loaded with rather than whichever ran last.
+    """
+    importName = fileMetadata.importName
+    module = imp.new_module(importName)
+    module.__file__ = fileMetadata.path
+
+    previous = dict((name, sys.modules.get(name)) for name in [importName] + dependencies.keys())
+    sys.modules.update(dependencies)
+    sys.modules[importName] = module
+    try:
+        exec compile(fileMetadata.source, fileMetadata.path, "exec") in module.__dict__
+    except Exception, e:
+        raise ModelMetadataError("Unable to import model file '%s' version '%s': %s" % \
+                (importName, fileMetadata.version, e))
+    finally:
+        for name, previousModule in previous.iteritems():
+            if previousModule == None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = previousModule
+
+    return module
+
+def executionModule(importName, version, register=True):
+    """Imports the real module of a model file version (and the model files it imports) once.
+
+    Newly imported modules are left in sys.modules under their import names
+    unless register is False (e.g. for old versions, whose names the latest
+    versions hold).
+    """
+    with executionLock:
+        if (importName, version) in executionModules:
+            return executionModules[(importName, version)]
+
+        if (importName, version) not in knownFiles:
+            raise ModelMetadataError("No source for model file '%s' version '%s'" % (importName, version))
+
+        fileMetadata = knownFiles[(importName, version)]
+        dependencies = dict((dependency[0], executionModule(dependency[0], dependency[1], register)) \
+                for dependency in fileMetadata.dependencies)
+
+        logging.info("Importing model code of '%s' version '%s' on first use", importName, version)
+        module = runModule(fileMetadata, dependencies)
+        if register:
+            sys.modules[importName] = module
+
+        executionModules[(importName, version)] = module
+        return module
+
+def executionClass(cls):
+    """Returns the class that can actually run a model, given it or its stand-in."""
+    if not getattr(cls, "metadataOnly", False):
+        return cls
+
+    realClass = getattr(executionModule(cls.fileMetadata.importName, cls.version), cls.__name__)
+    realClass.version = cls.version
+    return realClass
+
+def forgetExecution(importName, version):
+    """Drops the source and module of a model file version, unless another known file imports it."""
+    with executionLock:
+        if any((importName, version) in f.dependencies for f in knownFiles.itervalues()):
+            return
+
+        module = executionModules.pop((importName, version), None)
+        if module != None and sys.modules.get(importName) is module:
+            del sys.modules[importName]
+        knownFiles.pop((importName, version), None)
+
+class DeferredAttribute(object):
+    """Stand-in for a model's method, fetching the real one from the model's module on first use."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        realClass = executionClass(owner)
+        for c in realClass.__mro__:
+            if self.name in c.__dict__:
+                value = c.__dict__[self.name]
+                if hasattr(value, "__get__"):
+                    return value.__get__(instance, owner)
+                return value
+
+        raise AttributeError(self.name)
+
+def portableFunction(name, source, references, importName):
+    namespace = {"__builtins__": __builtins__, "__name__": importName}
+    for globalName, reference in references.iteritems():
+        if reference[0] == "value":
+            namespace[globalName] = reference[1]
+        else:
+            __import__(reference[1])
+            module = sys.modules[reference[1]]
+            namespace[globalName] = module if reference[0] == "module" else getattr(module, reference[2])
+
+    exec compile(source, "<%s.%s>" % (importName, name), "exec") in namespace
+    return namespace[name]
+
+def standInClasses(fileMetadata):
+    """Builds the light classes daemons use in place of the models of a file."""
+    rememberFile(fileMetadata)
+
+    classes = []
+    for classMetadata in fileMetadata.classes:
+        __import__(classMetadata.baseModule)
+        base  = getattr(sys.modules[classMetadata.baseModule], classMetadata.baseName)
+        attrs = dict(classMetadata.attributes, __module__=fileMetadata.importName,
+                metadataOnly=True, fileMetadata=fileMetadata)
+
+        for name in classMetadata.methods:
+            attrs[name] = DeferredAttribute(name)
+
+        for name, (source, references) in classMetadata.portableMethods.iteritems():
+            try:
+                attrs[name] = portableFunction(name, source, references, fileMetadata.importName)
+            except Exception:
+                logging.exception("Unable to rebuild '%s.%s' from source, importing it on first use instead",
+                        classMetadata.className, name)
+
+        classes.append(type(classMetadata.className, (base,), attrs))
+
+    return classes
+
+if __name__ == "__main__":
+    #Metadata must pickle as npsgd.model_metadata rather than __main__
+    from npsgd.model_metadata import extract
+    logging.basicConfig(level=logging.INFO)
+    extract([arg.split("=", 1) for arg in sys.argv[2:]], sys.argv[1])
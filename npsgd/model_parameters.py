@@ -1,8 +1,15 @@
 # Author: Thomas Dimson [tdimson@gmail.com]
 # Date:   January 2011
 # For distribution details, see LICENSE
-"""Module holding all types of model parameters."""
+"""Module holding all types of model parameters.
+
+Parameter objects declare what a model takes. Values are bound to them
+through a ParameterSchema, compiled once per model version, which validates
+a whole set of values in one pass and keeps each value in a BoundParameter
+record that shares everything else with its declaration.
+"""
 import copy
+import types
 import logging
 
 class ValidationError(RuntimeError): pass
@@ -22,6 +29,17 @@ class ModelParameter(object):
     def __init__(self, name):
         self.name = name
 
+    def validate(self, value):
+        """Returns a value as this parameter holds it, raising ValidationError if it isn't acceptable.
+
+        This doesn't touch the parameter, so declarations can validate values
+        for any number of tasks (see ParameterSchema).
+        """
+        return value
+
+    def setValue(self, value):
+        self.value = self.validate(value)
+
     def withValue(self, value):
         """Instantiates a copy of the model parameter with a given value.
         
@@ -108,12 +126,12 @@ class SelectParameter(ModelParameter):
 
         self.setValue(self.default)
 
-    def setValue(self, value):
+    def validate(self, value):
         checkVal = str(value)
         if checkVal not in self.options:
             raise ValidationError("Attempted to set ComboParameter with invalid value '%s'" % value)
 
-        self.value = value
+        return value
 
     def asMatlabCode(self):
         if self.value:
@@ -160,8 +178,8 @@ class BooleanParameter(ModelParameter):
 
         self.setValue(self.default)
 
-    def setValue(self, value):
-        self.value = bool(value)
+    def validate(self, value):
+        return bool(value)
 
     def asMatlabCode(self):
         if self.value:
@@ -210,8 +228,8 @@ class StringParameter(ModelParameter):
         if default != None:
             self.setValue(self.default)
 
-    def setValue(self, value):
-        self.value = str(value)
+    def validate(self, value):
+        return str(value)
 
     def asMatlabCode(self):
         return "%s='%s';" % (self.name, matlabEscape(self.value))
@@ -260,7 +278,7 @@ class RangeParameter(ModelParameter):
         if default != None:
             self.setValue(self.default)
 
-    def setValue(self, value):
+    def validate(self, value):
         if isinstance(value, basestring):
             start, end = [float(e.strip()) for e in value.split("-")]
         else:
@@ -279,7 +297,7 @@ class RangeParameter(ModelParameter):
                     (self.name, end, self.rangeEnd))
 
 
-        self.value = (start, end)
+        return (start, end)
 
     def asMatlabCode(self):
         start, end = self.value
@@ -346,7 +364,7 @@ class FloatParameter(ModelParameter):
         if default != None:
             self.setValue(self.default)
 
-    def setValue(self, inVal):
+    def validate(self, inVal):
         value = float(inVal)
         
         if self.rangeStart != None and value < self.rangeStart:
@@ -357,7 +375,7 @@ class FloatParameter(ModelParameter):
             raise ValidationError("%s value (%s) out of range" % 
                     (self.name, value))
 
-        self.value = value
+        return value
 
     def asMatlabCode(self):
         return "%s=%s;" % (self.name, self.value)
@@ -408,8 +426,109 @@ class IntegerParameter(FloatParameter):
         FloatParameter.__init__(self, *args, **kwargs)
         self.htmlClassBase = "npsgdInteger"
 
-    def setValue(self, value):
-        self.value = int(value)
+    def validate(self, value):
+        return int(value)
+
+class Missing(object):
+    """Placeholder for parameters a set of values leaves out."""
+
+class BoundParameter(object):
+    """A parameter's value for one task, sharing everything else with the parameter's declaration.
+
+    Attributes and methods not held here come from the declaration; methods
+    run with this record as self, so they see its value.
+    """
+
+    __slots__ = ("declaration", "value")
+
+    def __init__(self, declaration, value):
+        self.declaration = declaration
+        self.value       = value
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        attribute = getattr(type(self.declaration), name, None)
+        if isinstance(attribute, types.MethodType):
+            return types.MethodType(attribute.im_func, self)
+
+        return getattr(self.declaration, name)
+
+    def __getstate__(self):
+        return (self.declaration, self.value)
+
+    def __setstate__(self, state):
+        self.declaration, self.value = state
+
+    def withValue(self, value):
+        return BoundParameter(self.declaration, self.declaration.validate(value))
+
+class ParameterSchema(object):
+    """A model's parameter declarations compiled for binding values to them.
+
+    Models compile their parameters once per version (see ModelTask.schema).
+    Values are handled as tuples laid out like the declarations, with Missing
+    for parameters a task left out.
+    """
+
+    def __init__(self, declarations):
+        self.declarations = list(declarations)
+        self.names        = [d.name for d in self.declarations]
+        self.indexes      = dict((name, i) for i, name in enumerate(self.names))
+        self.validators   = [d.validate for d in self.declarations]
+
+    def validate(self, values):
+        """Validates raw values by parameter name in one pass, returning them as a tuple."""
+        result = [Missing] * len(self.names)
+        for name, value in values.iteritems():
+            i = self.indexes.get(name)
+            if i == None:
+                raise ValidationError("Unknown parameter '%s'" % name)
+
+            try:
+                result[i] = self.validators[i](value)
+            except (ValueError, TypeError), e:
+                raise ValidationError("%s value '%s' is invalid (%s)" % (name, value, e))
+
+        return tuple(result)
+
+    def validateDicts(self, parameterDicts):
+        """Like validate, but for values given as parameter dicts (see ModelParameter.asDict)."""
+        values = {}
+        for name, d in parameterDicts.iteritems():
+            if d["name"] != name:
+                raise ValidationError("Trying to instantiate the wrong parameter (called '%s' for '%s')" % (name, d["name"]))
+            values[name] = d["value"]
+
+        return self.validate(values)
+
+    def validateMany(self, valueSets):
+        """Validates many sets of raw values, returning a (values, error) pair for each."""
+        results = []
+        for values in valueSets:
+            try:
+                results.append((self.validate(values), None))
+            except ValidationError, e:
+                results.append((None, e))
+
+        return results
+
+    def bind(self, values):
+        """Returns BoundParameters for the values (a tuple from validate) that aren't Missing."""
+        return [BoundParameter(d, v) for d, v in zip(self.declarations, values) if v is not Missing]
+
+    def valuesOf(self, boundParameters):
+        """Lays the values of BoundParameters out as a tuple again (the reverse of bind)."""
+        result = [Missing] * len(self.names)
+        for param in boundParameters:
+            result[self.indexes[param.name]] = param.value
+
+        return tuple(result)
+
+    def valueDicts(self, values):
+        """Returns parameter dicts (see ModelParameter.asDict) for the values that aren't Missing."""
+        return dict((p.name, p.asDict()) for p in self.bind(values))
 
 
 def replaceAll(replacee, replaceList):
@@ -4,17 +4,27 @@
 """Module containing the main superclass for all models."""
 import os
 import sys
+import time
 import uuid
+import signal
 import random
 import string
 import logging
+import threading
+import contextlib
 import subprocess
+import child_process
+import resource_usage
 from email_manager import Email
+from model_parameters import ParameterSchema
 import shutil
 
 from config import config
 
 class LatexError(RuntimeError): pass
+class TaskTimeoutError(RuntimeError): pass
+class TaskCancelledError(RuntimeError): pass
+class TaskRequeuedError(RuntimeError): pass
 class ModelTask(object):
     """Abstract base class for all user-defined models.
 
@@ -30,26 +40,68 @@ class ModelTask(object):
     subtitle    = "Unspecified Subtitle"
     attachments = []
 
+    #Whether workers may run several queued tasks of this model in one bundle
+    supportsBundling = False
+
+    #Methods the web and queue daemons call without running the task. Written
+    #against parameters and cheap modules only, they work without importing
+    #the model's module (see model_metadata)
+    metadataMethods = ["estimatedCost"]
+
+    #Hard limits on a task's run, None for the config default (see resourceLimit).
+    #The wall clock limit (seconds) covers the whole run, the cpu time (seconds)
+    #and address space (megabytes) limits each model subprocess
+    wallTimeLimit = None
+    cpuTimeLimit  = None
+    memoryLimit   = None
+
+    #How many tasks of this model may run at once across all workers and on
+    #any one host, None for no limit. Enforced by the queue when leasing
+    maxConcurrent        = None
+    maxConcurrentPerHost = None
+
     def __init__(self, emailAddress, taskId, modelParameters={}, failureCount=0, visibleId=None):
         self.emailAddress      = emailAddress
         self.taskId            = taskId
         self.failureCount      = failureCount
         self.modelParameters   = []
         self.visibleId         = visibleId
+        self.processOutput     = None
+        self.progress          = None
+        self.failureOutput     = None
+        self.failureReason     = None
+        self.cancelRequested   = False
+        self.cancelReason      = None
+        self.startTime         = None
+        self.elapsedTime       = 0.0
+        self.clockRate         = 1.0
+        self.watchedProcesses  = []
+        self.watchLock         = threading.Lock()
+        self.usageStage        = "simulation"
+        self.resourceUsage     = {}
+        self.watchSnapshots    = {}
+        self.leaseToken        = None
         if self.visibleId == None:
             self.visibleId = "".join(random.choice(string.letters + string.digits)\
                                     for i in xrange(8))
 
         self.workingDirectory  = "/var/tmp/npsgd/%s" % str(uuid.uuid4())
 
-        for k,v in modelParameters.iteritems():
-            param = self.parameterType(k).fromDict(v)
-            setattr(self, param.name, param)
-            self.modelParameters.append(param)
+        self.bindValues(self.__class__.schema().validateDicts(modelParameters))
+
+    @classmethod
+    def schema(cls):
+        """Returns the model's parameters compiled into a ParameterSchema, once per model class (i.e. version)."""
+        if "compiledSchema" not in cls.__dict__:
+            cls.compiledSchema = ParameterSchema(cls.parameters)
+
+        return cls.compiledSchema
 
-        #Recover ordering
-        parameterIndexes = dict((e.name, i) for (i,e) in enumerate(self.__class__.parameters))
-        self.modelParameters.sort(key=lambda x: parameterIndexes[x.name])
+    def bindValues(self, values):
+        """Sets the task's parameters to values already validated by the model's schema."""
+        self.modelParameters = self.__class__.schema().bind(values)
+        for param in self.modelParameters:
+            setattr(self, param.name, param)
 
     def createWorkingDirectory(self):
         try:
@@ -57,6 +109,266 @@ class ModelTask(object):
         except OSError, e:
             logging.warning(e)
 
+    def taskOutput(self):
+        """Returns the destination for this task's subprocess output, opening it on first use."""
+        if self.processOutput == None:
+            if not os.path.exists(config.taskLogDirectory):
+                os.makedirs(config.taskLogDirectory)
+
+            self.processOutput = child_process.TaskOutput(child_process.taskLogPath(self),
+                    config.outputTailLines, self.outputLine)
+
+        return self.processOutput
+
+    def closeTaskOutput(self):
+        if self.processOutput != None:
+            self.processOutput.close()
+
+    def outputTail(self):
+        """Returns the last few lines of subprocess output (stderr first) for diagnostics."""
+        if self.processOutput == None:
+            return ""
+
+        return self.processOutput.tail("stderr") + self.processOutput.tail("stdout")
+
+    def outputLine(self, stream, line):
+        """Called with every line of subprocess output as it arrives."""
+        progress = self.parseProgress(line)
+        if progress != None:
+            self.reportProgress(*progress)
+
+    def reportProgress(self, fraction=None, stage=None):
+        """Records how far along this task is, to be sent with the next heartbeat.
+
+        Either may be None to leave it unchanged. Models can call this directly
+        or have it fed from their output through parseProgress.
+        """
+        oldFraction, oldStage = self.progress or (None, None)
+        if fraction == None:
+            fraction = oldFraction
+        if stage == None:
+            stage = oldStage
+
+        self.progress = (fraction, stage)
+        logging.debug("Task %s progress: %s", self.taskId, self.progress)
+
+    def parseProgress(self, line):
+        """Returns a (fraction complete, stage) tuple if a line of model output reports progress.
+
+        Models with progress output should override this, the default never
+        finds any.
+        """
+        return None
+
+    @classmethod
+    def resourceLimit(cls, name):
+        """Returns one of the model's limits (e.g. "wallTimeLimit" or "maxConcurrent"), or None.
+
+        A [Model <short_name>] section of the config takes precedence over the
+        model class, which takes precedence over the [Isolation] default.
+        """
+        value = config.modelSetting(cls.short_name, name)
+        if value == None:
+            value = getattr(cls, name)
+        if value == None:
+            value = getattr(config, name, 0)
+
+        value = float(value)
+        if value > 0:
+            return value
+        else:
+            return None
+
+    @classmethod
+    def concurrencyLimits(cls):
+        """Returns (key, cluster-wide limit, per-host limit) tuples capping how many tasks may run at once.
+
+        Running tasks are counted against every key of their model, so keys can
+        be shared by several models (e.g. for license seats). Limits may be None.
+        """
+        return [("model:%s" % cls.short_name,
+                cls.resourceLimit("maxConcurrent"), cls.resourceLimit("maxConcurrentPerHost"))]
+
+    def startClock(self, now=None, rate=1.0):
+        """Starts (or resumes) counting time against this task's wall clock limit.
+
+        A task's clock only runs while the task itself is being worked on, so
+        that tasks of a bundle aren't charged for the time spent on each other.
+        Tasks sharing a process for the whole bundle share its time instead:
+        their clocks run at a rate of 1/len(bundle).
+        """
+        with self.watchLock:
+            if self.startTime == None:
+                self.startTime = now if now != None else time.time()
+                self.clockRate = rate
+
+    def stopClock(self):
+        with self.watchLock:
+            if self.startTime != None:
+                self.elapsedTime += (time.time() - self.startTime) * self.clockRate
+                self.startTime    = None
+
+    def secondsToDeadline(self):
+        """Returns the (wall clock) time left before the wall clock limit, or None if there isn't one (or the clock is stopped)."""
+        limit = self.__class__.resourceLimit("wallTimeLimit")
+        with self.watchLock:
+            if limit == None or self.startTime == None:
+                return None
+
+            charged = self.elapsedTime + (time.time() - self.startTime) * self.clockRate
+            return (limit - charged) / self.clockRate
+
+    def pastDeadline(self):
+        remaining = self.secondsToDeadline()
+        return remaining != None and remaining <= 0
+
+    def recordUsage(self, stage, usage):
+        """Adds a ResourceUsage to this task's total for a stage."""
+        with self.watchLock:
+            self.resourceUsage.setdefault(stage, resource_usage.ResourceUsage()).add(usage)
+
+    @contextlib.contextmanager
+    def accountUsage(self, stage):
+        """Context manager charging work done by the worker (and any children) to a stage."""
+        previousStage = self.usageStage
+        self.usageStage = stage
+        before = resource_usage.selfUsage()
+        try:
+            yield
+        finally:
+            self.recordUsage(stage, resource_usage.selfUsage().since(before))
+            self.usageStage = previousStage
+
+    def usageDict(self):
+        """Returns this task's per-stage resource usage as a dictionary (for sending to the queue)."""
+        with self.watchLock:
+            return dict((stage, usage.asDict()) for stage, usage in self.resourceUsage.iteritems())
+
+    def watchProcess(self, process):
+        """Registers a running child to be killed if this task is cancelled.
+
+        Long-lived children shared between tasks are also sampled here so that
+        the task can be charged for its share of their usage.
+        """
+        with self.watchLock:
+            self.watchedProcesses.append(process)
+            self.watchSnapshots[process] = resource_usage.processUsage(process.pid)
+            cancelled = self.cancelReason != None
+
+        if cancelled:
+            child_process.killProcessGroup(process)
+
+    def unwatchProcess(self, process):
+        with self.watchLock:
+            if process in self.watchedProcesses:
+                self.watchedProcesses.remove(process)
+            before = self.watchSnapshots.pop(process, None)
+
+        #Children we reaped ourselves were accounted exactly with wait4
+        if before != None and process.returncode == None:
+            after = resource_usage.processUsage(process.pid)
+            if after != None:
+                self.recordUsage(self.usageStage, after.since(before))
+
+    def cancel(self, reason):
+        """Aborts this task, killing any running children (thread safe).
+
+        The reason is "timeout", "cancelled" or "requeue" (for tasks that were
+        only aborted because they shared a process with one of the others);
+        the task's run raises the matching error as soon as the children are
+        gone.
+        """
+        with self.watchLock:
+            if self.cancelReason != None:
+                return
+
+            self.cancelReason = reason
+            processes = list(self.watchedProcesses)
+
+        logging.warning("Aborting task %s (%s), killing %d processes", self.taskId, reason, len(processes))
+        for process in processes:
+            child_process.killProcessGroup(process)
+
+    def cancellationError(self):
+        if self.cancelReason == "timeout":
+            return TaskTimeoutError("Task %s exceeded its time limit" % self.taskId)
+        elif self.cancelReason == "requeue":
+            return TaskRequeuedError("Task %s was aborted along with its bundle" % self.taskId)
+        else:
+            return TaskCancelledError("Task %s was cancelled" % self.taskId)
+
+    def checkCancelled(self):
+        """Raises a TaskTimeoutError, TaskCancelledError or TaskRequeuedError if this task has been aborted."""
+        if self.cancelReason != None:
+            raise self.cancellationError()
+
+    def isolation(self, limitResources):
+        """Returns keyword arguments for child_process.spawn isolating a subprocess of this task.
+
+        Model subprocesses (limitResources) are pinned to the worker slot's cores
+        and held to the model's limits, post-processing subprocesses are
+        simply run at a lower priority.
+        """
+        if limitResources:
+            return {
+                "cpuTimeLimit": self.__class__.resourceLimit("cpuTimeLimit"),
+                "memoryLimit":  self.__class__.resourceLimit("memoryLimit"),
+                "cpus":         child_process.slotCpus,
+                "niceness":     config.modelNice
+            }
+        elif self.usageStage != "simulation":
+            return {"niceness": config.postProcessingNice}
+        else:
+            return {}
+
+    def runProcess(self, args, input=None, limitResources=False, **kwargs):
+        """Runs a subprocess, streaming its output to the task log, and returns its exit code.
+
+        The child is killed if the task is cancelled, and isolated as described
+        in the isolation method. Afterwards self.stdout and self.stderr hold
+        the last few lines of each stream.
+        """
+        self.checkCancelled()
+        output = self.taskOutput()
+        if input != None:
+            kwargs["stdin"] = subprocess.PIPE
+
+        isolation = self.isolation(limitResources)
+        cpuTimeLimit = isolation.get("cpuTimeLimit")
+        kwargs.update(isolation)
+        process = child_process.spawn(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        self.watchProcess(process)
+        try:
+            readers = [output.follow("stdout", process.stdout), output.follow("stderr", process.stderr)]
+            if input != None:
+                try:
+                    process.stdin.write(input)
+                except IOError, e:
+                    logging.warning("Subprocess stopped reading its input: %s", e)
+                process.stdin.close()
+
+            for reader in readers:
+                reader.join()
+
+            self.recordUsage(self.usageStage, resource_usage.waitForChild(process))
+            returnCode = process.returncode
+        finally:
+            self.unwatchProcess(process)
+
+        self.stdout = output.tail("stdout")
+        self.stderr = output.tail("stderr")
+        if cpuTimeLimit != None and returnCode in [-signal.SIGXCPU, -signal.SIGKILL]:
+            logging.warning("Task %s exceeded its cpu time limit of %ss", self.taskId, cpuTimeLimit)
+            self.cancel("timeout")
+
+        self.checkCancelled()
+        return returnCode
+
+    @classmethod
+    def parameterSignature(cls):
+        """Names and types of the model's parameters; versions with equal signatures can take each other's tasks."""
+        return frozenset((p.name, p.__class__) for p in cls.parameters)
+
     def parameterType(self, parameterName):
         """Returns an empty version the parameter class for a given parameter name."""
 
@@ -144,7 +456,7 @@ class ModelTask(object):
         logging.info("Will run PDFLatex %d times", config.latexNumRuns)
         for i in xrange(config.latexNumRuns):
             logging.info("Calling PDFLatex (run %d) to generate pdf output", i+1)
-            retCode = subprocess.call([config.pdfLatexPath, "-halt-on-error", texPath], cwd=self.workingDirectory)
+            retCode = self.runProcess([config.pdfLatexPath, "-halt-on-error", texPath], cwd=self.workingDirectory)
             logging.info("PDFLatex terminated with error code %d", retCode)
 
             if retCode != 0:
@@ -169,20 +481,105 @@ class ModelTask(object):
                 config.resultsEmailBodyTemplate.generate(task=self),
                 attachments)
 
+    def estimatedCost(self):
+        """Returns a rough, unitless estimate of the cost of running this task.
+
+        The queue adds these up when bundling small tasks together, so only
+        their relative size matters.
+        """
+        return 1.0
+
     def runModel(self):
         """Performs model-specific steps for execution."""
         logging.warning("Called default run model - this should be overridden")
 
+    @classmethod
+    def runModelBundle(cls, tasks):
+        """Performs model-specific execution for a bundle of tasks.
+
+        Returns a list with an exception (or None on success) for each task. The
+        default runs each task's model in turn, models supporting bundling
+        override this to process the whole bundle in a single invocation.
+        Overrides start and stop each task's clock (see startClock) around the
+        work done for it.
+        """
+        errors = []
+        for task in tasks:
+            task.startClock()
+            try:
+                task.runModel()
+                errors.append(None)
+            except RuntimeError, e:
+                logging.exception(e)
+                errors.append(e)
+            finally:
+                task.stopClock()
+
+        return errors
+
+    @classmethod
+    def runBundle(cls, tasks):
+        """Runs a bundle of tasks, returning a list of (task, results email or exception) pairs.
+
+        Execution happens once for the whole bundle, then graphs, attachments
+        and results emails are produced for every task that succeeded.
+        """
+
+        logging.info("Running bundle of %d '%s' tasks", len(tasks), cls.short_name)
+        for task in tasks:
+            task.createWorkingDirectory()
+
+        try:
+            before = resource_usage.selfUsage()
+            for task in tasks:
+                task.reportProgress(stage="execution")
+                task.prepareExecution()
+
+            errors = cls.runModelBundle(tasks)
+            inProcessUsage = resource_usage.selfUsage().since(before).scaled(1.0 / len(tasks))
+
+            results = []
+            for task, error in zip(tasks, errors):
+                task.recordUsage("simulation", inProcessUsage)
+                #Killing a task's children tends to surface as some other failure
+                if task.cancelReason != None:
+                    error = task.cancellationError()
+
+                if error != None:
+                    results.append((task, error))
+                    continue
+
+                task.startClock()
+                try:
+                    task.reportProgress(stage="graphs")
+                    with task.accountUsage("graphs"):
+                        task.prepareGraphs()
+
+                    task.reportProgress(stage="report")
+                    with task.accountUsage("pdf"):
+                        resultsEmail = task.resultsEmail(task.getAttachments())
+                    results.append((task, resultsEmail))
+                except Exception, e:
+                    logging.exception(e)
+                    if task.cancelReason != None:
+                        e = task.cancellationError()
+                    results.append((task, e))
+                finally:
+                    task.stopClock()
+
+            return results
+        finally:
+            for task in tasks:
+                task.closeTaskOutput()
+                if os.path.exists(task.workingDirectory):
+                    shutil.rmtree(task.workingDirectory)
+
     def run(self):
         """Runs the model with parameters, and returns results email object."""
 
         logging.info("Running default task for '%s'", self.emailAddress)
-        self.createWorkingDirectory()
-        try:
-            self.prepareExecution()
-            self.runModel()
-            self.prepareGraphs()
-            return self.resultsEmail(self.getAttachments())
-        finally:
-            if os.path.exists(self.workingDirectory):
-                shutil.rmtree(self.workingDirectory)
+        [(task, result)] = self.__class__.runBundle([self])
+        if isinstance(result, Exception):
+            raise result
+
+        return result
@@ -0,0 +1,208 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module for accounting the resources used by model tasks.
+
+Workers record cpu time, peak memory and i/o for each stage of a task's run
+(simulation, graphs, pdf and email) and report them to the queue when they
+commit the task. Results are only emailed once the task is committed, so the
+email stage is reported with the worker's next commit. The queue keeps running totals per model version, which tell us how
+many slots a host can take and which models are memory hungry. They also
+keep the wall time tasks took, from which the queue predicts how long a task
+should run (see UsageLedger.expectedRunTime).
+
+Children started for a single task are reaped with wait4 to get their exact
+usage. Long-lived children (matlab engines, standalone servers) are sampled
+through /proc before and after each task, and work done inside the worker
+itself is measured with getrusage.
+"""
+import os
+import errno
+import logging
+import resource
+import threading
+
+stages = ["simulation", "graphs", "pdf", "email"]
+
+class ResourceUsage(object):
+    """Cpu time (seconds), peak resident memory (kilobytes) and bytes read/written by some work."""
+
+    def __init__(self, userTime=0.0, systemTime=0.0, maxRss=0, readBytes=0, writeBytes=0):
+        self.userTime   = userTime
+        self.systemTime = systemTime
+        self.maxRss     = maxRss
+        self.readBytes  = readBytes
+        self.writeBytes = writeBytes
+
+    @classmethod
+    def fromRusage(cls, rusage):
+        #Block counts are in 512 byte units, maxrss is already in kilobytes on linux
+        return cls(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+
+    def add(self, other):
+        """Accumulates other into this usage. Peak memory is the larger of the two."""
+        self.userTime   += other.userTime
+        self.systemTime += other.systemTime
+        self.maxRss      = max(self.maxRss, other.maxRss)
+        self.readBytes  += other.readBytes
+        self.writeBytes += other.writeBytes
+
+    def since(self, earlier):
+        """Returns the usage between an earlier snapshot and this one.
+
+        Peak memory can't be taken apart this way, so it only counts if the
+        peak rose in between (otherwise it belongs to earlier work).
+        """
+        maxRss = self.maxRss if self.maxRss > earlier.maxRss else 0
+        return ResourceUsage(self.userTime - earlier.userTime, self.systemTime - earlier.systemTime,
+                maxRss, self.readBytes - earlier.readBytes, self.writeBytes - earlier.writeBytes)
+
+    def scaled(self, factor):
+        """Returns this usage with cpu and i/o multiplied by factor (for splitting between tasks)."""
+        return ResourceUsage(self.userTime * factor, self.systemTime * factor,
+                self.maxRss, int(self.readBytes * factor), int(self.writeBytes * factor))
+
+    def asDict(self):
+        return {
+            "userTime":   self.userTime,
+            "systemTime": self.systemTime,
+            "maxRss":     self.maxRss,
+            "readBytes":  self.readBytes,
+            "writeBytes": self.writeBytes
+        }
+
+    @classmethod
+    def fromDict(cls, dictionary):
+        return cls(float(dictionary["userTime"]), float(dictionary["systemTime"]),
+                int(dictionary["maxRss"]), int(dictionary["readBytes"]), int(dictionary["writeBytes"]))
+
+def selfUsage():
+    """Returns the usage of the current process so far (excluding children)."""
+    return ResourceUsage.fromRusage(resource.getrusage(resource.RUSAGE_SELF))
+
+def waitForChild(process):
+    """Reaps a subprocess.Popen child with wait4, returning its ResourceUsage.
+
+    Sets process.returncode just as Popen.wait would.
+    """
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    return ResourceUsage.fromRusage(rusage)
+
+clockTicks = os.sysconf("SC_CLK_TCK")
+def processUsage(pid):
+    """Returns the usage of a live process so far from /proc, or None if it can't be read."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            #Fields after the parenthesised command name, utime and stime are the 12th and 13th
+            fields = f.read().rsplit(")", 1)[1].split()
+        usage = ResourceUsage(float(fields[11]) / clockTicks, float(fields[12]) / clockTicks)
+
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    usage.maxRss = int(line.split()[1])
+
+        with open("/proc/%d/io" % pid) as f:
+            for line in f:
+                key, value = line.split(":")
+                if key == "read_bytes":
+                    usage.readBytes = int(value)
+                elif key == "write_bytes":
+                    usage.writeBytes = int(value)
+    except (IOError, OSError, IndexError, ValueError), e:
+        logging.debug("Unable to read usage of process %d: %s", pid, e)
+        return None
+
+    return usage
+
+class UsageLedger(object):
+    """Running resource totals of completed tasks per model and version (thread safe)."""
+
+    def __init__(self):
+        self.entries = {}
+        self.lock    = threading.Lock()
+
+    def newEntry(self):
+        return {"runs": 0, "stages": {}, "timedRuns": 0, "wallTime": 0.0, "cost": 0.0}
+
+    def record(self, modelName, modelVersion, stageUsages, wallTime=None, cost=None):
+        """Adds the per-stage usage (a stage -> ResourceUsage dictionary) of one completed task.
+
+        wallTime is how long the task was leased for and cost its estimatedCost().
+        """
+        with self.lock:
+            entry = self.entries.setdefault((modelName, modelVersion), self.newEntry())
+            entry["runs"] += 1
+            for stage, usage in stageUsages.iteritems():
+                entry["stages"].setdefault(stage, ResourceUsage()).add(usage)
+
+            if wallTime != None and cost != None:
+                entry["timedRuns"] += 1
+                entry["wallTime"]  += wallTime
+                entry["cost"]      += cost
+
+    def recordStages(self, modelName, modelVersion, stageUsages):
+        """Adds per-stage usage of a task recorded before, without counting another run."""
+        with self.lock:
+            entry = self.entries.setdefault((modelName, modelVersion), self.newEntry())
+            for stage, usage in stageUsages.iteritems():
+                entry["stages"].setdefault(stage, ResourceUsage()).add(usage)
+
+    def expectedRunTime(self, modelName, modelVersion, cost, minRuns):
+        """Predicts the wall time of a task from the time per unit of cost of earlier runs.
+
+        Returns None if fewer than minRuns runs of the model version were timed.
+        """
+        with self.lock:
+            entry = self.entries.get((modelName, modelVersion))
+            if entry == None or entry["timedRuns"] < max(1, minRuns) or entry["cost"] <= 0:
+                return None
+
+            return entry["wallTime"] / entry["cost"] * cost
+
+    def asDict(self):
+        """Returns a model name -> version -> totals dictionary, with per-run means."""
+        with self.lock:
+            models = {}
+            for (modelName, modelVersion), entry in self.entries.iteritems():
+                runs = entry["runs"]
+                models.setdefault(modelName, {})[modelVersion] = {
+                    "runs":      runs,
+                    "stages":    dict((stage, usage.asDict()) for stage, usage in entry["stages"].iteritems()),
+                    "mean":      dict((stage, usage.scaled(1.0 / runs).asDict())
+                                    for stage, usage in entry["stages"].iteritems()),
+                    "timedRuns": entry["timedRuns"],
+                    "wallTime":  entry["wallTime"],
+                    "cost":      entry["cost"]
+                }
+
+            return models
+
+    @classmethod
+    def fromDict(cls, dictionary):
+        ledger = cls()
+        for modelName, versions in dictionary.iteritems():
+            for modelVersion, entry in versions.iteritems():
+                ledger.entries[(modelName, modelVersion)] = {
+                    "runs":      entry["runs"],
+                    "stages":    dict((stage, ResourceUsage.fromDict(usage))
+                                    for stage, usage in entry["stages"].iteritems()),
+                    "timedRuns": entry.get("timedRuns", 0),
+                    "wallTime":  entry.get("wallTime", 0.0),
+                    "cost":      entry.get("cost", 0.0)
+                }
+
+        return ledger
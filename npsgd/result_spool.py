@@ -0,0 +1,209 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module used within workers for holding on to finished results while the queue is down.
+
+Workers commit a finished task with the queue before sending its results
+email. If the queue can't be reached at that point, the results (the email
+with its attachments, the lease token and the task's resource usage) are
+written to a spool directory instead of being thrown away. A background thread
+keeps retrying the commit, backing off exponentially, and delivers the
+results as soon as the queue takes them. The spool lives on disk, so results
+also survive a worker restart.
+
+Results emails that can't be sent after a commit are spooled the same way,
+marked as committed, so that they survive the worker draining or
+restarting. The thread retries sending those until it succeeds.
+
+Only failures to reach the queue are retried. They are retried for as long
+as the queue stays unreachable: only the queue knows whether our lease is
+still good (a restarted queue keeps restored leases for leaseRestoreGrace
+from its own start, and takes the latest token of a requeued task until it
+is leased again). Results the queue answers badly for are given up on, as
+are those still spooled after resultSpoolMaxAge hours (be they waiting for
+their commit or for their email to be sent).
+"""
+import os
+import glob
+import time
+import pickle
+import logging
+import threading
+from config import config
+
+class QueueUnreachableError(RuntimeError): pass
+
+class SpooledResult(object):
+    """The results of a finished task, waiting to be committed with the queue."""
+
+    #Results spooled by older workers don't name their model and are never committed
+    modelName    = None
+    modelVersion = None
+    committed    = False
+
+    def __init__(self, taskId, leaseToken, usage, email, modelName=None, modelVersion=None):
+        self.taskId       = taskId
+        self.leaseToken   = leaseToken
+        self.usage        = usage
+        self.email        = email
+        self.modelName    = modelName
+        self.modelVersion = modelVersion
+        self.spooledTime  = time.time()
+        self.attempts     = 0
+        self.nextAttempt  = self.spooledTime
+
+    def fileName(self):
+        return "%s_%s.result" % (self.taskId, self.leaseToken)
+
+    def backoff(self):
+        """Notes a failed commit attempt, scheduling the next one."""
+        self.attempts   += 1
+        delay            = min(config.resultSpoolMaxBackoff, 5 * 2 ** (self.attempts - 1))
+        self.nextAttempt = time.time() + delay
+        return delay
+
+class ResultSpool(object):
+    """Directory of spooled results, one pickle per task (thread safe)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock      = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def put(self, result):
+        """Writes a result to the spool, replacing the file atomically so a crash can't leave half of it."""
+        path = os.path.join(self.directory, result.fileName())
+        with self.lock:
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + ".tmp", path)
+
+        logging.info("Spooled results of task '%s' to %s", result.taskId, path)
+
+    def remove(self, result):
+        with self.lock:
+            try:
+                os.remove(os.path.join(self.directory, result.fileName()))
+            except OSError, e:
+                logging.warning("Unable to remove spooled result: %s", e)
+
+    def results(self):
+        """Returns every result in the spool, setting aside files that can't be read."""
+        results = []
+        with self.lock:
+            for path in sorted(glob.glob(os.path.join(self.directory, "*.result"))):
+                try:
+                    with open(path, "rb") as f:
+                        results.append(pickle.load(f))
+                except Exception:
+                    logging.exception("Unreadable spooled result %s, setting it aside", path)
+                    os.rename(path, path + ".bad")
+
+        return results
+
+class ResultSpoolThread(threading.Thread):
+    """Thread retrying the commit of spooled results until the queue answers.
+
+    commit(result) returns whether this worker won the task, raising
+    QueueUnreachableError if the queue can't be reached and RuntimeError if
+    it answers badly. Won results are handed to deliver(result), lost ones
+    are discarded and those given up on before their commit are handed to
+    abandon(result). If deliver raises, the result is kept (as committed)
+    and delivery is retried.
+    """
+
+    def __init__(self, spool, commit, deliver, abandon):
+        threading.Thread.__init__(self)
+        self.daemon  = True
+        self.spool   = spool
+        self.commit  = commit
+        self.deliver = deliver
+        self.abandon = abandon
+        self.maxAge  = config.resultSpoolMaxAge * 3600
+        self.wakeup  = threading.Event()
+
+    def run(self):
+        pending = self.spool.results()
+        if len(pending) > 0:
+            logging.info("Found %d spooled results from before we started", len(pending))
+
+        while True:
+            now = time.time()
+            for result in pending:
+                if result.nextAttempt <= now:
+                    self.retry(result)
+
+            pending = [result for result in pending if result.attempts >= 0]
+            self.wakeup.wait(min([r.nextAttempt - now for r in pending] + [config.resultSpoolMaxBackoff]))
+            if self.wakeup.isSet():
+                self.wakeup.clear()
+                known   = set(r.fileName() for r in pending)
+                pending = pending + [r for r in self.spool.results() if r.fileName() not in known]
+
+    def tooOld(self, result):
+        return self.maxAge > 0 and time.time() - result.spooledTime >= self.maxAge
+
+    def retry(self, result):
+        if result.committed:
+            self.retryDelivery(result)
+            return
+
+        try:
+            committed = self.commit(result)
+        except QueueUnreachableError, e:
+            if not self.tooOld(result):
+                delay = result.backoff()
+                logging.warning("Still unable to commit spooled task '%s' (attempt %d), retrying in %ds",
+                        result.taskId, result.attempts, delay)
+                return
+
+            logging.error("Giving up on spooled task '%s', the queue has been unreachable for %ds",
+                    result.taskId, time.time() - result.spooledTime)
+            self.giveUp(result)
+            return
+        except RuntimeError, e:
+            logging.error("Giving up on spooled task '%s', the queue refused its commit: %s", result.taskId, e)
+            self.giveUp(result)
+            return
+
+        if committed:
+            logging.info("Committed spooled task '%s' after %ds, delivering results",
+                    result.taskId, time.time() - result.spooledTime)
+            result.committed = True
+            self.retryDelivery(result)
+        else:
+            logging.warning("Discarding spooled results of task '%s', our lease is no longer current", result.taskId)
+            self.forget(result)
+
+    def retryDelivery(self, result):
+        try:
+            self.deliver(result)
+        except Exception:
+            if self.tooOld(result):
+                logging.exception("Giving up on sending the results of task '%s' after %ds", result.taskId,
+                        time.time() - result.spooledTime)
+                self.forget(result)
+                return
+
+            delay = result.backoff()
+            logging.exception("Unable to send the results of task '%s' (attempt %d), retrying in %ds",
+                    result.taskId, result.attempts, delay)
+            self.spool.put(result)
+            return
+
+        self.forget(result)
+
+    def giveUp(self, result):
+        self.abandon(result)
+        self.forget(result)
+
+    def forget(self, result):
+        self.spool.remove(result)
+        result.attempts = -1
+
+    def notify(self):
+        """Tells the thread a new result was spooled."""
+        self.wakeup.set()
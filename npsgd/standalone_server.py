@@ -0,0 +1,140 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module containing long-lived 'server' children for standalone models.
+
+Some standalone executables spend a long time loading data before they start
+sampling. Those that support it can instead be started once in a serve mode,
+after which the worker sends them tasks over stdin as line-delimited JSON:
+
+    {"args": ["-n", "1000", ...], "cwd": "/var/tmp/npsgd/..."}
+
+The executable answers on stdout with zero or more output messages followed
+by a single status message, each on its own line:
+
+    {"stdout": "...", "stderr": "..."}
+    {"status": 0}
+
+Anything the server writes to its own stderr goes to the worker's stderr.
+Executables that support bundling read the same task lines from a manifest
+file instead and print one status message per task, in order.
+"""
+import json
+import time
+import atexit
+import logging
+import threading
+import subprocess
+import child_process
+from config import config
+
+class StandaloneServerError(RuntimeError): pass
+class StandaloneServer(object):
+    """A single long-lived standalone executable speaking the serve protocol (thread safe).
+
+    The child is (re)spawned on demand, so a crash only costs the task that
+    was running at the time.
+    """
+
+    def __init__(self, command):
+        self.command     = command
+        self.process     = None
+        self.lock        = threading.RLock()
+        self.stopTimeout = 10
+
+    def isAlive(self):
+        return self.process != None and self.process.poll() == None
+
+    def start(self):
+        logging.info("Starting standalone server '%s'", " ".join(self.command))
+        self.process = child_process.spawn(self.command, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, cpus=child_process.slotCpus, niceness=config.modelNice)
+
+    def stop(self):
+        """Closes the server's stdin (its signal to exit), killing it if it lingers."""
+        with self.lock:
+            if self.process == None:
+                return
+
+            process = self.process
+            self.process = None
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+            deadline = time.time() + self.stopTimeout
+            while process.poll() == None and time.time() < deadline:
+                time.sleep(0.1)
+
+            if process.poll() == None:
+                logging.warning("Standalone server %d did not exit, killing it", process.pid)
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+                process.wait()
+
+    def run(self, args, cwd, outputCallback, watcher=None):
+        """Sends a task to the server and returns its exit status.
+
+        Output is passed to outputCallback(stream, text) as it arrives. If a
+        watcher is given it is told about the server process while the task
+        runs (see ModelTask.watchProcess).
+        """
+        with self.lock:
+            if not self.isAlive():
+                if self.process != None:
+                    logging.warning("Standalone server exited with code %s, respawning", self.process.returncode)
+                self.start()
+
+            process = self.process
+            if watcher != None:
+                watcher.watchProcess(process)
+            try:
+                process.stdin.write("%s\n" % json.dumps({"args": args, "cwd": cwd}))
+                process.stdin.flush()
+                return readResult(process.stdout.readline, outputCallback)
+            except (IOError, OSError, ValueError, StandaloneServerError), e:
+                self.stop()
+                raise StandaloneServerError("Standalone server '%s' failed: %s" % (self.command[0], e))
+            finally:
+                if watcher != None:
+                    watcher.unwatchProcess(process)
+
+def readResult(readline, outputCallback):
+    """Reads protocol messages up to and including a status message, returning the status.
+
+    Lines are read with the given readline function, which returns an empty
+    string at end of file. Output is passed to outputCallback(stream, text).
+    """
+    while True:
+        line = readline()
+        if line == "":
+            raise StandaloneServerError("Server exited unexpectedly")
+
+        message = json.loads(line)
+        for stream in ["stdout", "stderr"]:
+            if message.get(stream):
+                outputCallback(stream, message[stream])
+
+        if "status" in message:
+            return message["status"]
+
+servers     = {}
+serversLock = threading.Lock()
+def getServer(command):
+    """Returns the worker's server for a given launch command, creating it on first use."""
+    key = tuple(command)
+    with serversLock:
+        if key not in servers:
+            servers[key] = StandaloneServer(command)
+
+        return servers[key]
+
+def stopServers():
+    with serversLock:
+        for server in servers.itervalues():
+            server.stop()
+
+atexit.register(stopServers)
@@ -3,8 +3,13 @@
 # For distribution details, see LICENSE
 """Module containing abstract base class for standalone models."""
 import os
+import json
+import time
 import logging
 import subprocess
+import child_process
+import resource_usage
+import standalone_server
 from model_task import ModelTask
 from config import config
 
@@ -15,10 +20,17 @@ class StandaloneTask(ModelTask):
     This class is meant to be the superclass of the user's various
     standalone models. These will generally compiled models, but can include
     anything that needs to be launched in a subprocess
+
+    Executables that implement the protocol in the standalone_server module
+    can set serverMode to be started once per worker and then fed tasks,
+    rather than being launched afresh for every task. Executables that can
+    process a manifest of several tasks in one invocation can set
+    supportsBundling (see bundleParameters).
     """
 
     abstractModel = "StandaloneTask"
     executable    = "ls"
+    serverMode    = False
 
     def executableParameters(self):
         """Returns parameters to the underlying executable as a Python list."""
@@ -28,24 +40,128 @@ class StandaloneTask(ModelTask):
                 "*"
         ]
 
+    def serverParameters(self):
+        """Returns parameters for launching 'executable' as a long-lived server.
+
+        Tasks whose server parameters differ are sent to different servers.
+        """
+
+        return ["--serve"]
+
+    def bundleParameters(self, manifestPath):
+        """Returns parameters for running a whole bundle of tasks in one invocation.
+
+        The manifest has a line per task in the standalone_server protocol
+        format, and the executable must answer with a status message per task.
+        """
+
+        return ["--bundle", manifestPath]
+
     def runModel(self):
         """Spawns a python subprocess of 'executable' class variable and executes.
 
-        This method is meant to run standalone binaries of models. It stores the
-        stdout/stderr in class variables called self.stdout and self.stderr.
+        This method is meant to run standalone binaries of models. Output is
+        streamed to the task log, and the last few lines of stdout/stderr are
+        kept in class variables called self.stdout and self.stderr.
         """
 
         exe = self.__class__.executable
+        output = self.taskOutput()
 
-        logging.info("Launching subprocess '%s %s'", exe, " ".join(self.executableParameters()))
-        mProcess = subprocess.Popen([exe] + self.executableParameters(),
-                cwd=self.workingDirectory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self.stdout, self.stderr = mProcess.communicate()
-        logging.info("Stdout was: --------\n%s\n-----",  self.stdout)
-        logging.info("Stderr was: --------\n%s\n-----",  self.stderr)
+        if self.__class__.serverMode:
+            command = [exe] + self.serverParameters()
+            logging.info("Sending '%s' to server '%s'", " ".join(self.executableParameters()), " ".join(command))
+            server = standalone_server.getServer(command)
+            try:
+                returnCode = server.run(self.executableParameters(), self.workingDirectory, output.line, watcher=self)
+            except standalone_server.StandaloneServerError:
+                self.checkCancelled()
+                raise
+            self.stdout = output.tail("stdout")
+            self.stderr = output.tail("stderr")
+        else:
+            logging.info("Launching subprocess '%s %s'", exe, " ".join(self.executableParameters()))
+            returnCode = self.runProcess([exe] + self.executableParameters(),
+                    limitResources=True, cwd=self.workingDirectory)
 
-        if mProcess.returncode != 0:
-            raise ExecutableError("Bad return code '%s' from '%s'" % (mProcess.returnCode, exe))
+        logging.info("Subprocess output was written to '%s'", output.path)
+        if returnCode != 0:
+            logging.warning("Subprocess failed, last output was: --------\n%s\n-----", self.outputTail())
+            raise StandaloneError("Bad return code '%s' from '%s'" % (returnCode, exe))
 
         logging.info("Subprocess all done")
 
+    @classmethod
+    def runModelBundle(cls, tasks):
+        """Runs a bundle of tasks in a single invocation of 'executable'.
+
+        Servers are already warm, so in server mode (or for models that don't
+        support bundling) the tasks are simply run one after another.
+        """
+
+        if cls.serverMode or not cls.supportsBundling or len(tasks) == 1:
+            return super(StandaloneTask, cls).runModelBundle(tasks)
+
+        exe = cls.executable
+        manifestPath = os.path.join(tasks[0].workingDirectory, "bundle_manifest.json")
+        with open(manifestPath, 'w') as f:
+            for task in tasks:
+                f.write("%s\n" % json.dumps({"args": task.executableParameters(), "cwd": task.workingDirectory}))
+
+        bundleArgs = [exe] + tasks[0].bundleParameters(manifestPath)
+        logging.info("Launching bundle subprocess '%s' for %d tasks", " ".join(bundleArgs), len(tasks))
+        isolation = tasks[0].isolation(True)
+        if isolation["cpuTimeLimit"] != None:
+            isolation["cpuTimeLimit"] *= len(tasks)
+        mProcess = child_process.spawn(bundleArgs, cwd=tasks[0].workingDirectory,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, **isolation)
+        #The bundle shares one deadline, len(tasks) times a single task's
+        startTime = time.time()
+        for task in tasks:
+            task.startClock(startTime, 1.0 / len(tasks))
+            task.watchProcess(mProcess)
+
+        #The bundle's own stderr isn't attributable to any one task, so every task log gets it
+        def bundleStderr(line):
+            for task in tasks:
+                task.taskOutput().line("stderr", line)
+        stderrReader = child_process.followPipe(mProcess.stderr, bundleStderr)
+
+        errors = []
+        try:
+            for task in tasks:
+                output = task.taskOutput()
+                returnCode = standalone_server.readResult(mProcess.stdout.readline, output.line)
+                task.stdout = output.tail("stdout")
+                task.stderr = output.tail("stderr")
+                if returnCode != 0:
+                    logging.warning("Task %s failed in bundle, output is in '%s'", task.taskId, output.path)
+                    errors.append(StandaloneError("Bad return code '%s' from '%s'" % (returnCode, exe)))
+                else:
+                    errors.append(None)
+        except standalone_server.StandaloneServerError:
+            #Killing the bundle cuts its output short, which is dealt with below
+            if not any(task.cancelReason != None for task in tasks):
+                raise
+        finally:
+            mProcess.stdout.close()
+            stderrReader.join()
+            bundleUsage = resource_usage.waitForChild(mProcess).scaled(1.0 / len(tasks))
+            bundleCode = mProcess.returncode
+            #Aborting one task kills the bundle, the others are requeued (unless they timed out too)
+            aborted = any(task.cancelReason != None for task in tasks)
+            for task in tasks:
+                task.unwatchProcess(mProcess)
+                if aborted:
+                    task.cancel("timeout" if task.pastDeadline() else "requeue")
+                task.stopClock()
+                task.recordUsage("simulation", bundleUsage)
+
+        if aborted:
+            return [task.cancellationError() for task in tasks]
+
+        if bundleCode != 0:
+            raise StandaloneError("Bad return code '%s' from bundle run of '%s'" % (bundleCode, exe))
+
+        logging.info("Bundle subprocess all done")
+        return errors
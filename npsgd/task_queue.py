@@ -7,9 +7,98 @@ import sys
 import time
 import logging
 import threading
+import collections
 
 class TaskQueueException(RuntimeError): pass
 
+class TaskLease(object):
+    """A task handed out to a worker, with the time we last heard about it.
+
+    Workers piggyback progress (fraction complete and current stage) on their
+    heartbeats. progressTime records when that progress last changed so that
+    hung tasks can be told apart from slow ones.
+
+    A task that runs for much longer than expected is flagged as a straggler
+    and may be leased a second time (speculatively) to another worker. The
+    two leases then race: the first worker to claim the task before sending
+    its results wins, and the other lease is marked lost.
+
+    Every lease carries a fencing token, larger than that of any earlier
+    lease. Workers present it with heartbeats and results, so a worker whose
+    lease expired can't touch or complete the task once it's leased again.
+    The task remembers the latest token it was leased with (as leaseToken).
+    """
+
+    def __init__(self, task, touchTime, host=None, workerId=None, speculative=False, token=None):
+        self.task         = task
+        self.token        = token
+        self.host         = host
+        self.workerId     = workerId
+        self.leaseTime    = touchTime
+        self.touchTime    = touchTime
+        self.progress     = None
+        self.stage        = None
+        self.progressTime = None
+        self.speculative  = speculative
+        self.straggler    = False
+        self.lost         = False
+        if token != None:
+            task.leaseToken = max(token, getattr(task, "leaseToken", None))
+
+    def matches(self, taskId, workerId=None, token=None):
+        """True if this is a lease of the task id with the token (or held by workerId, if given)."""
+        if self.task.taskId != taskId:
+            return False
+
+        if token != None:
+            return self.token == token
+
+        return workerId == None or self.workerId == workerId
+
+    def asDict(self):
+        return {
+            "task":        self.task.asDict(),
+            "workerId":    self.workerId,
+            "host":        self.host,
+            "token":       self.token,
+            "leaseTime":   self.leaseTime,
+            "speculative": self.speculative,
+            "straggler":   self.straggler
+        }
+
+    @classmethod
+    def fromDict(cls, dictionary, task, touchTime):
+        """Rebuilds a lease of task from asDict, as if last touched at touchTime."""
+        lease = cls(task, touchTime, dictionary["host"], dictionary["workerId"],
+                dictionary["speculative"], dictionary["token"])
+        lease.leaseTime = dictionary["leaseTime"]
+        lease.straggler = dictionary["straggler"]
+        return lease
+
+    def taskDict(self):
+        """Returns the task's dictionary as handed to the worker, including the lease token."""
+        taskDict = self.task.asDict()
+        taskDict["leaseToken"] = self.token
+        return taskDict
+
+    def touch(self, now, progress=None, stage=None):
+        self.touchTime = now
+        if progress == None and stage == None:
+            return
+
+        if progress != self.progress or stage != self.stage:
+            self.progressTime = now
+
+        self.progress = progress
+        self.stage    = stage
+
+    def stalledSince(self, stallTime):
+        """True if the task reports a fraction complete, but nothing has changed since stallTime.
+
+        Tasks that only report their stage are never considered stalled.
+        """
+        return self.progress != None and self.progressTime <= stallTime
+
 class TaskQueue(object):
     """Main queue object (thread safe).
 
@@ -21,14 +110,32 @@ class TaskQueue(object):
     def __init__(self):
         self.requests        = []
         self.processingTasks = []
+        self.lastLeaseToken  = 0
         self.lock = threading.RLock()
 
-    def allRequests(self):
-        """Returns all requests in processing or requests queue.
-        
+    def newLeaseToken(self):
+        with self.lock:
+            self.lastLeaseToken += 1
+            return self.lastLeaseToken
+
+    def queuedRequests(self):
+        """Returns all requests waiting in the requests queue.
+
         This is really only useful for serializing the queue to disk."""
         with self.lock:
-            return self.requests + self.processingTasks
+            return list(self.requests)
+
+    def processingLeases(self):
+        """Returns the leases of tasks being processed, except those lost to another copy.
+
+        Like queuedRequests, this is for serializing the queue to disk."""
+        with self.lock:
+            return [lease for lease in self.processingTasks if not lease.lost]
+
+    def restoreProcessingLease(self, lease):
+        """Puts a lease read back from disk into the processing queue."""
+        with self.lock:
+            self.processingTasks.append(lease)
 
 
     def putTask(self, request):
@@ -44,62 +151,347 @@ class TaskQueue(object):
             self.requests.insert(0,request)
 
 
-    def putProcessingTask(self, task):
-        """Puts a model into the queue for worker processing."""
+    def putProcessingTask(self, task, host=None, workerId=None):
+        """Puts a model into the queue for worker processing (by a given worker on a given host).
+
+        Returns the new lease.
+        """
         now = time.time()
         with self.lock:
-            self.processingTasks.append((task, now))
+            lease = TaskLease(task, now, host, workerId, token=self.newLeaseToken())
+            self.processingTasks.append(lease)
+            return lease
+
+    def busySlotsByWorker(self):
+        """Returns a dictionary counting processing tasks per worker id."""
+        with self.lock:
+            counts = collections.defaultdict(int)
+            for lease in self.processingTasks:
+                counts[lease.workerId] += 1
+
+            return counts
+
+    def spareConcurrency(self, modelClass, host):
+        """Returns how many more tasks of a model may be leased to a worker on host (None for no limit)."""
+        with self.lock:
+            clusterCounts = collections.defaultdict(int)
+            hostCounts    = collections.defaultdict(int)
+            for lease in self.processingTasks:
+                for key, clusterLimit, hostLimit in lease.task.modelClass.concurrencyLimits():
+                    clusterCounts[key] += 1
+                    if lease.host == host:
+                        hostCounts[key] += 1
+
+        spare = None
+        for key, clusterLimit, hostLimit in modelClass.concurrencyLimits():
+            for limit, counts in [(clusterLimit, clusterCounts), (hostLimit, hostCounts)]:
+                if limit != None:
+                    left = max(0, int(limit) - counts[key])
+                    spare = left if spare == None else min(spare, left)
+
+        return spare
     
-    def pullNextVersioned(self, modelVersions):
-        """Pulls the next model from the worker queue that matches versions."""
+    def pullNextVersioned(self, modelVersions, host=None):
+        """Pulls the next model from the worker queue that matches versions.
+
+        Models already running as many tasks as their concurrency limits allow
+        are passed over, so they don't hold up the rest of the queue.
+        """
         with self.lock:
+            spares = {}
             for i,task in enumerate(self.requests):
-                if [task.__class__.short_name, task.__class__.version] in modelVersions:
+                modelClass = task.modelClass
+                if [modelClass.short_name, modelClass.version] not in modelVersions:
+                    continue
+
+                if modelClass not in spares:
+                    spares[modelClass] = self.spareConcurrency(modelClass, host)
+
+                if spares[modelClass] != 0:
                     del self.requests[i]
                     return task
 
         return None
 
-    
+    def pullNextVersionedBundle(self, modelVersions, costThreshold, maxTasks, host=None):
+        """Pulls a bundle of tasks of the same model and version that matches versions.
+
+        Tasks of the first matching model are added to the bundle while their
+        summed estimated cost stays within costThreshold (and the model's
+        concurrency limits). Models that don't support bundling always come
+        back as a bundle of one. Returns an empty list if nothing matches.
+        """
+        with self.lock:
+            first = self.pullNextVersioned(modelVersions, host)
+            if first == None:
+                return []
+
+            bundle = [first]
+            if not first.modelClass.supportsBundling:
+                return bundle
+
+            spare = self.spareConcurrency(first.modelClass, host)
+            if spare != None:
+                maxTasks = min(maxTasks, spare)
+
+            cost = first.estimatedCost()
+            i = 0
+            while i < len(self.requests) and len(bundle) < maxTasks:
+                task = self.requests[i]
+                if task.modelClass is first.modelClass and cost + task.estimatedCost() <= costThreshold:
+                    cost += task.estimatedCost()
+                    bundle.append(task)
+                    del self.requests[i]
+                else:
+                    i += 1
+
+            return bundle
+
     def pullNextTask(self):
         """Pulls a model from the worker queue."""
         with self.lock:
             return self.requests.pop(0)
 
-    def touchProcessingTaskById(self, taskId):
-        """Update timestamp on a task that is currently processing."""
+    def touchProcessingTaskById(self, taskId, progress=None, stage=None, workerId=None, token=None):
+        """Update timestamp (and progress, if reported) on a task that is currently processing.
+
+        Returns the lease (the one with token, or held by workerId, if given).
+        """
 
         now = time.time()
         with self.lock:
-            for i, (task, taskTime) in enumerate(self.processingTasks):
-                if task.taskId == taskId:
-                    self.processingTasks[i] = (task, now)
-                    break
+            for lease in self.processingTasks:
+                if lease.matches(taskId, workerId, token):
+                    lease.touch(now, progress, stage)
+                    return lease
             else:
                 raise TaskQueueException("Invalid id '%s'" % taskId)
 
     def hasProcessingTaskById(self, taskId):
+        """True if some lease of the task id is still in the running (not lost to a copy)."""
+        with self.lock:
+            return any(lease.matches(taskId) and not lease.lost for lease in self.processingTasks)
+
+    def claimProcessingTaskById(self, taskId, workerId=None, token=None):
+        """Claims a processing task for the worker about to deliver its results.
+
+        Returns False if the worker has no lease of the task, or lost it to
+        a speculative copy claimed first. Otherwise every other lease of the
+        task is marked lost and True is returned.
+        """
         with self.lock:
-            return any(e.taskId == taskId for (e,t) in self.processingTasks)
+            claimed = None
+            for lease in self.processingTasks:
+                if lease.matches(taskId, workerId, token) and not lease.lost:
+                    claimed = lease
+                    break
+            else:
+                return False
 
-    def pullProcessingTasksOlderThan(self, oldTime):
-        """Pulls tasks out of the processing queue that are stale."""
+            for lease in self.processingTasks:
+                if lease.matches(taskId) and lease is not claimed and not lease.lost:
+                    logging.info("Lease of task '%s' by worker '%s' lost to worker '%s'",
+                            taskId, lease.workerId, claimed.workerId)
+                    lease.lost = True
+
+            return True
+
+    def pullProcessingLeasesOlderThan(self, oldTime):
+        """Pulls leases out of the processing queue that are stale."""
 
         with self.lock:
-            expireTasks = [e for (e,t) in self.processingTasks if t <= oldTime]
-            self.processingTasks = [(e,t) for (e,t) in self.processingTasks if t > oldTime]
+            expireLeases = [lease for lease in self.processingTasks if lease.touchTime <= oldTime]
+            self.processingTasks = [lease for lease in self.processingTasks if lease.touchTime > oldTime]
 
-            return expireTasks
+            return expireLeases
+
+    def pullProcessingLeasesStalledSince(self, stallTime):
+        """Pulls leases out of the processing queue whose progress hasn't changed since stallTime."""
 
-    def pullProcessingTaskById(self, taskId):
         with self.lock:
-            possibleTasks = [e for (e,t) in self.processingTasks if e.taskId == taskId]
-            self.processingTasks = [(e,t) for (e,t) in self.processingTasks if e.taskId != taskId]
+            stalledLeases = [lease for lease in self.processingTasks if lease.stalledSince(stallTime)]
+            self.processingTasks = [lease for lease in self.processingTasks if not lease.stalledSince(stallTime)]
+
+            return stalledLeases
 
-            if len(possibleTasks) == 0:
+    def pullProcessingLeaseById(self, taskId, workerId=None, token=None):
+        """Pulls the lease of a task id (the one with token, or held by workerId, if given) out of the processing queue."""
+        with self.lock:
+            for i, lease in enumerate(self.processingTasks):
+                if lease.matches(taskId, workerId, token):
+                    del self.processingTasks[i]
+                    return lease
+            else:
                 raise TaskQueueException("Invalid id '%s'" % taskId)
 
-            return possibleTasks[0]
+    def commitProcessingTaskById(self, taskId, workerId=None, token=None):
+        """Atomically claims and completes a processing task for the worker holding the lease.
+
+        Returns the completed lease if the worker won the task, otherwise
+        None (dropping the worker's lease if it had lost to another copy).
+
+        A task whose lease expired while its worker couldn't reach us (e.g.
+        the worker spooled its results during an outage) is back in the
+        requests queue. As long as it hasn't been leased again, the latest
+        token still completes it, and the returned lease has no leaseTime.
+        """
+        with self.lock:
+            if self.claimProcessingTaskById(taskId, workerId, token):
+                return self.pullProcessingLeaseById(taskId, workerId, token)
+
+            for i, lease in enumerate(self.processingTasks):
+                if lease.matches(taskId, workerId, token):
+                    del self.processingTasks[i]
+                    return None
+
+            if token != None and not any(lease.matches(taskId) for lease in self.processingTasks):
+                for i, task in enumerate(self.requests):
+                    if task.taskId == taskId and task.leaseToken == token:
+                        logging.info("Completing requeued task '%s' with its latest lease token %s", taskId, token)
+                        del self.requests[i]
+                        lease = TaskLease(task, time.time(), None, workerId, token=token)
+                        lease.leaseTime = None
+                        return lease
+
+            return None
+
+    def flagStragglers(self, expectedRunTime, factor, now):
+        """Flags leases running factor times longer than expectedRunTime(task) predicts.
+
+        Tasks reporting progress are only flagged if their projected run time
+        is also that far off. Returns the newly flagged leases.
+        """
+        with self.lock:
+            flagged = []
+            for lease in self.processingTasks:
+                if lease.straggler or lease.lost or lease.speculative:
+                    continue
+
+                expected = expectedRunTime(lease.task)
+                if expected == None:
+                    continue
+
+                elapsed = now - lease.leaseTime
+                if elapsed <= factor * expected:
+                    continue
+
+                if lease.progress != None and lease.progress > 0 and elapsed / lease.progress <= factor * expected:
+                    continue
+
+                lease.straggler = True
+                flagged.append(lease)
+
+            return flagged
+
+    def pullSpeculativeTask(self, modelVersions, host=None, workerId=None):
+        """Leases a copy of a straggling task to an idle worker, returning the new lease (or None).
+
+        Only tasks with a single lease get a copy, and never on the host (or
+        worker) already running them, since that may be what slows them down.
+        """
+        with self.lock:
+            for lease in self.processingTasks:
+                task       = lease.task
+                modelClass = task.modelClass
+                if not lease.straggler or lease.lost or getattr(task, "cancelRequested", False):
+                    continue
+
+                if [modelClass.short_name, modelClass.version] not in modelVersions:
+                    continue
+
+                if lease.workerId == workerId or (host != None and lease.host == host):
+                    continue
+
+                if sum(1 for other in self.processingTasks if other.task is task) > 1:
+                    continue
+
+                if self.spareConcurrency(modelClass, host) == 0:
+                    continue
+
+                copy = TaskLease(task, time.time(), host, workerId, speculative=True, token=self.newLeaseToken())
+                self.processingTasks.append(copy)
+                return copy
+
+        return None
+
+    def cancelTaskByVisibleId(self, visibleId):
+        """Cancels a task by its visible id.
+
+        Queued tasks are simply dropped ("cancelled"). Processing tasks are
+        flagged so that the worker aborts them on its next heartbeat
+        ("cancelling"). Returns None if there is no such task.
+        """
+
+        with self.lock:
+            for i, task in enumerate(self.requests):
+                if task.visibleId == visibleId:
+                    del self.requests[i]
+                    return "cancelled"
+
+            for lease in self.processingTasks:
+                if lease.task.visibleId == visibleId:
+                    lease.task.cancelRequested = True
+                    return "cancelling"
+
+        return None
+
+    def taskStatusByVisibleId(self, visibleId):
+        """Returns a dictionary describing where a task is and how far along it is, or None."""
+
+        with self.lock:
+            for lease in self.processingTasks:
+                if lease.task.visibleId == visibleId:
+                    return {
+                        "state":    "processing",
+                        "progress": lease.progress,
+                        "stage":    lease.stage
+                    }
+
+            for i, task in enumerate(self.requests):
+                if task.visibleId == visibleId:
+                    return {
+                        "state":    "queued",
+                        "position": i + 1
+                    }
+
+        return None
+
+    def summary(self):
+        """Returns counts of queued and processing tasks, and the summed estimated cost of the queued ones."""
+        with self.lock:
+            return {
+                "queued":     len(self.requests),
+                "processing": len(self.processingTasks),
+                "backlog":    sum(task.estimatedCost() for task in self.requests)
+            }
+
+    def replaceQueuedTasks(self, replacement):
+        """Swaps queued tasks for replacement(task), where that isn't None, keeping their places in the queue.
+
+        Returns the number of tasks replaced.
+        """
+        replaced = 0
+        with self.lock:
+            for i, task in enumerate(self.requests):
+                newTask = replacement(task)
+                if newTask != None:
+                    self.requests[i] = newTask
+                    replaced += 1
+
+        return replaced
+
+    def missingVersions(self, modelVersions, limit=5):
+        """Returns up to limit [name, version] pairs of queued tasks not in modelVersions, oldest first."""
+        missing = []
+        with self.lock:
+            for task in self.requests:
+                version = [task.modelClass.short_name, task.modelClass.version]
+                if version not in modelVersions and version not in missing:
+                    missing.append(version)
+                    if len(missing) >= limit:
+                        break
+
+        return missing
 
     def isEmpty(self):
         with self.lock:
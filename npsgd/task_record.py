@@ -0,0 +1,74 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module used within the queue daemon for holding tasks compactly.
+
+The queue keeps every queued task, and every request waiting for
+confirmation (for days), in memory. Full ModelTask objects are heavy for
+that: each carries its own dictionary, parameter records, a working
+directory, locks and so on, none of which the queue needs. The queue holds
+TaskRecords instead and builds a ModelTask only when it needs one (e.g. for
+an email).
+"""
+
+class TaskRecord(object):
+    """Compact form of a task, as the queue holds it.
+
+    Everything shared by all tasks of a model version lives on the model
+    class, of which the record only keeps a reference. Parameter values sit
+    in a flat tuple laid out like the model's ParameterSchema. The task's
+    estimatedCost() is worked out once, when the record is made.
+    """
+
+    __slots__ = ("modelClass", "taskId", "visibleId", "emailAddress", "failureCount", "values",
+            "cost", "leaseToken", "cancelRequested", "failureOutput", "failureReason")
+
+    def __init__(self, modelClass, taskId, visibleId, emailAddress, failureCount, values, cost):
+        self.modelClass      = modelClass
+        self.taskId          = taskId
+        self.visibleId       = visibleId
+        self.emailAddress    = intern(emailAddress) if type(emailAddress) is str else emailAddress
+        self.failureCount    = failureCount
+        self.values          = values
+        self.cost            = cost
+        self.leaseToken      = None
+        self.cancelRequested = False
+        self.failureOutput   = None
+        self.failureReason   = None
+
+    @classmethod
+    def fromTask(cls, task):
+        modelClass = task.__class__
+        record = cls(modelClass, task.taskId, task.visibleId, task.emailAddress, task.failureCount,
+                modelClass.schema().valuesOf(task.modelParameters), task.estimatedCost())
+        record.leaseToken = task.leaseToken
+        return record
+
+    def task(self):
+        """Builds the full ModelTask this record stands for."""
+        task = self.modelClass(self.emailAddress, self.taskId, failureCount=self.failureCount, visibleId=self.visibleId)
+        task.bindValues(self.values)
+        task.leaseToken      = self.leaseToken
+        task.cancelRequested = self.cancelRequested
+        task.failureOutput   = self.failureOutput
+        task.failureReason   = self.failureReason
+        return task
+
+    def estimatedCost(self):
+        return self.cost
+
+    def failureEmail(self):
+        return self.task().failureEmail()
+
+    def asDict(self):
+        modelClass = self.modelClass
+        return {
+            "emailAddress" :   self.emailAddress,
+            "taskId":          self.taskId,
+            "visibleId":       self.visibleId,
+            "failureCount":    self.failureCount,
+            "modelName":       modelClass.short_name,
+            "modelFullName":   modelClass.full_name,
+            "modelVersion":    modelClass.version,
+            "modelParameters": modelClass.schema().valueDicts(self.values)
+        }
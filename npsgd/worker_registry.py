@@ -0,0 +1,188 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Module used within the queue daemon for keeping track of workers.
+
+Workers register once with what they can run and what they have to run it
+with, then check in with every request they make. The queue uses this for
+knowing how much capacity it has and for keeping tasks away from workers that
+keep failing them.
+"""
+import time
+import logging
+import threading
+from config import config
+
+class WorkerRecord(object):
+    """Everything the queue knows about a single worker."""
+
+    def __init__(self, workerId, host, slots, modelVersions, resources):
+        self.workerId         = workerId
+        self.host             = host
+        self.slots            = slots
+        self.modelVersions    = modelVersions
+        self.resources        = resources
+        self.registeredTime   = time.time()
+        self.lastCheckin      = self.registeredTime
+        self.completed        = 0
+        self.failed           = 0
+        self.failureRate      = 0.0
+        self.recentOutcomes   = 0
+        self.quarantinedUntil = 0
+
+    def isAlive(self, now):
+        return now - self.lastCheckin < config.keepAliveTimeout
+
+    def isHealthy(self, now):
+        return now >= self.quarantinedUntil
+
+    def supports(self, modelName, modelVersion):
+        return [modelName, modelVersion] in self.modelVersions
+
+    def recordOutcome(self, failed, now):
+        """Folds a task outcome into the worker's failure rate (an exponential moving average).
+
+        A worker failing more than workerFailureThreshold of its recent tasks is
+        quarantined for workerQuarantineTime seconds, after which it starts
+        with a clean slate.
+        """
+        if failed:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+        weight = 0.2
+        self.failureRate     = (1 - weight) * self.failureRate + weight * (1.0 if failed else 0.0)
+        self.recentOutcomes += 1
+        if self.recentOutcomes >= 3 and self.failureRate > config.workerFailureThreshold:
+            logging.warning("Worker '%s' is failing too many tasks (failure rate %.2f), quarantining it for %ds",
+                    self.workerId, self.failureRate, config.workerQuarantineTime)
+            self.quarantinedUntil = now + config.workerQuarantineTime
+            self.failureRate      = 0.0
+            self.recentOutcomes   = 0
+
+    def asDict(self, now, busySlots):
+        return {
+            "workerId":      self.workerId,
+            "host":          self.host,
+            "slots":         self.slots,
+            "busySlots":     busySlots,
+            "resources":     self.resources,
+            "modelVersions": self.modelVersions,
+            "alive":         self.isAlive(now),
+            "healthy":       self.isHealthy(now),
+            "completed":     self.completed,
+            "failed":        self.failed,
+            "failureRate":   self.failureRate,
+            "lastCheckin":   self.lastCheckin
+        }
+
+class UnknownWorkerError(RuntimeError): pass
+class WorkerRegistry(object):
+    """Registry of workers keyed by their self-assigned ids (thread safe).
+
+    Workers that predate registration don't send an id; all we can do for
+    those is remember when one of them last checked in.
+    """
+
+    def __init__(self):
+        self.workers              = {}
+        self.lastAnonymousCheckin = 0
+        self.lock                 = threading.RLock()
+
+    def register(self, workerId, host, slots, modelVersions, resources):
+        with self.lock:
+            logging.info("Registered worker '%s' on %s with %d slots", workerId, host, slots)
+            self.workers[workerId] = WorkerRecord(workerId, host, slots, modelVersions, resources)
+
+    def unregister(self, workerId):
+        with self.lock:
+            if workerId in self.workers:
+                logging.info("Worker '%s' retired", workerId)
+                del self.workers[workerId]
+
+    def checkin(self, workerId, modelVersions=None):
+        """Notes that a worker is still around, raising UnknownWorkerError if it never registered."""
+        now = time.time()
+        with self.lock:
+            if workerId == None:
+                self.lastAnonymousCheckin = now
+                return None
+
+            if workerId not in self.workers:
+                raise UnknownWorkerError("Unknown worker '%s'" % workerId)
+
+            worker = self.workers[workerId]
+            worker.lastCheckin = now
+            if modelVersions != None:
+                worker.modelVersions = modelVersions
+
+            return worker
+
+    def recordOutcome(self, workerId, failed):
+        with self.lock:
+            if workerId in self.workers:
+                self.workers[workerId].recordOutcome(failed, time.time())
+
+    def shouldDispatchTo(self, workerId):
+        """False if a worker is unhealthy and a healthy live worker could take its work instead."""
+        now = time.time()
+        with self.lock:
+            worker = self.workers.get(workerId)
+            if worker == None or worker.isHealthy(now):
+                return True
+
+            for other in self.workers.itervalues():
+                if other.isAlive(now) and other.isHealthy(now) and \
+                        any(other.supports(*version) for version in worker.modelVersions):
+                    return False
+
+            logging.info("Dispatching to unhealthy worker '%s' as no healthy worker can take its models", workerId)
+            return True
+
+    def pruneDead(self):
+        """Forgets workers that haven't checked in for ten keep alive timeouts."""
+        oldTime = time.time() - 10 * config.keepAliveTimeout
+        with self.lock:
+            for workerId, worker in self.workers.items():
+                if worker.lastCheckin < oldTime:
+                    logging.info("Forgetting worker '%s', last seen at %s", workerId, time.ctime(worker.lastCheckin))
+                    del self.workers[workerId]
+
+    def isStranded(self, modelName, modelVersion):
+        """True if live workers are known and none of them can run a model version."""
+        now = time.time()
+        with self.lock:
+            live = [w for w in self.workers.itervalues() if w.isAlive(now)]
+            #Workers that predate registration don't tell us what they run
+            if len(live) == 0 or now - self.lastAnonymousCheckin < config.keepAliveTimeout:
+                return False
+
+            return not any(w.supports(modelName, modelVersion) for w in live)
+
+    def capacity(self, busySlots, modelName=None, modelVersion=None):
+        """Summarizes live workers (only those supporting a model version, if given).
+
+        busySlots maps worker ids to the number of tasks leased to them.
+        """
+        now = time.time()
+        with self.lock:
+            live = [w for w in self.workers.itervalues() if w.isAlive(now) and \
+                    (modelName == None or w.supports(modelName, modelVersion))]
+            healthy = [w for w in live if w.isHealthy(now)]
+            slots   = sum(w.slots for w in healthy)
+            busy    = sum(min(w.slots, busySlots.get(w.workerId, 0)) for w in healthy)
+
+            anonymous = now - self.lastAnonymousCheckin < config.keepAliveTimeout
+            return {
+                "has_workers":     len(healthy) > 0 or anonymous,
+                "workers":         len(live),
+                "healthy_workers": len(healthy),
+                "slots":           slots,
+                "free_slots":      slots - busy
+            }
+
+    def workerDicts(self, busySlots):
+        now = time.time()
+        with self.lock:
+            return [w.asDict(now, busySlots.get(w.workerId, 0)) for w in self.workers.itervalues()]
@@ -12,24 +12,32 @@ responsible for sending out confirmation code e-mail messages.
 """
 import os
 import sys
+import time
+import base64
 import anydbm
 import shelve
+import pickle
 import logging
 import tornado.web
 import tornado.ioloop
 import tornado.escape
 import tornado.httpserver
 import threading
-from datetime import datetime
 from optparse import OptionParser
 
 import npsgd.email_manager
 from npsgd.email_manager import Email
 from npsgd import model_manager
 from npsgd.config import config
-from npsgd.task_queue import TaskQueue
+from npsgd.task_queue import TaskQueue, TaskLease
 from npsgd.task_queue import TaskQueueException
+from npsgd.task_record import TaskRecord
 from npsgd.confirmation_map import ConfirmationMap
+from npsgd.confirmed_codes import ConfirmedCodes
+from npsgd.confirmation_token import ConfirmedTokens, ConfirmationTokenError
+from npsgd.confirmation_token import encodeToken, decodeToken, isToken, tokenKey
+from npsgd.resource_usage import ResourceUsage, UsageLedger
+from npsgd.worker_registry import WorkerRegistry, UnknownWorkerError
 from npsgd.model_manager import modelManager
 
 glb = None
@@ -49,13 +57,38 @@ class QueueGlobals(object):
         else:
             self.idCounter = 0
 
+        if shelve.has_key("usageLedger"):
+            self.usageLedger = UsageLedger.fromDict(shelve["usageLedger"])
+        else:
+            self.usageLedger = UsageLedger()
+
+        if shelve.has_key("confirmedTokens"):
+            self.confirmedTokens = ConfirmedTokens.fromDict(shelve["confirmedTokens"])
+        else:
+            self.confirmedTokens = ConfirmedTokens()
+
+        self.confirmedCodes = ConfirmedCodes(config.confirmTimeoutSeconds, config.confirmedCodeBucket,
+                config.confirmedCodeBloomCapacity, config.confirmedCodeBloomErrorRate)
+        if shelve.has_key("confirmedCodes"):
+            self.confirmedCodes.loadDict(shelve["confirmedCodes"])
+
         self.loadDiskTaskQueue()
+        self.loadDiskLeases()
         self.loadConfirmationMap()
-        self.expireWorkerTaskThread = ExpireWorkerTaskThread(self.taskQueue)
-        self.lastWorkerCheckin = datetime(1,1,1)
+        if shelve.has_key("leaseToken"):
+            self.taskQueue.lastLeaseToken = shelve["leaseToken"]
+
+        self.workerRegistry  = WorkerRegistry()
+        self.expireWorkerTaskThread = ExpireWorkerTaskThread(self.taskQueue, self.workerRegistry, self.usageLedger)
+        self.expireWorkerTaskThread.start()
 
     def loadDiskTaskQueue(self):
-        """Load task queue from disk using the shelve reserved for the queue."""
+        """Load task queue from disk using the shelve reserved for the queue.
+
+        Leases are saved on their own when tasks are handed out (see
+        syncLeases), so tasks saved as queued may have been leased since.
+        Those are left to loadDiskLeases.
+        """
 
         if not self.shelve.has_key("taskQueue"):
             logging.info("Unable to read task queue from disk db, starting fresh")
@@ -65,25 +98,80 @@ class QueueGlobals(object):
         readTasks   = 0
         failedTasks = 0
         taskDicts = self.shelve["taskQueue"]
+        leasedIds = set(leaseDict["task"]["taskId"] for leaseDict in self.shelve.get("leases", []))
         for taskDict in taskDicts:
-            try:
-                task = modelManager.getModelFromTaskDict(taskDict)
-            except model_manager.InvalidModelError, e:
-                emailAddress = taskDict["emailAddress"]
-                subject = config.lostTaskEmailSubject.generate(full_name=taskDict["modelFullName"], 
-                        visibleId=taskDict["visibleId"])
-                body = config.lostTaskEmailTemplate.generate()
-                emailObject = Email(emailAddress, subject, body)
-                logging.info("Invalid model-version pair, notifying %s", emailAddress)
-                npsgd.email_manager.backgroundEmailSend(Email(emailAddress, subject, body))
+            if taskDict["taskId"] in leasedIds:
+                continue
+
+            task = self.restoreTask(taskDict)
+            if task == None:
                 failedTasks += 1
                 continue
             
             readTasks += 1
+            task.leaseToken = taskDict.get("leaseToken")
             self.taskQueue.putTask(task)
 
         logging.info("Read %s tasks, failed while reading %s tasks", readTasks, failedTasks)
 
+    def loadDiskLeases(self):
+        """Load the leases of tasks that were processing from the queue shelve.
+
+        Restored leases stay in flight: their workers get leaseRestoreGrace
+        seconds to heartbeat (the task is requeued as usual if they don't), and
+        can still complete them with their lease tokens.
+        """
+
+        if not self.shelve.has_key("leases"):
+            return
+
+        touchTime = time.time() - config.keepAliveTimeout + config.leaseRestoreGrace
+        tasks     = {}
+        for leaseDict in self.shelve["leases"]:
+            taskDict = leaseDict["task"]
+            if taskDict["taskId"] not in tasks:
+                tasks[taskDict["taskId"]] = self.restoreTask(taskDict)
+
+            task = tasks[taskDict["taskId"]]
+            if task != None:
+                self.taskQueue.restoreProcessingLease(TaskLease.fromDict(leaseDict, task, touchTime))
+
+        logging.info("Restored %d in flight leases, giving their workers %ds to check in",
+                len(self.taskQueue.processingLeases()), config.leaseRestoreGrace)
+
+    def restoreTask(self, taskDict):
+        """Rebuilds a task read from disk, notifying its user and returning None if its model version is gone.
+
+        Tasks of versions that are gone move to the latest version of their
+        model instead, if it takes the same parameters.
+        """
+        try:
+            return TaskRecord.fromTask(modelManager.getModelFromTaskDict(taskDict))
+        except model_manager.InvalidModelError, e:
+            task = self.migrateTaskDict(taskDict)
+            if task != None:
+                return task
+
+            emailAddress = taskDict["emailAddress"]
+            subject = config.lostTaskEmailSubject.generate(full_name=taskDict["modelFullName"], 
+                    visibleId=taskDict["visibleId"])
+            body = config.lostTaskEmailTemplate.generate()
+            logging.info("Invalid model-version pair, notifying %s", emailAddress)
+            npsgd.email_manager.backgroundEmailSend(Email(emailAddress, subject, body))
+            return None
+
+    def migrateTaskDict(self, taskDict):
+        """Moves a task dict to the latest version of its model, returning None if that version can't take it."""
+        try:
+            task = TaskRecord.fromTask(modelManager.migrateTaskDict(taskDict))
+        except model_manager.InvalidModelError, e:
+            logging.info("Unable to migrate task '%s': %s", taskDict["taskId"], e)
+            return None
+
+        logging.info("Migrated task '%s' of model '%s' from version '%s' to '%s'", taskDict["taskId"],
+                taskDict["modelName"], taskDict["modelVersion"], task.modelClass.version)
+        return task
+
     def loadConfirmationMap(self):
         """Load confirmation map ([code, modelDict] pairs) from shelve reserved for the queue."""
 
@@ -98,15 +186,12 @@ class QueueGlobals(object):
         failedCodes = 0
         for code, taskDict in confirmationMapEntries.iteritems():
             try:
-                task = modelManager.getModelFromTaskDict(taskDict)
+                task = TaskRecord.fromTask(modelManager.getModelFromTaskDict(taskDict))
             except model_manager.InvalidModelError, e:
-                emailAddress = taskDict["emailAddress"]
-                subject = config.confirmationFailedEmailSubject.generate(full_name=taskDict["modelFullName"], 
-                        visibleId=taskDict["visibleId"])
-                body = config.confirmationFailedEmailTemplate.generate(code=code)
-                emailObject = Email(emailAddress, subject, body)
-                logging.info("Invalid model-version pair, notifying %s", emailAddress)
-                npsgd.email_manager.backgroundEmailSend(Email(emailAddress, subject, body))
+                task = self.migrateTaskDict(taskDict)
+
+            if task == None:
+                self.notifyConfirmationFailed(taskDict, code)
                 failedCodes += 1
                 continue
 
@@ -115,26 +200,83 @@ class QueueGlobals(object):
 
         logging.info("Read %s codes, failed while reading %s codes", readCodes, failedCodes)
 
+    def notifyConfirmationFailed(self, taskDict, code):
+        """Tells the user a request can't be confirmed because its model version is gone."""
+        emailAddress = taskDict["emailAddress"]
+        subject = config.confirmationFailedEmailSubject.generate(
+                full_name=taskDict.get("modelFullName", taskDict["modelName"]), visibleId=taskDict["visibleId"])
+        body = config.confirmationFailedEmailTemplate.generate(code=code)
+        logging.info("Invalid model-version pair, notifying %s", emailAddress)
+        npsgd.email_manager.backgroundEmailSend(Email(emailAddress, subject, body))
+
+    def confirmToken(self, token):
+        """Confirms a token (see confirmation_token), returning its task or None if it was confirmed before.
+
+        Raises ConfirmationTokenError for forged or expired tokens and
+        InvalidModelError if the task's model version is gone.
+        """
+        taskDict, expiryTime = decodeToken(token, config.requestSecret)
+        try:
+            task = TaskRecord.fromTask(modelManager.getModelFromTaskDict(taskDict))
+        except model_manager.InvalidModelError, e:
+            task = self.migrateTaskDict(taskDict)
+            if task == None:
+                raise
+
+        if not self.confirmedTokens.add(tokenKey(token), expiryTime):
+            return None
+
+        return task
+
 
     def syncShelve(self):
-        """Serializes the task queue, confirmation map and id counter to disk using the queue shelve."""
+        """Serializes the task queue, leases, confirmation map, usage ledger, id and lease token counters to disk using the queue shelve."""
         try:
             with self.shelveLock:
-                self.shelve["taskQueue"]        = [e.asDict() \
-                        for e in self.taskQueue.allRequests()]
+                self.shelve["taskQueue"]        = [dict(e.asDict(), leaseToken=e.leaseToken) \
+                        for e in self.taskQueue.queuedRequests()]
+                self.shelve["leases"]           = [lease.asDict() \
+                        for lease in self.taskQueue.processingLeases()]
                 self.shelve["confirmationMap"]  = dict( (code, task.asDict())\
                         for (code, task) in self.confirmationMap.getRequestsWithCodes())
 
+                self.shelve["confirmedTokens"]  = self.confirmedTokens.asDict()
+                self.shelve["confirmedCodes"]   = self.confirmedCodes.asDict()
+                self.shelve["usageLedger"] = self.usageLedger.asDict()
+                self.shelve["leaseToken"]  = self.taskQueue.lastLeaseToken
+
                 with self.idLock:
                     self.shelve["idCounter"] = self.idCounter
+
+                #Some dbm backends only write their index on close, which never happens if we're killed
+                self.shelve.sync()
         except pickle.PicklingError, e:
             logging.warning("Unable sync task queue and confirmation error to disk due to a pickling (serialization error): %s", e)
             return
 
         logging.info("Synced queue and confirmation map to disk")
 
-    def touchWorkerCheckin(self):
-        self.lastWorkerCheckin = datetime.now()
+    def syncLeases(self):
+        """Serializes just the leases and the lease token counter, for when tasks are handed out.
+
+        Full syncs pickle all of the queue's state, too much to do for every
+        task handed out. Tasks that still appear queued on disk are taken to
+        be leased when loading (see loadDiskTaskQueue).
+        """
+        try:
+            with self.shelveLock:
+                self.shelve["leases"]     = [lease.asDict() for lease in self.taskQueue.processingLeases()]
+                self.shelve["leaseToken"] = self.taskQueue.lastLeaseToken
+                self.shelve.sync()
+        except pickle.PicklingError, e:
+            logging.warning("Unable to sync leases to disk due to a pickling (serialization) error: %s", e)
+
+    def referencedModelVersions(self):
+        """Returns the (name, version) pairs of every queued, processing or unconfirmed task."""
+        tasks = self.taskQueue.queuedRequests() + [lease.task for lease in self.taskQueue.processingLeases()] + \
+                [task for (code, task) in self.confirmationMap.getRequestsWithCodes()]
+
+        return set((task.modelClass.short_name, task.modelClass.version) for task in tasks)
 
     def newTaskId(self):
         with self.idLock:
@@ -145,13 +287,19 @@ class ExpireWorkerTaskThread(threading.Thread):
     """Task Expiration Thread
 
     Moves tasks back into the queue whenever
-    We haven't heard from a worker in a while
+    We haven't heard from a worker in a while, or
+    a task's reported progress has stalled.
+    It also flags tasks running far longer than expected
+    so that idle workers can be handed speculative copies
     """
 
-    def __init__(self, taskQueue):
+    def __init__(self, taskQueue, workerRegistry, usageLedger):
         threading.Thread.__init__(self)
         self.daemon = True
         self.taskQueue = taskQueue
+        self.workerRegistry = workerRegistry
+        self.usageLedger = usageLedger
+        self.strandedSince = {}
         self.done = threading.Event()
 
     def run(self):
@@ -162,22 +310,110 @@ class ExpireWorkerTaskThread(threading.Thread):
             if self.done.isSet():
                 break
 
-            badTasks = self.taskQueue.pullProcessingTasksOlderThan(
+            badLeases = self.taskQueue.pullProcessingLeasesOlderThan(
                     time.time() - config.keepAliveTimeout)
 
-            if len(badTasks) > 0:
-                logging.info("Found %d tasks to expire", len(badTasks))
+            if len(badLeases) > 0:
+                logging.info("Found %d tasks to expire", len(badLeases))
+
+            self.expireLeases(badLeases, "timeout")
+
+            if config.progressStallTimeout > 0:
+                stalledLeases = self.taskQueue.pullProcessingLeasesStalledSince(
+                        time.time() - config.progressStallTimeout)
+
+                self.expireLeases(stalledLeases, "stalled progress")
+
+            if config.speculationFactor > 0:
+                self.flagStragglers()
+
+            if config.strandedTaskTimeout > 0:
+                self.migrateStrandedTasks()
+
+            self.workerRegistry.pruneDead()
+
+    def expireLeases(self, leases, reason):
+        """Expires leases, counting each against the worker that held it.
+
+        A task only goes back into the queue if no other lease of it (a
+        speculative copy) is still running.
+        """
+        expiredIds = set()
+        for lease in leases:
+            taskId = lease.task.taskId
+            if not lease.lost:
+                self.workerRegistry.recordOutcome(lease.workerId, True)
+
+            if lease.lost or taskId in expiredIds or self.taskQueue.hasProcessingTaskById(taskId):
+                logging.info("Dropping lease of task '%s' by worker '%s' due to %s, another lease remains",
+                        taskId, lease.workerId, reason)
+                continue
+
+            expiredIds.add(taskId)
+            self.expireTask(lease.task, reason)
+
+    def flagStragglers(self):
+        def expectedRunTime(task):
+            return self.usageLedger.expectedRunTime(task.modelClass.short_name, task.modelClass.version,
+                    task.estimatedCost(), config.speculationMinRuns)
+
+        now = time.time()
+        for lease in self.taskQueue.flagStragglers(expectedRunTime, config.speculationFactor, now):
+            logging.warning("Task '%s' has run on worker '%s' for %.1fs (expected %.1fs), offering a speculative copy",
+                    lease.task.taskId, lease.workerId, now - lease.leaseTime, expectedRunTime(lease.task))
+
+    def migrateStrandedTasks(self):
+        """Moves queued tasks whose version no live worker has run for strandedTaskTimeout to the latest version.
+
+        The wait leaves workers time to fetch versions they lack from us (see
+        WorkerModelBundle). Tasks the latest version can't take stay put.
+        """
+        now      = time.time()
+        stranded = set()
+        for task in self.taskQueue.queuedRequests():
+            key = (task.modelClass.short_name, task.modelClass.version)
+            if key not in stranded and self.workerRegistry.isStranded(*key):
+                stranded.add(key)
+
+        for key in self.strandedSince.keys():
+            if key not in stranded:
+                del self.strandedSince[key]
+
+        for key in stranded:
+            self.strandedSince.setdefault(key, now)
+
+        def migrate(task):
+            key = (task.modelClass.short_name, task.modelClass.version)
+            if now - self.strandedSince.get(key, now) < config.strandedTaskTimeout:
+                return None
+
+            try:
+                newTask = TaskRecord.fromTask(modelManager.migrateTaskDict(task.asDict()))
+            except model_manager.InvalidModelError, e:
+                logging.debug("Leaving stranded task '%s' be: %s", task.taskId, e)
+                return None
+
+            newTask.leaseToken = task.leaseToken
+            logging.warning("Migrated stranded task '%s' of model '%s' from version '%s' to '%s'",
+                    task.taskId, key[0], key[1], newTask.modelClass.version)
+            return newTask
 
-            for task in badTasks:
-                task.failureCount += 1
-                logging.warning("Task '%s' failed due to timeout (failure #%d)", task.taskId, task.failureCount)
-                if task.failureCount > config.maxJobFailures:
-                    logging.warning("Exceeded max job failures, sending fail email")
-                    npsgd.email_manager.backgroundEmailSend(task.failureEmail())
-                else:
-                    logging.warning("Inserting task back in to queue with new taskId")
-                    task.taskId = glb.newTaskId()
-                    self.taskQueue.putTask(task)
+        if len(self.strandedSince) > 0:
+            self.taskQueue.replaceQueuedTasks(migrate)
+
+    def expireTask(self, task, reason):
+        if getattr(task, "cancelRequested", False):
+            logging.info("Dropping cancelled task '%s' (%s)", task.taskId, reason)
+            return
+
+        task.failureCount += 1
+        logging.warning("Task '%s' failed due to %s (failure #%d)", task.taskId, reason, task.failureCount)
+        if task.failureCount > config.maxJobFailures:
+            logging.warning("Exceeded max job failures, sending fail email")
+            npsgd.email_manager.backgroundEmailSend(task.failureEmail())
+        else:
+            logging.warning("Inserting task back in to queue")
+            self.taskQueue.putTask(task)
 
 class QueueRequestHandler(tornado.web.RequestHandler):
     """Superclass to all queue request methods."""
@@ -189,6 +425,34 @@ class QueueRequestHandler(tornado.web.RequestHandler):
             self.write(tornado.escape.json_encode({"error": "bad_secret"}))
             return False
 
+    def workerId(self):
+        return self.get_argument("worker_id", None)
+
+    def leaseToken(self):
+        """Returns the fencing token of the worker's lease, or None for workers that don't send one."""
+        token = self.get_argument("token", None)
+        return int(token) if token != None else None
+
+    def checkinWorker(self, modelVersions=None, required=False):
+        """Records a check-in from the requesting worker.
+
+        If required and the worker isn't registered (e.g. the queue restarted)
+        this responds asking the worker to register and returns False.
+        """
+        try:
+            glb.workerRegistry.checkin(self.workerId(), modelVersions)
+        except UnknownWorkerError, e:
+            if not required:
+                return True
+
+            logging.info("Asking unknown worker '%s' to register", self.workerId())
+            self.write(tornado.escape.json_encode({
+                "error": {"type" : "unregistered" }
+            }))
+            return False
+
+        return True
+
 class ClientModelCreate(QueueRequestHandler):
     """HTTP handler for clients creating a model request (before confirmation)."""
 
@@ -207,7 +471,11 @@ class ClientModelCreate(QueueRequestHandler):
         task_json = tornado.escape.json_decode(self.get_argument("task_json"))
         task = modelManager.getModelFromTaskDict(task_json)
         task.taskId = glb.newTaskId()
-        code = glb.confirmationMap.putRequest(task)
+        if config.confirmationMode == "token":
+            code = encodeToken(task.asDict(), time.time() + config.confirmTimeoutSeconds, config.requestSecret)
+        else:
+            #The queue only holds the compact record, the full task is just needed for the email
+            code = glb.confirmationMap.putRequest(TaskRecord.fromTask(task))
 
         emailAddress = task.emailAddress
         logging.info("Generated a request for %s, confirmation %s required", emailAddress, code)
@@ -226,25 +494,122 @@ class ClientModelCreate(QueueRequestHandler):
 class ClientQueueHasWorkers(QueueRequestHandler):
     """Request handler for the web daemon to check if workers are available.
 
-    We keep track of the last time workers checked into the queue in order
-    to ensure that all requests can be processed.
+    Answers from the worker registry: how many live (and healthy) workers
+    there are and how many of their slots are free. If a model name and
+    version are given, only workers able to run that model count.
     """
 
     def get(self):
         if not self.checkSecret():
             return
 
-        td = datetime.now() - glb.lastWorkerCheckin
-        hasWorkers = (td.seconds + td.days * 24 * 3600) < config.keepAliveTimeout
+        capacity = glb.workerRegistry.capacity(glb.taskQueue.busySlotsByWorker(),
+                self.get_argument("model", None), self.get_argument("version", None))
 
         self.write(tornado.escape.json_encode({
-            "response": {
-                "has_workers" : hasWorkers
-            }    
+            "response": capacity
+        }))
+
+
+class ClientQueueStatus(QueueRequestHandler):
+    """Request handler summarizing queue depth, estimated backlog and worker capacity (for scaling)."""
+
+    def get(self):
+        if not self.checkSecret():
+            return
+
+        status = glb.taskQueue.summary()
+        status.update(glb.workerRegistry.capacity(glb.taskQueue.busySlotsByWorker()))
+        status["confirmations"]   = glb.confirmationMap.stats()
+        status["confirmed_codes"] = glb.confirmedCodes.stats()
+        self.write(tornado.escape.json_encode({
+            "response": status
+        }))
+
+
+class ClientWorkers(QueueRequestHandler):
+    """Request handler listing every worker the queue knows about, for monitoring."""
+
+    def get(self):
+        if not self.checkSecret():
+            return
+
+        self.write(tornado.escape.json_encode({
+            "response": glb.workerRegistry.workerDicts(glb.taskQueue.busySlotsByWorker())
+        }))
+
+
+class ClientTaskProgress(QueueRequestHandler):
+    """Request handler for the web daemon to check on a task by its visible id.
+
+    Responds with whether the task is queued or processing and, for the
+    latter, the progress last reported through the worker's heartbeats.
+    """
+
+    def get(self, visibleId):
+        if not self.checkSecret():
+            return
+
+        status = glb.taskQueue.taskStatusByVisibleId(visibleId)
+        if status == None:
+            status = {"state": "unknown"}
+
+        self.write(tornado.escape.json_encode({
+            "response": status
+        }))
+
+
+class ClientCancelTask(QueueRequestHandler):
+    """Request handler for cancelling a task by its visible id.
+
+    Queued tasks are removed immediately. Tasks that a worker is processing
+    are flagged and the worker kills the run when its next heartbeat is
+    answered.
+    """
+
+    def get(self, visibleId):
+        if not self.checkSecret():
+            return
+
+        state = glb.taskQueue.cancelTaskByVisibleId(visibleId)
+        if state == None:
+            raise tornado.web.HTTPError(404)
+
+        logging.info("Cancel requested for task '%s': %s", visibleId, state)
+        glb.syncShelve()
+        self.write(tornado.escape.json_encode({
+            "response": state
+        }))
+
+
+class ClientModelReferences(QueueRequestHandler):
+    """Request handler listing the model versions that tasks still refer to.
+
+    The web and worker daemons ask for these before unloading old model
+    versions (see ModelManager.collectGarbage).
+    """
+
+    def get(self):
+        if not self.checkSecret():
+            return
+
+        self.write(tornado.escape.json_encode({
+            "response": sorted(glb.referencedModelVersions())
+        }))
+
+
+class ClientUsageStats(QueueRequestHandler):
+    """Request handler reporting the resources used by completed tasks, per model version."""
+
+    def get(self):
+        if not self.checkSecret():
+            return
+
+        self.write(tornado.escape.json_encode({
+            "response": glb.usageLedger.asDict()
         }))
 
 
-previouslyConfirmed = set()
 class ClientConfirm(QueueRequestHandler):
     """HTTP handler for clients confirming a model request.
     
@@ -252,18 +617,18 @@ class ClientConfirm(QueueRequestHandler):
     request queue for processing.
     """
     def get(self, code):
-        global previouslyConfirmed
-
         if not self.checkSecret():
             return
 
+        if isToken(code):
+            self.confirmToken(code)
+            return
+
         try:
-            #Expire old confirmations first, just in case
-            glb.confirmationMap.expireConfirmations()
             confirmedRequest = glb.confirmationMap.getRequest(code)
-            previouslyConfirmed.add(code)
+            glb.confirmedCodes.add(code)
         except KeyError, e:
-            if code in previouslyConfirmed:
+            if code in glb.confirmedCodes:
                 self.write(tornado.escape.json_encode({
                     "response": "already_confirmed"
                 }))
@@ -277,6 +642,28 @@ class ClientConfirm(QueueRequestHandler):
             "response": "okay"
         }))
 
+    def confirmToken(self, token):
+        try:
+            task = glb.confirmToken(token)
+        except ConfirmationTokenError, e:
+            logging.info("Rejecting confirmation token: %s", e)
+            raise tornado.web.HTTPError(404)
+        except model_manager.InvalidModelError, e:
+            glb.notifyConfirmationFailed(decodeToken(token, config.requestSecret)[0], token)
+            raise tornado.web.HTTPError(404)
+
+        if task == None:
+            self.write(tornado.escape.json_encode({
+                "response": "already_confirmed"
+            }))
+            return
+
+        glb.taskQueue.putTask(task)
+        glb.syncShelve()
+        self.write(tornado.escape.json_encode({
+            "response": "okay"
+        }))
+
 
 class WorkerInfo(QueueRequestHandler):
     """HTTP handler for workers checking into the queue."""
@@ -285,59 +672,175 @@ class WorkerInfo(QueueRequestHandler):
         if not self.checkSecret():
             return
 
-        glb.touchWorkerCheckin()
+        self.checkinWorker()
         self.write("{}")
 
+class WorkerUnregister(QueueRequestHandler):
+    """HTTP handler for workers retiring gracefully, so that they stop counting as capacity."""
+
+    def post(self):
+        if not self.checkSecret():
+            return
+
+        glb.workerRegistry.unregister(self.workerId())
+        self.write(tornado.escape.json_encode({
+            "status": "okay"
+        }))
+
+class WorkerRegister(QueueRequestHandler):
+    """HTTP handler for workers registering themselves with the queue.
+
+    Workers register on start up (and whenever the queue no longer knows
+    them) with their id, host, number of slots, supported model versions and
+    resources. Afterwards any request carrying their id counts as a check-in.
+    """
+
+    def post(self):
+        if not self.checkSecret():
+            return
+
+        glb.workerRegistry.register(self.workerId(), self.get_argument("host"),
+                int(self.get_argument("slots", 1)),
+                tornado.escape.json_decode(self.get_argument("model_versions_json")),
+                tornado.escape.json_decode(self.get_argument("resources_json", "{}")))
+
+        self.write(tornado.escape.json_encode({
+            "status": "okay"
+        }))
+
 class WorkerTaskKeepAlive(QueueRequestHandler):
     """HTTP handler for workers pinging the queue while working on a task.
     
     Having this request makes sure that we don't time out any jobs that 
     are currently being handled by some worker. If a worker goes down,
     we will put the job back into the queue because this request won't have
-    been made.
+    been made. The response tells the worker whether to cancel the task
+    (because it was cancelled, another worker's copy of it won the race, or
+    the worker's lease was expired and the task leased to someone else).
     """
     def get(self, taskIdString):
         if not self.checkSecret():
             return
-        glb.touchWorkerCheckin()
+        self.checkinWorker()
         taskId = int(taskIdString)
-        logging.info("Got heartbeat for task id '%s'", taskId)
+        progress = self.get_argument("progress", None)
+        if progress != None:
+            progress = float(progress)
+        stage = self.get_argument("stage", None)
+
+        logging.info("Got heartbeat for task id '%s' (progress %s, stage %s)", taskId, progress, stage)
         try:
-            task = glb.taskQueue.touchProcessingTaskById(taskId)
+            lease = glb.taskQueue.touchProcessingTaskById(taskId, progress, stage, self.workerId(), self.leaseToken())
         except TaskQueueException, e:
+            if self.leaseToken() != None and glb.taskQueue.hasProcessingTaskById(taskId):
+                logging.info("Stale keep alive request for task id '%s': leased again since token %s", taskId, self.leaseToken())
+                self.write(tornado.escape.json_encode({
+                    "cancel": True
+                }))
+                return
+
             logging.info("Bad keep alive request: no such task id '%s' exists" % taskId)
             self.write(tornado.escape.json_encode({
                 "error": {"type" : "bad_id" }
             }))
+            return
 
-        self.write("{}")
+        if lease.lost or getattr(lease.task, "cancelRequested", False):
+            self.write(tornado.escape.json_encode({
+                "cancel": True
+            }))
+        else:
+            self.write("{}")
 
 class WorkerSucceededTask(QueueRequestHandler):
     """HTTP handler for workers telling the queue that they have succeeded processing.
 
     After this request, the queue no longer needs to keep track of the job in any way
-    and declares it complete.
+    and declares it complete. The resources the task used are added to the
+    usage ledger for its model version. Current workers use WorkerCommitTask
+    instead, this remains for workers that check with WorkerHasTask first.
     """
 
     def get(self, taskIdString):
+        self.post(taskIdString)
+
+    def post(self, taskIdString):
         if not self.checkSecret():
             return
-        glb.touchWorkerCheckin()
-        taskId = int(taskIdString)
-        try:
-            task = glb.taskQueue.pullProcessingTaskById(taskId)
-        except TaskQueueException, e:
-            logging.info("Bad succeed request: no task id exists")
+        self.checkinWorker()
+        lease = glb.taskQueue.commitProcessingTaskById(int(taskIdString), self.workerId(), self.leaseToken())
+        if lease == None:
+            logging.info("Bad succeed request: no task id exists (or the lease was lost)")
             self.write(tornado.escape.json_encode({
                 "error": {"type" : "bad_id" }
             }))
             return
 
-        glb.syncShelve()
+        self.completeLease(lease)
         self.write(tornado.escape.json_encode({
             "status": "okay"
         }))
 
+    def completeLease(self, lease):
+        """Records the usage and outcome of a lease the worker completed."""
+        task      = lease.task
+        usageJson = self.get_argument("usage_json", None)
+        if usageJson != None:
+            stageUsages = dict((stage, ResourceUsage.fromDict(usage))
+                    for stage, usage in tornado.escape.json_decode(usageJson).iteritems())
+            wallTime = time.time() - lease.leaseTime if lease.leaseTime != None else None
+            glb.usageLedger.record(task.modelClass.short_name, task.modelClass.version, stageUsages,
+                    wallTime, task.estimatedCost())
+
+        glb.workerRegistry.recordOutcome(self.workerId(), False)
+        glb.syncShelve()
+
+    def recordDeliveryUsage(self):
+        """Records the usage of delivering tasks the worker committed earlier (their email stage)."""
+        deliveryJson = self.get_argument("delivery_usage_json", None)
+        if deliveryJson == None:
+            return
+
+        for delivery in tornado.escape.json_decode(deliveryJson):
+            stageUsages = dict((stage, ResourceUsage.fromDict(usage))
+                    for stage, usage in delivery["usage"].iteritems())
+            glb.usageLedger.recordStages(delivery["modelName"], delivery["modelVersion"], stageUsages)
+
+class WorkerCommitTask(WorkerSucceededTask):
+    """HTTP handler for workers committing the result of a task before delivering it.
+
+    Completing a task takes a single request: if the worker's lease (named by
+    its fencing token) is still current, it is marked complete and the
+    response is "commit", meaning this worker (and no other) should send the
+    results email. Otherwise the response is "lost" and the worker should
+    discard its results, since the task was expired and leased again or
+    another copy of it was committed first.
+
+    The usage of delivering the results of tasks the worker committed before
+    comes along with each commit.
+    """
+
+    def post(self, taskIdString):
+        if not self.checkSecret():
+            return
+        self.checkinWorker()
+        self.recordDeliveryUsage()
+        taskId = int(taskIdString)
+        lease  = glb.taskQueue.commitProcessingTaskById(taskId, self.workerId(), self.leaseToken())
+        if lease == None:
+            logging.info("Worker '%s' lost task '%s' (token %s), rejecting its result",
+                    self.workerId(), taskId, self.leaseToken())
+            self.write(tornado.escape.json_encode({
+                "response": "lost"
+            }))
+            return
+
+        logging.info("Worker '%s' committed task '%s'", self.workerId(), taskId)
+        self.completeLease(lease)
+        self.write(tornado.escape.json_encode({
+            "response": "commit"
+        }))
+
 class WorkerHasTask(QueueRequestHandler):
     """HTTP handler for workers ensuring that a job still exists.
 
@@ -347,16 +850,19 @@ class WorkerHasTask(QueueRequestHandler):
     (this could happen if the queue declares that the first worker had timed out).
     If there is no task with that id still in the processing list then 
     an e-mail being sent out would be a duplicate.
+
+    When a task has a speculative copy running, asking is also claiming: the
+    first worker to ask gets "yes" and the other copy's lease is lost.
     """
 
     def get(self, taskIdString):
         if not self.checkSecret():
             return
 
-        glb.touchWorkerCheckin()
+        self.checkinWorker()
         taskId = int(taskIdString)
         logging.info("Got 'has task' request for task of id '%d'", taskId)
-        if glb.taskQueue.hasProcessingTaskById(taskId):
+        if glb.taskQueue.claimProcessingTaskById(taskId, self.workerId(), self.leaseToken()):
             self.write(tornado.escape.json_encode({
                 "response": "yes"
             }))
@@ -369,17 +875,25 @@ class WorkerFailedTask(QueueRequestHandler):
     """HTTP handler for workers reporting failure to complete a job.
     
     Upon failure, we will either recycle the request into the queue or we will
-    report a failure (with an e-mail message to the user).
+    report a failure (with an e-mail message to the user). Tasks that the
+    worker aborted are reported with a reason: timeouts fail immediately
+    (running them again would just time out again), cancelled tasks are
+    dropped silently and tasks aborted along with a bundle-mate are requeued
+    without counting a failure. Nothing is recycled while another copy of the task is
+    still running, or if this worker's copy had already lost the race.
+
+    Workers post their reports, as the output tail can be too long for a
+    query string. GET is still taken from workers that haven't been upgraded.
     """
 
-    def get(self, taskIdString):
+    def post(self, taskIdString):
         if not self.checkSecret():
             return
 
-        glb.touchWorkerCheckin()
+        self.checkinWorker()
         taskId = int(taskIdString)
         try:
-            task = glb.taskQueue.pullProcessingTaskById(taskId)
+            lease = glb.taskQueue.pullProcessingLeaseById(taskId, self.workerId(), self.leaseToken())
         except TaskQueueException, e:
             logging.info("Bad failed request: no such task id exists, ignoring request")
             self.write(tornado.escape.json_encode({
@@ -387,6 +901,36 @@ class WorkerFailedTask(QueueRequestHandler):
             }))
             return
 
+        task   = lease.task
+        reason = self.get_argument("reason", None)
+        task.failureOutput = self.get_argument("output", None)
+        if lease.lost:
+            logging.info("Worker stopped its copy of task '%s', which another worker completed", task.taskId)
+        elif glb.taskQueue.hasProcessingTaskById(taskId):
+            logging.info("A copy of task '%s' failed (%s), leaving it to the other copy", task.taskId, reason)
+            if reason not in ["cancelled", "requeue"]:
+                glb.workerRegistry.recordOutcome(self.workerId(), True)
+        elif reason == "cancelled" or getattr(task, "cancelRequested", False):
+            logging.info("Worker stopped cancelled task '%s'", task.taskId)
+        elif reason == "timeout":
+            logging.warning("Task '%s' exceeded its time limit, sending failure email", task.taskId)
+            task.failureReason = "timeout"
+            npsgd.email_manager.backgroundEmailSend(task.failureEmail())
+        elif reason == "requeue":
+            logging.info("Task '%s' was aborted along with its bundle, returning it to the queue", task.taskId)
+            glb.taskQueue.putTask(task)
+        else:
+            glb.workerRegistry.recordOutcome(self.workerId(), True)
+            self.recordFailure(task)
+
+        glb.syncShelve()
+        self.write(tornado.escape.json_encode({
+            "status": "okay"
+        }))
+
+    get = post
+
+    def recordFailure(self, task):
         task.failureCount += 1
         logging.warning("Worker had a failure while processing task '%s' (failure #%d)",\
                 task.taskId, task.failureCount)
@@ -398,38 +942,115 @@ class WorkerFailedTask(QueueRequestHandler):
             logging.warning("Returning task to queue for another attempt")
             glb.taskQueue.putTask(task)
 
+
+class WorkerModelBundle(QueueRequestHandler):
+    """HTTP handler serving the source of a model version to workers that lack it.
+
+    The response holds the model's file and every model file it imports, at
+    the versions the model was loaded with, those imported first. Sources are
+    base64 encoded; workers check them against their versions (see model_cache).
+    """
+    def get(self):
+        if not self.checkSecret():
+            return
+
+        modelName    = self.get_argument("model_name")
+        modelVersion = self.get_argument("model_version")
+        try:
+            files = modelManager.sourceBundle(modelName, modelVersion)
+        except (KeyError, model_manager.InvalidModelError), e:
+            logging.warning("Worker '%s' asked for unknown model '%s' version '%s'", self.workerId(), modelName, modelVersion)
+            self.write(tornado.escape.json_encode({
+                "error": {"type" : "unknown_version" }
+            }))
+            return
+
+        logging.info("Sending model '%s' version '%s' to worker '%s'", modelName, modelVersion, self.workerId())
         self.write(tornado.escape.json_encode({
-            "status": "okay"
+            "files": [{
+                "importName":   f.importName,
+                "version":      f.version,
+                "dependencies": f.dependencies,
+                "source":       base64.b64encode(f.source)
+            } for f in files]
         }))
 
 
 class WorkerTaskRequest(QueueRequestHandler):
-    """HTTP handler for workers grabbings tasks off the queue."""
+    """HTTP handler for workers grabbings tasks off the queue.
+
+    Workers that find nothing queued for them may instead be handed a
+    speculative copy of a task that is straggling on another host.
+    """
     def post(self):
         if not self.checkSecret():
             return
 
         modelVersions = tornado.escape.json_decode(self.get_argument("model_versions_json"))
+        costThreshold = float(self.get_argument("bundle_cost_threshold", 0))
+        maxBundleSize = int(self.get_argument("max_bundle_size", 1))
+        host          = self.get_argument("host", None)
+
+        if not self.checkinWorker(modelVersions, required=True):
+            return
 
-        glb.touchWorkerCheckin()
         logging.info("Received worker task request with models %s", modelVersions)
-        if glb.taskQueue.isEmpty():
+        if not glb.workerRegistry.shouldDispatchTo(self.workerId()):
+            logging.info("Holding tasks back from unhealthy worker '%s'", self.workerId())
             self.write(tornado.escape.json_encode({
-                "status": "empty_queue"
+                "status": "unhealthy"
             }))
+        elif glb.taskQueue.isEmpty():
+            if not self.writeSpeculativeTask(modelVersions, host):
+                self.write(tornado.escape.json_encode({
+                    "status": "empty_queue"
+                }))
         else:
-            task = glb.taskQueue.pullNextVersioned(modelVersions)
-            if task == None:
-                logging.info("Found no models in queue matching worker's supported versions")
+            if maxBundleSize > 1:
+                tasks = glb.taskQueue.pullNextVersionedBundle(modelVersions, costThreshold, maxBundleSize, host)
+            else:
+                task  = glb.taskQueue.pullNextVersioned(modelVersions, host)
+                tasks = [task] if task != None else []
+
+            if len(tasks) == 0:
+                if self.writeSpeculativeTask(modelVersions, host):
+                    return
+
+                logging.info("Found no models in queue matching worker's supported versions (or under their concurrency limits)")
+                self.write(tornado.escape.json_encode({
+                    "status": "no_version",
+                    "missing_versions": glb.taskQueue.missingVersions(modelVersions)
+                }))
+            elif len(tasks) == 1:
+                lease = glb.taskQueue.putProcessingTask(tasks[0], host, self.workerId())
+                glb.syncLeases()
                 self.write(tornado.escape.json_encode({
-                    "status": "no_version"
+                    "task": lease.taskDict()
                 }))
             else:
-                glb.taskQueue.putProcessingTask(task)
+                logging.info("Handing out a bundle of %d tasks", len(tasks))
+                leases = [glb.taskQueue.putProcessingTask(task, host, self.workerId()) for task in tasks]
+                glb.syncLeases()
                 self.write(tornado.escape.json_encode({
-                    "task": task.asDict()
+                    "tasks": [lease.taskDict() for lease in leases]
                 }))
 
+    def writeSpeculativeTask(self, modelVersions, host):
+        """Hands the worker a copy of a straggling task if there is one, returning whether it did."""
+        if config.speculationFactor <= 0:
+            return False
+
+        lease = glb.taskQueue.pullSpeculativeTask(modelVersions, host, self.workerId())
+        if lease == None:
+            return False
+
+        logging.info("Handing worker '%s' a speculative copy of straggling task '%s'", self.workerId(), lease.task.taskId)
+        glb.syncLeases()
+        self.write(tornado.escape.json_encode({
+            "task": lease.taskDict()
+        }))
+        return True
+
 def main():
     global glb
     parser = OptionParser()
@@ -445,7 +1066,7 @@ def main():
     config.loadConfig(options.config)
     config.setupLogging(options.log)
     model_manager.setupModels()
-    model_manager.startScannerThread()
+    model_manager.startScannerThread(lambda: glb.referencedModelVersions() if glb != None else None)
 
     if not os.path.exists(os.path.dirname(config.queueFile)):
         logging.warning("Queue directory does not exist, attempting to create")
@@ -462,16 +1083,29 @@ def main():
         glb = QueueGlobals(queueShelve)
         queueHTTP = tornado.httpserver.HTTPServer(tornado.web.Application([
             (r"/worker_info", WorkerInfo),
+            (r"/worker_register", WorkerRegister),
+            (r"/worker_unregister", WorkerUnregister),
             (r"/client_model_create", ClientModelCreate),
             (r"/client_queue_has_workers", ClientQueueHasWorkers),
-            (r"/client_confirm/(\w+)", ClientConfirm),
+            (r"/client_workers", ClientWorkers),
+            (r"/client_queue_status", ClientQueueStatus),
+            (r"/client_confirm/([\w\-\.]+)", ClientConfirm),
+            (r"/client_task_progress/(\w+)", ClientTaskProgress),
+            (r"/client_cancel_task/(\w+)", ClientCancelTask),
+            (r"/client_usage_stats", ClientUsageStats),
+            (r"/client_model_references", ClientModelReferences),
             (r"/worker_failed_task/(\d+)", WorkerFailedTask),
             (r"/worker_succeed_task/(\d+)", WorkerSucceededTask),
             (r"/worker_has_task/(\d+)",     WorkerHasTask),
+            (r"/worker_commit_task/(\d+)",  WorkerCommitTask),
             (r"/worker_keep_alive_task/(\d+)", WorkerTaskKeepAlive),
-            (r"/worker_work_task", WorkerTaskRequest)
+            (r"/worker_work_task", WorkerTaskRequest),
+            (r"/worker_model_bundle", WorkerModelBundle)
         ]))
         queueHTTP.listen(options.port)
+        #Unconfirmed requests expire in the background rather than on the next confirmation
+        tornado.ioloop.PeriodicCallback(glb.confirmationMap.expireConfirmations,
+                config.confirmExpireInterval * 1000).start()
         logging.info("NPSGD Queue Booted up, serving on port %d", options.port)
         print >>sys.stderr, "NPSGD queue server listening on %d" % options.port
         tornado.ioloop.IOLoop.instance().start()
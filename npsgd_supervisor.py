@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Worker supervisor for NPSGD.
+
+This script runs on a worker machine in place of a fixed set of worker
+processes. It periodically asks the queue server how many tasks are waiting
+and how many worker slots are free, then starts more workers (each in its own
+slot) when tasks have nowhere to go, and drains idle workers when the queue
+has been empty for a while. Workers that die are replaced as needed to keep
+the minimum running. Stopping the supervisor drains all of its workers.
+"""
+import os
+import sys
+import math
+import time
+import json
+import uuid
+import signal
+import socket
+import logging
+import urllib2, urllib
+import subprocess
+from optparse import OptionParser
+
+from npsgd.config import config
+
+class ManagedWorker(object):
+    """A worker process started by the supervisor."""
+
+    def __init__(self, slot, workerId, process):
+        self.slot     = slot
+        self.workerId = workerId
+        self.process  = process
+        self.draining = False
+
+    def isRunning(self):
+        return self.process.poll() == None
+
+    def drain(self):
+        """Asks the worker to finish its current task and exit."""
+        logging.info("Draining worker '%s' (slot %d)", self.workerId, self.slot)
+        self.draining = True
+        try:
+            os.kill(self.process.pid, signal.SIGUSR1)
+        except OSError, e:
+            logging.warning("Unable to signal worker '%s': %s", self.workerId, e)
+
+class NPSGDSupervisor(object):
+    """Scales the local worker processes between minWorkers and maxWorkers.
+
+    Scaling uses some hysteresis: workers are only added once tasks have been
+    waiting for a free slot for scaleUpDelay seconds, and only removed (one
+    per check, idle ones only) once the queue has been empty for scaleDownDelay.
+    """
+
+    def __init__(self, configPath, serverAddress, serverPort):
+        self.configPath     = configPath
+        self.workerScript   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "npsgd_worker.py")
+        self.baseRequest    = "http://%s:%s" % (serverAddress, serverPort)
+        self.statusRequest  = "%s/client_queue_status" % self.baseRequest
+        self.workersRequest = "%s/client_workers" % self.baseRequest
+        self.workers        = []
+        self.waitingSince   = None
+        self.emptySince     = None
+        self.stopping       = False
+
+    def queueRequest(self, url):
+        response = urllib2.urlopen("%s?%s" % (url, urllib.urlencode({"secret": config.requestSecret})))
+        return json.load(response)["response"]
+
+    def activeWorkers(self):
+        return [w for w in self.workers if not w.draining]
+
+    def startWorker(self):
+        usedSlots = set(w.slot for w in self.workers)
+        slot      = min(i for i in xrange(len(self.workers) + 1) if i not in usedSlots)
+        workerId  = "%s-%d-%s" % (socket.gethostname(), slot, uuid.uuid4().hex[:8])
+        logPath   = os.path.join(config.workerLogDirectory, "npsgd_worker_%d.log" % slot)
+
+        logging.info("Starting worker '%s' in slot %d", workerId, slot)
+        process = subprocess.Popen([sys.executable, self.workerScript, "-c", self.configPath,
+            "-l", logPath, "--slot", str(slot), "--worker-id", workerId], close_fds=True)
+        self.workers.append(ManagedWorker(slot, workerId, process))
+
+    def reapWorkers(self):
+        """Forgets workers that have exited, complaining about those that weren't asked to."""
+        for worker in list(self.workers):
+            if worker.isRunning():
+                continue
+
+            self.workers.remove(worker)
+            if worker.draining:
+                logging.info("Worker '%s' retired", worker.workerId)
+            else:
+                logging.warning("Worker '%s' exited unexpectedly with code %s", worker.workerId, worker.process.returncode)
+
+    def idleWorkers(self):
+        """Returns our active workers that the queue knows and that hold no tasks."""
+        busySlots = dict((w["workerId"], w["busySlots"]) for w in self.queueRequest(self.workersRequest))
+        return [w for w in self.activeWorkers() if busySlots.get(w.workerId, 1) == 0]
+
+    def targetWorkers(self, status, now):
+        """Decides how many active workers we want given the queue's status."""
+        active  = len(self.activeWorkers())
+        waiting = status["queued"] - status["free_slots"]
+
+        if waiting > 0:
+            self.waitingSince = self.waitingSince or now
+        else:
+            self.waitingSince = None
+
+        if status["queued"] == 0:
+            self.emptySince = self.emptySince or now
+        else:
+            self.emptySince = None
+
+        target = active
+        if self.waitingSince != None and now - self.waitingSince >= config.scaleUpDelay:
+            extra = waiting
+            if config.backlogPerWorker > 0:
+                waitingBacklog = status["backlog"] * waiting / status["queued"]
+                extra = int(math.ceil(waitingBacklog / config.backlogPerWorker))
+            target = active + max(1, extra)
+        elif self.emptySince != None and now - self.emptySince >= config.scaleDownDelay:
+            target = active - 1
+
+        return max(config.minWorkers, min(config.maxWorkers, target))
+
+    def scale(self):
+        self.reapWorkers()
+        active = len(self.activeWorkers())
+        try:
+            status = self.queueRequest(self.statusRequest)
+        except (urllib2.URLError, ValueError, KeyError), e:
+            logging.error("Unable to get queue status from %s: %s", self.baseRequest, e)
+            status = None
+
+        if status == None:
+            target = max(config.minWorkers, active)
+        else:
+            target = self.targetWorkers(status, time.time())
+            logging.debug("Queue has %d queued tasks (backlog %.1f), %d free slots; %d local workers, want %d",
+                    status["queued"], status["backlog"], status["free_slots"], active, target)
+
+        if target > active:
+            for i in xrange(target - active):
+                self.startWorker()
+            #Give the new workers time to register before judging the queue again
+            self.waitingSince = None
+        elif target < active:
+            try:
+                idle = self.idleWorkers()
+            except (urllib2.URLError, ValueError, KeyError), e:
+                logging.error("Unable to list workers from %s: %s", self.baseRequest, e)
+                idle = []
+
+            if len(idle) > 0:
+                idle[-1].drain()
+
+    def stop(self):
+        self.stopping = True
+
+    def loop(self):
+        """Main loop, running until the supervisor is stopped and all its workers have drained."""
+        logging.info("Entering supervisor loop")
+        while not self.stopping:
+            try:
+                self.scale()
+            except Exception:
+                logging.exception("Unhandled exception in supervisor loop!")
+
+            time.sleep(config.scaleInterval)
+
+        logging.info("Stopping, draining %d workers", len(self.workers))
+        for worker in self.activeWorkers():
+            worker.drain()
+
+        while len(self.workers) > 0:
+            time.sleep(1)
+            self.reapWorkers()
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-c', '--config', dest="config",
+            help="Configuration file path", type="string", default="config.cfg")
+
+    parser.add_option('-l', '--log-filename', dest='log',
+                        help="Log filename (use '-' for stderr)", default="-")
+
+    (options, args) = parser.parse_args()
+
+    config.loadConfig(options.config)
+    config.setupLogging(options.log)
+
+    supervisor = NPSGDSupervisor(os.path.abspath(options.config), config.queueServerAddress, config.queueServerPort)
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    signal.signal(signal.SIGINT,  lambda signum, frame: supervisor.stop())
+    logging.info("NPSGD Supervisor booted up, keeping %d to %d workers", config.minWorkers, config.maxWorkers)
+    supervisor.loop()
+
+if __name__ == "__main__":
+    main()
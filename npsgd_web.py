@@ -59,7 +59,8 @@ class ClientModelRequest(tornado.web.RequestHandler):
             #check with queue to see if we have workers
             http = tornado.httpclient.AsyncHTTPClient()
             request = tornado.httpclient.HTTPRequest(
-                    "http://%s:%s/client_queue_has_workers?secret=%s" % (config.queueServerAddress, config.queueServerPort, config.requestSecret),
+                    "http://%s:%s/client_queue_has_workers?%s" % (config.queueServerAddress, config.queueServerPort,
+                        urllib.urlencode({"secret": config.requestSecret, "model": model.short_name, "version": model.version})),
                     method="GET")
             callback = functools.partial(self.queueCallback, model=model)
             http.fetch(request, callback)
@@ -91,12 +92,12 @@ class ClientModelRequest(tornado.web.RequestHandler):
                 lastWorkerCheckSuccess = datetime.now()
                 self.renderModel(model)
             else:
-                self.queueErrorRender("We are sorry, our model worker machines appear to be down at the moment. Please try again later")
+                self.queueErrorRender("We are sorry, our model worker machines appear to be down at the moment. Please try again later", model)
                 return
 
         except KeyError:
             logging.info("Bad response from queue server")
-            self.queueErrorRender("We are sorry. Our queuing server appears to be having issues communicating at the moment, please try again later")
+            self.queueErrorRender("We are sorry. Our queuing server appears to be having issues communicating at the moment, please try again later", model)
             return
 
     @tornado.web.asynchronous
@@ -163,9 +164,9 @@ class ClientModelRequest(tornado.web.RequestHandler):
             except tornado.web.HTTPError:
                 argVal = param.nonExistValue()
 
-            value = param.withValue(argVal)
-            paramDict[param.name] = value.asDict()
+            paramDict[param.name] = {"name": param.name, "value": argVal}
 
+        #Validated (once) by the model's parameter schema
         task = model(email, 0, paramDict)
         return task
 
@@ -208,10 +209,34 @@ class ClientConfirmRequest(tornado.web.RequestHandler):
             raise tornado.web.HTTPError(500)
             
 
+class ClientTaskProgressRequest(tornado.web.RequestHandler):
+    """HTTP handler returning a task's status and progress as JSON.
+
+    Requests proxy asynchronously to the queue, which keeps the progress
+    workers report with their heartbeats.
+    """
+
+    @tornado.web.asynchronous
+    def get(self, visibleId):
+        http = tornado.httpclient.AsyncHTTPClient()
+        request = tornado.httpclient.HTTPRequest(
+                "http://%s:%s/client_task_progress/%s?secret=%s" % (config.queueServerAddress, config.queueServerPort, \
+                        visibleId, config.requestSecret))
+
+        http.fetch(request, self.progressCallback)
+
+    def progressCallback(self, response):
+        if response.error: raise tornado.web.HTTPError(500)
+
+        json = tornado.escape.json_decode(response.body)
+        self.set_header("Content-Type", "application/json")
+        self.finish(tornado.escape.json_encode(json["response"]))
+
 def setupClientApplication():
     appList = [ 
         (r"/", ClientBaseRequest),
-        (r"/confirm_submission/(\w+)", ClientConfirmRequest),
+        (r"/confirm_submission/([\w\-\.]+)", ClientConfirmRequest),
+        (r"/task_progress/(\w+)", ClientTaskProgressRequest),
         (r"/models/(.*)", ClientModelRequest)
     ]
 
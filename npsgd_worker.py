@@ -8,49 +8,104 @@ This script will periodically poll the queue server specified in the config
 file to see if it has any jobs available. When it finds one, it will 
 take it off the queue and begin processing - and communicate success back
 with the user (via e-mail) or failure back to the queue
+
+Sending a worker SIGUSR1 drains it: it finishes the task it is working on
+(if any) and then exits.
+
+Results of tasks finished while the queue can't be reached are spooled to
+disk and committed once it is back (see result_spool).
+
+Model versions the queue has tasks for but this worker lacks are fetched
+from the queue (see model_cache).
 """
 import os
 import sys
 import time
 import json
+import uuid
+import signal
+import socket
 import logging
+import base64
 import urllib2, urllib
-from threading import Thread, Event
+import httplib
+from threading import Thread, Event, Lock
 from optparse import OptionParser
 
 from npsgd import model_manager
+from npsgd import child_process
+from npsgd import resource_usage
 from npsgd.config import config
 from npsgd.model_task import ModelTask
 from npsgd.model_manager import modelManager
+from npsgd.model_metadata import FileMetadata
+from npsgd.model_cache import ModelSourceCache, ModelBundleError
+from npsgd.result_spool import ResultSpool, ResultSpoolThread, SpooledResult, QueueUnreachableError
 import npsgd.email_manager
 
 class TaskKeepAliveThread(Thread):
     """Model keep alive thread.
 
     Periodically sends a keepalive (heartbeat) to the server while we are working
-    on a model task so that it doesn't expire our task id. 
+    on a model task so that it doesn't expire our task id. The task's latest
+    progress rides along with each heartbeat. This thread also aborts the task
+    if it runs past its wall clock limit or the queue asks for it to be cancelled.
     """
 
-    def __init__(self, keepAliveRequest, taskId):
+    def __init__(self, keepAliveRequest, task, workerId):
         Thread.__init__(self)
         self.done             = Event()
         self.keepAliveRequest = keepAliveRequest
-        self.taskId           = taskId
+        self.task             = task
+        self.workerId         = workerId
         self.daemon           = True
 
+    def heartbeatArguments(self):
+        arguments = {"secret": config.requestSecret, "worker_id": self.workerId}
+        if self.task.leaseToken != None:
+            arguments["token"] = self.task.leaseToken
+        if self.task.progress != None:
+            fraction, stage = self.task.progress
+            if fraction != None:
+                arguments["progress"] = fraction
+            if stage != None:
+                arguments["stage"] = stage
+
+        return arguments
+
+    def waitInterval(self):
+        """Returns how long to sleep: until the next heartbeat or the task's deadline."""
+        remaining = self.task.secondsToDeadline()
+        if remaining == None or self.task.cancelReason != None:
+            return config.keepAliveInterval
+
+        return max(0, min(config.keepAliveInterval, remaining))
+
     def run(self):
         fails = 0
         while True:
-            self.done.wait(config.keepAliveInterval)
+            self.done.wait(self.waitInterval())
             if self.done.isSet():
                 break
 
+            if self.task.pastDeadline():
+                self.task.cancel("timeout")
+
             try:
                 logging.info("Making heartbeat request '%s'", self.keepAliveRequest)
-                response = urllib2.urlopen("%s/%s?secret=%s" % (self.keepAliveRequest, self.taskId, config.requestSecret))
+                response = urllib2.urlopen("%s/%s?%s" % (self.keepAliveRequest, self.task.taskId,
+                    urllib.urlencode(self.heartbeatArguments())))
+                decodedResponse = json.load(response)
             except urllib2.URLError, e:
                 logging.error("Heartbeat failed to make connection to %s", self.keepAliveRequest)
                 fails += 1
+                continue
+            except ValueError, e:
+                logging.error("Bad heartbeat response from %s", self.keepAliveRequest)
+                continue
+
+            if decodedResponse.get("cancel"):
+                self.task.cancel("cancelled")
 
 
 class NPSGDWorker(object):
@@ -60,38 +115,108 @@ class NPSGDWorker(object):
     at a fixed interval. When it finds a task, it will decode it into a model, 
     then process it using the model's "run" method.
     """
-    def __init__(self, serverAddress, serverPort):
+    def __init__(self, serverAddress, serverPort, slot=0, workerId=None):
+        self.workerId             = workerId or "%s-%d-%s" % (socket.gethostname(), slot, uuid.uuid4().hex[:8])
+        self.draining             = False
         self.baseRequest          = "http://%s:%s" % (serverAddress, serverPort)
         self.infoRequest          = "%s/worker_info"      % self.baseRequest
+        self.registerRequest      = "%s/worker_register"  % self.baseRequest
+        self.unregisterRequest    = "%s/worker_unregister" % self.baseRequest
         self.taskRequest          = "%s/worker_work_task" % self.baseRequest
         self.failedTaskRequest    = "%s/worker_failed_task" % self.baseRequest
-        self.hasTaskRequest       = "%s/worker_has_task" % self.baseRequest
-        self.succeedTaskRequest    = "%s/worker_succeed_task" % self.baseRequest
+        self.commitTaskRequest    = "%s/worker_commit_task" % self.baseRequest
         self.taskKeepAliveRequest = "%s/worker_keep_alive_task" % self.baseRequest
+        self.modelBundleRequest   = "%s/worker_model_bundle" % self.baseRequest
         self.requestTimeout  = 100
         self.supportedModels = ["test"]
         self.requestErrors   = 0
         self.maxErrors       = 3 
         self.errorSleepTime    = 10
         self.requestSleepTime = 10
+        self.fetchRetryTime   = 300
+        self.fetchFailures    = {}
+        self.modelCache       = ModelSourceCache(os.path.join(config.modelCacheDirectory, "slot_%d" % slot),
+                config.modelCacheSize)
+        self.deliveryUsage     = [] #Email stage usage of delivered tasks, reported with the next commit
+        self.deliveryUsageLock = Lock()
+        self.resultSpool      = ResultSpool(os.path.join(config.resultSpoolDirectory, "slot_%d" % slot))
+        self.resultSpoolThread = ResultSpoolThread(self.resultSpool,
+                lambda result: self.commitTask(result.taskId, result.leaseToken, result.usage),
+                lambda result: self.sendResults(result.email, result.modelName, result.modelVersion),
+                lambda result: self.notifyFailedTask(result.taskId, "Unable to commit the task's results",
+                    token=result.leaseToken))
 
     def getServerInfo(self):
         try:
-            response = urllib2.urlopen("%s?secret=%s" % (self.infoRequest, config.requestSecret))
+            response = urllib2.urlopen("%s?%s" % (self.infoRequest, self.workerArguments()))
         except urllib2.URLError, e:
             logging.error("Failed to make initial connection to %s", self.baseRequest)
             return
         
         logging.info("Got initial response from server")
 
+    def resources(self):
+        """Returns a description of what this worker has to run models with, for the queue's registry."""
+        cpuCount = os.sysconf("SC_NPROCESSORS_ONLN")
+        resources = {
+            "cpus":     len(child_process.slotCpus) if child_process.slotCpus else cpuCount,
+            "cpuCount": cpuCount
+        }
+
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemTotal:"):
+                        resources["memory"] = int(line.split()[1]) / 1024
+        except IOError:
+            pass
+
+        return resources
+
+    def register(self):
+        """Registers this worker with the queue so that it can track our capacity and health."""
+        try:
+            logging.info("Registering with the queue as '%s'", self.workerId)
+            urllib2.urlopen(self.registerRequest, data=urllib.urlencode({
+                "secret": config.requestSecret,
+                "worker_id": self.workerId,
+                "host": socket.gethostname(),
+                "slots": 1,
+                "model_versions_json": json.dumps(modelManager.modelVersions()),
+                "resources_json": json.dumps(self.resources())
+            }))
+        except urllib2.URLError, e:
+            logging.error("Failed to register with the queue at %s", self.baseRequest)
+
+    def unregister(self):
+        try:
+            logging.info("Unregistering from the queue")
+            urllib2.urlopen(self.unregisterRequest, data=self.workerArguments())
+        except urllib2.URLError, e:
+            logging.error("Failed to unregister from the queue at %s", self.baseRequest)
+
+    def drain(self):
+        """Stops taking new tasks, so that the worker exits once its current task (if any) is done."""
+        logging.info("Draining: will exit after the current task")
+        self.draining = True
+
+    def workerArguments(self, **kwargs):
+        """Returns query string arguments identifying this worker to the queue."""
+        arguments = {"secret": config.requestSecret, "worker_id": self.workerId}
+        arguments.update(kwargs)
+        return urllib.urlencode(arguments)
+
     def loop(self):
-        """Main IO loop."""
+        """Main IO loop, running until the worker is drained."""
         logging.info("Entering event loop")
-        while True:
+        while not self.draining:
             try:
                 self.handleEvents()
             except Exception:
                 logging.exception("Unhandled exception in event loop!")
+
+        self.unregister()
+        logging.info("Worker drained, exiting")
                 
     def handleEvents(self):
         """Workhorse method of actually making requests to the queue for tasks."""
@@ -100,7 +225,11 @@ class NPSGDWorker(object):
             #response = urllib2.urlopen("%s?secret=%s" % (self.taskRequest, config.requestSecret))
             response = urllib2.urlopen(self.taskRequest, data=urllib.urlencode({
                 "secret": config.requestSecret,
-                "model_versions_json": json.dumps(modelManager.modelVersions())
+                "worker_id": self.workerId,
+                "model_versions_json": json.dumps(modelManager.modelVersions()),
+                "bundle_cost_threshold": config.bundleCostThreshold,
+                "max_bundle_size": config.maxBundleSize,
+                "host": socket.gethostname()
             }))
         except urllib2.URLError, e:
             self.requestErrors += 1
@@ -123,102 +252,252 @@ class NPSGDWorker(object):
 
 
     def processResponse(self, response):
-        if "status" in response:
+        if "error" in response:
+            if response["error"].get("type") == "unregistered":
+                self.register()
+        elif "status" in response:
             if response["status"] == "empty_queue":
                 logging.info("No tasks available on server")
             elif response["status"] == "no_version":
                 logging.info("Queue lacks any tasks with our model versions")
+                self.fetchMissingModels(response.get("missing_versions", []))
+            elif response["status"] == "unhealthy":
+                logging.warning("Queue is holding tasks back from us after too many failures")
         elif "task" in response:
             self.processTask(response["task"])
+        elif "tasks" in response:
+            self.processBundle(response["tasks"])
+
+    def fetchMissingModels(self, missingVersions):
+        """Loads model versions that queued tasks need but we lack, from our cache or the queue.
 
-    def notifyFailedTask(self, taskId):
+        Versions that can't be had aren't asked for again for fetchRetryTime seconds.
+        """
+        for name, version in missingVersions:
+            if modelManager.hasModel(name, version) or self.fetchFailures.get((name, version), 0) > time.time():
+                continue
+
+            files = self.modelCache.get(name, version)
+            if files == None:
+                try:
+                    files = self.modelCache.put(name, version, self.fetchModelBundle(name, version))
+                except (ModelBundleError, IOError, OSError), e:
+                    logging.error("Unable to fetch model '%s' version '%s': %s", name, version, e)
+                    self.fetchFailures[(name, version)] = time.time() + self.fetchRetryTime
+                    continue
+
+            model_manager.loadModelFiles(files)
+            if modelManager.hasModel(name, version):
+                logging.info("Loaded model '%s' version '%s' for queued tasks", name, version)
+            else:
+                self.fetchFailures[(name, version)] = time.time() + self.fetchRetryTime
+
+    def fetchModelBundle(self, name, version):
+        """Asks the queue for the source of a model version, returning it as a list of FileMetadata."""
+        logging.info("Fetching model '%s' version '%s' from the queue", name, version)
         try:
-            logging.info("Notifying server of failed task with id %s", taskId)
-            response = urllib2.urlopen("%s/%s?secret=%s" % (self.failedTaskRequest, taskId, config.requestSecret))
+            response = urllib2.urlopen("%s?%s" % (self.modelBundleRequest,
+                self.workerArguments(model_name=name, model_version=version)))
+            decodedResponse = json.load(response)
         except urllib2.URLError, e:
-            logging.error("Failed to communicate failed task to server %s", self.baseRequest)
+            raise ModelBundleError("Failed to connect to %s: %s" % (self.baseRequest, e))
+        except ValueError, e:
+            raise ModelBundleError("Bad response from the queue: %s" % e)
+
+        if "files" not in decodedResponse:
+            raise ModelBundleError("Queue refused: %s" % decodedResponse.get("error"))
 
-    def notifySucceedTask(self, taskId):
         try:
-            logging.info("Notifying server of succeeded task with id %s", taskId)
-            response = urllib2.urlopen("%s/%s?secret=%s" % (self.succeedTaskRequest, taskId, config.requestSecret))
-        except urllib2.URLError, e:
-            logging.error("Failed to communicate succeeded task to server %s", self.baseRequest)
+            return [FileMetadata(str(f["importName"]), None, str(f["version"]), base64.b64decode(f["source"]),
+                [(str(n), str(v)) for n, v in f["dependencies"]], None) for f in decodedResponse["files"]]
+        except (KeyError, TypeError, ValueError), e:
+            raise ModelBundleError("Malformed model bundle: %s" % e)
 
-    def serverHasTask(self, taskId):
-        """Method for ensuring that the queue still recognizes our task id.
+    def notifyFailedTask(self, taskId, output="", reason=None, token=None):
+        """Tells the server a task failed, along with the tail of its output for diagnostics.
 
-        If the queue has expired the task for some reason (i.e. a timeout)
-        this method will return false. Otherwise, it means we can proceed.
+        The reason is "timeout", "cancelled" or "requeue" for tasks that were
+        aborted rather than failing on their own (see ModelTask.cancel). The token is the fencing token of
+        our lease, so that a stale report can't fail a task leased since.
         """
+        arguments = {"output": output}
+        if reason != None:
+            arguments["reason"] = reason
+        if token != None:
+            arguments["token"] = token
+
         try:
-            logging.info("Making has task request for %s", taskId)
-            response = urllib2.urlopen("%s/%s?secret=%s" % (self.hasTaskRequest, taskId, config.requestSecret))
+            logging.info("Notifying server of failed task with id %s", taskId)
+            #Posted, as the output tail may be too long for a query string
+            response = urllib2.urlopen("%s/%s" % (self.failedTaskRequest, taskId),
+                    data=self.workerArguments(**arguments))
         except urllib2.URLError, e:
-            logging.error("Failed to make has task request to server %s", self.baseRequest)
+            logging.error("Failed to communicate failed task to server %s", self.baseRequest)
+
+    def commitTask(self, taskId, leaseToken, usage):
+        """Commits a finished task with the queue, returning whether we should deliver its results.
+
+        The queue marks our lease complete (recording what the task cost to
+        run, see resource_usage) only if it is still current. If the task was
+        expired and leased again, or another copy of it was committed first,
+        this returns False and the results must be thrown away. Raises
+        QueueUnreachableError if the queue can't be reached, RuntimeError if
+        it answers with an error.
+        """
+        arguments = {"usage_json": json.dumps(usage)}
+        if leaseToken != None:
+            arguments["token"] = leaseToken
+        with self.deliveryUsageLock:
+            deliveryUsage = list(self.deliveryUsage)
+        if len(deliveryUsage) > 0:
+            arguments["delivery_usage_json"] = json.dumps(deliveryUsage)
+
+        try:
+            logging.info("Committing task with id %s", taskId)
+            response = urllib2.urlopen("%s/%s" % (self.commitTaskRequest, taskId),
+                    data=self.workerArguments(**arguments))
+        except urllib2.HTTPError, e:
+            logging.error("Server %s refused commit request", self.baseRequest)
             raise RuntimeError(e)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            logging.error("Failed to make commit request to server %s", self.baseRequest)
+            raise QueueUnreachableError(e)
 
         try:
             decodedResponse = json.load(response)
+        except (httplib.HTTPException, socket.error), e:
+            logging.error("Lost connection to server %s during commit", self.baseRequest)
+            raise QueueUnreachableError(e)
         except ValueError, e:
-            logging.error("Bad response from server for has task")
+            logging.error("Bad response from server for commit")
             raise RuntimeError(e)
-        
-        if "response" in decodedResponse and decodedResponse["response"] in ["yes", "no"]:
-            return decodedResponse["response"] == "yes"
+
+        if "response" in decodedResponse and decodedResponse["response"] in ["commit", "lost"]:
+            with self.deliveryUsageLock:
+                self.deliveryUsage = self.deliveryUsage[len(deliveryUsage):]
+            return decodedResponse["response"] == "commit"
         else:
             logging.error("Malformed response from server")
-            raise RuntimeError("Malformed response from server for 'has task'")
+            raise RuntimeError("Malformed response from server for 'commit task'")
         
     def processTask(self, taskDict):
-        """Handle creation and running of a model and setup heartbeat thread.
-
-        This is the heart of a worker. When we find a model on the queue, this
-        method takes the request and decodes it into something that can be processed.
-        It will then spawn a heartbeat thread that continues to check into the server
-        while we actually enter the models "run" method. From there, it is all up
-        to the model to handle.
+        """Handle creation and running of a single model task."""
+        self.processBundle([taskDict])
+
+    def processBundle(self, taskDicts):
+        """Handle creation and running of a bundle of model tasks and setup heartbeat threads.
+
+        This is the heart of a worker. When we find models on the queue, this
+        method takes the requests (all for the same model version) and decodes
+        them into something that can be processed. It will then spawn a
+        heartbeat thread per task that continues to check into the server
+        while we actually enter the model's "runBundle" method. From there, it
+        is all up to the model to handle.
         """
-        taskId = None
-        if "taskId" in taskDict:
-            taskId = taskDict["taskId"]
+        taskIds = [(taskDict["taskId"], taskDict.get("leaseToken")) for taskDict in taskDicts if "taskId" in taskDict]
+        child_process.pruneTaskLogs()
 
         try:
             try:
-                model = modelManager.getModel(taskDict["modelName"], taskDict["modelVersion"])
-                logging.info("Creating a model task for '%s'", taskDict["modelName"])
-                taskObject = model.fromDict(taskDict)
-            except KeyError, e:
-                logging.warning("Was unable to deserialize model task (%s), model task: %s", e, taskDict)
-                if taskId:
-                    self.notifyFailedTask(taskId)
+                taskObjects = []
+                for taskDict in taskDicts:
+                    model = modelManager.getExecutionModel(taskDict["modelName"], taskDict["modelVersion"])
+                    logging.info("Creating a model task for '%s'", taskDict["modelName"])
+                    taskObject = model.fromDict(taskDict)
+                    taskObject.leaseToken = taskDict.get("leaseToken")
+                    taskObjects.append(taskObject)
+            except (KeyError, model_manager.InvalidModelError), e:
+                logging.warning("Was unable to deserialize model task (%s), model tasks: %s", e, taskDicts)
+                for taskId, token in taskIds:
+                    self.notifyFailedTask(taskId, token=token)
                 return
 
-            keepAliveThread = TaskKeepAliveThread(self.taskKeepAliveRequest, taskObject.taskId)
-            keepAliveThread.start()
-            try:
-                resultsEmail = taskObject.run()
-                logging.info("Model finished running, sending email")
-                if self.serverHasTask(taskObject.taskId):
-                    npsgd.email_manager.blockingEmailSend(resultsEmail)
-                    logging.info("Email sent, model is 100% complete!")
-                    self.notifySucceedTask(taskObject.taskId)
-                else:
-                    logging.warning("Skipping task completion since the server forgot about our task")
-
-            except RuntimeError, e:
-                logging.error("Some kind of error during processing model task, notifying server of failure")
-                logging.exception(e)
-                self.notifyFailedTask(taskObject.taskId)
+            keepAliveThreads = [TaskKeepAliveThread(self.taskKeepAliveRequest, t, self.workerId) for t in taskObjects]
+            for keepAliveThread in keepAliveThreads:
+                keepAliveThread.start()
 
+            try:
+                try:
+                    results = taskObjects[0].__class__.runBundle(taskObjects)
+                except RuntimeError, e:
+                    logging.error("Some kind of error during processing model task, notifying server of failure")
+                    logging.exception(e)
+                    results = [(taskObject, e) for taskObject in taskObjects]
+
+                for taskObject, result in results:
+                    if isinstance(result, Exception):
+                        logging.error("Task '%s' failed, notifying server of failure", taskObject.taskId)
+                        self.notifyFailedTask(taskObject.taskId, taskObject.outputTail(), taskObject.cancelReason,
+                                taskObject.leaseToken)
+                    else:
+                        self.completeTask(taskObject, result)
             finally:
-                keepAliveThread.done.set()
+                for keepAliveThread in keepAliveThreads:
+                    keepAliveThread.done.set()
 
         except: #If all else fails, notify the server that we are going down
-            if taskId:
-                self.notifyFailedTask(taskId)
+            for taskId, token in taskIds:
+                self.notifyFailedTask(taskId, token=token)
             raise
 
+    def completeTask(self, taskObject, resultsEmail):
+        """Commits a finished task with the queue and, if we won it, sends out the results email.
+
+        If the queue can't be reached the results are spooled, to be committed
+        and delivered by the result spool thread once it's back.
+        """
+        try:
+            logging.info("Model finished running, committing result")
+            committed = self.commitTask(taskObject.taskId, taskObject.leaseToken, taskObject.usageDict())
+        except QueueUnreachableError, e:
+            logging.error("Unable to commit task '%s' (%s), spooling its results", taskObject.taskId, e)
+            self.resultSpool.put(SpooledResult(taskObject.taskId, taskObject.leaseToken,
+                taskObject.usageDict(), resultsEmail, taskObject.short_name, taskObject.version))
+            self.resultSpoolThread.notify()
+            return
+        except RuntimeError, e:
+            logging.error("Queue refused to commit task '%s' (%s), reporting it failed", taskObject.taskId, e)
+            self.notifyFailedTask(taskObject.taskId, "Unable to commit the task's results", token=taskObject.leaseToken)
+            return
+
+        if not committed:
+            logging.warning("Skipping task completion since our lease of the task is no longer current")
+            return
+
+        self.deliverResults(taskObject, resultsEmail)
+
+    def deliverResults(self, taskObject, resultsEmail):
+        """Sends out the results email of a task we committed.
+
+        The queue already counts the task as done, so nobody else will send
+        this. If sending fails the email is spooled (as committed), to be
+        retried by the result spool thread even if we drain or restart.
+        """
+        try:
+            self.sendResults(resultsEmail, taskObject.short_name, taskObject.version)
+        except Exception:
+            logging.exception("Failed to send results email of task '%s', spooling it", taskObject.taskId)
+            result = SpooledResult(taskObject.taskId, taskObject.leaseToken, taskObject.usageDict(),
+                    resultsEmail, taskObject.short_name, taskObject.version)
+            result.committed = True
+            self.resultSpool.put(result)
+            self.resultSpoolThread.notify()
+
+    def sendResults(self, resultsEmail, modelName, modelVersion):
+        """Sends a results email, raising an exception if it can't be sent.
+
+        What sending cost is the task's email stage. The task was committed
+        already, so that usage is reported along with our next commit.
+        """
+        before = resource_usage.selfUsage()
+        npsgd.email_manager.blockingEmailSend(resultsEmail)
+        logging.info("Email sent, model is 100% complete!")
+
+        if modelName != None:
+            with self.deliveryUsageLock:
+                self.deliveryUsage.append({"modelName": modelName, "modelVersion": modelVersion,
+                    "usage": {"email": resource_usage.selfUsage().since(before).asDict()}})
+
 def main():
     parser = OptionParser()
     parser.add_option('-c', '--config', dest="config",
@@ -226,17 +505,27 @@ def main():
 
     parser.add_option('-l', '--log-filename', dest='log',
                         help="Log filename (use '-' for stderr)", default="-")
+    parser.add_option('-s', '--slot', dest='slot', type="int", default=0,
+            help="Slot number of this worker among those on the host (picks its cores, see cpusPerSlot)")
+    parser.add_option('-i', '--worker-id', dest='workerId', default=None,
+            help="Id to register with the queue under (generated if not given)")
 
     (options, args) = parser.parse_args()
 
     config.loadConfig(options.config)
     config.setupLogging(options.log)
+    child_process.setWorkerSlot(options.slot)
     model_manager.setupModels()
     model_manager.startScannerThread()
 
-    worker = NPSGDWorker(config.queueServerAddress, config.queueServerPort)
+    worker = NPSGDWorker(config.queueServerAddress, config.queueServerPort, options.slot, options.workerId)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: worker.drain())
+    #Otherwise the signal breaks off blocking reads (EINTR), failing the tasks we are draining for
+    signal.siginterrupt(signal.SIGUSR1, False)
     logging.info("NPSGD Worker booted up, going into event loop")
     worker.getServerInfo()
+    worker.register()
+    worker.resultSpoolThread.start()
     worker.loop()
 
 if __name__ == "__main__":
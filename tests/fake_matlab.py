@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Stand-in for a matlab interpreter, for testing matlab_engine without matlab.
+
+Understands just enough of what MatlabEngine sends it: disp of a string, of
+a list of strings or of the caught error's message, try/catch/end,
+error('message') and exit. Calling the script functions 'pid', 'hang' or
+'crash' prints the interpreter's pid, stops it responding or kills it.
+Every line read is echoed after a prompt, as a marker only counts when it is
+printed rather than echoed.
+"""
+import os
+import re
+import sys
+import time
+
+def strings(code):
+    return [s.replace("''", "'") for s in re.findall(r"'((?:[^']|'')*)'", code)]
+
+def main():
+    sys.stdout.write("< M A T L A B (stand-in) >\n")
+    sys.stdout.flush()
+
+    skipping = False #Skipping the rest of a try block (or an unused catch block)
+    message  = ""
+    for line in iter(sys.stdin.readline, ""):
+        line = line.strip()
+        sys.stdout.write(">> %s\n" % line)
+
+        if line == "try":
+            skipping = False
+        elif line.startswith("catch"):
+            #Run the catch block only if the try block raised
+            skipping = not skipping
+        elif line == "end":
+            skipping = False
+        elif skipping:
+            pass
+        elif line.startswith("exit"):
+            break
+        elif line.startswith("error("):
+            message  = strings(line)[0]
+            skipping = True
+        elif line.startswith("disp(npsgdError.message)"):
+            sys.stdout.write("%s\n" % message)
+        elif line.startswith("disp("):
+            sys.stdout.write("%s\n" % "".join(strings(line)))
+        elif line == "pid;":
+            sys.stdout.write("pid %d\n" % os.getpid())
+        elif line == "hang;":
+            sys.stdout.flush()
+            time.sleep(3600)
+        elif line == "crash;":
+            sys.exit(3)
+
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
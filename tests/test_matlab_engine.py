@@ -0,0 +1,116 @@
+# Author: Thomas Dimson [tdimson@gmail.com]
+# Date:   January 2011
+# For distribution details, see LICENSE
+"""Tests of the matlab engine pool, run against the fake_matlab.py stand-in.
+
+Run from the top directory with: python -m unittest discover tests
+"""
+import os
+import re
+import sys
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from npsgd.config import config
+from npsgd import matlab_engine
+
+fakeMatlab = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_matlab.py")]
+
+class MatlabEngineTest(unittest.TestCase):
+    def setUp(self):
+        config.modelNice = 0
+        self.workingDirectory = tempfile.mkdtemp()
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.stop()
+        os.rmdir(self.workingDirectory)
+
+    def job(self, scriptFunction):
+        return (self.workingDirectory, "/models", scriptFunction, "")
+
+    def newEngine(self, timeout=0):
+        engine = matlab_engine.MatlabEngine(fakeMatlab, timeout)
+        engine.stopTimeout = 1
+        self.engines.append(engine)
+        return engine
+
+    def newPool(self, size, maxRuns):
+        pool = matlab_engine.MatlabEnginePool(fakeMatlab, size, maxRuns)
+        self.engines.extend(pool.engines)
+        return pool
+
+    def testOutputEndsAtMarker(self):
+        engine = self.newEngine()
+        succeeded, output = engine.run(*self.job("disp('hello')"))
+        self.assertTrue(succeeded)
+        self.assertTrue("hello\n" in output)
+        #The banner belongs to no task, and the markers (only echoed split) are left out
+        self.assertFalse("M A T L A B" in output)
+        self.assertEqual(re.findall("NPSGD_MARKER_[0-9a-f]{32}", output), [])
+
+        succeeded, output = engine.run(*self.job("disp('world')"))
+        self.assertTrue(succeeded)
+        self.assertTrue("world\n" in output)
+        self.assertFalse("hello" in output)
+
+    def testErrorIsCaptured(self):
+        engine = self.newEngine()
+        succeeded, output = engine.run(*self.job("error('it broke')"))
+        self.assertFalse(succeeded)
+        self.assertTrue("it broke\n" in output)
+
+        #The engine is still usable afterwards
+        succeeded, output = engine.run(*self.job("disp('again')"))
+        self.assertTrue(succeeded)
+        self.assertTrue("again\n" in output)
+
+    def testOutputCallback(self):
+        lines = []
+        succeeded, output = self.newEngine().run(*self.job("disp('streamed')"), outputCallback=lines.append)
+        self.assertTrue(succeeded)
+        self.assertEqual(output, "")
+        self.assertTrue("streamed\n" in lines)
+
+    def testCrashRaises(self):
+        engine = self.newEngine()
+        self.assertRaises(matlab_engine.MatlabEngineError, engine.run, *self.job("crash"))
+
+    def testHungEngineTimesOut(self):
+        engine = self.newEngine(timeout=1)
+        start = time.time()
+        self.assertRaises(matlab_engine.MatlabEngineError, engine.run, *self.job("hang"))
+        self.assertTrue(time.time() - start < 10)
+
+    def pids(self, results):
+        return [int(output.split("pid ")[1].split()[0]) for (succeeded, output) in results]
+
+    def testRecycledAfterMaxRuns(self):
+        pool = self.newPool(1, 2)
+        pids = self.pids(pool.runMany([self.job("pid")] * 5))
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[3], pids[4])
+
+    def testRecycledAfterFailure(self):
+        pool = self.newPool(1, 10)
+        results = pool.runMany([self.job("pid"), self.job("error('no')"), self.job("pid")])
+        self.assertEqual([succeeded for (succeeded, output) in results], [True, False, True])
+        self.assertNotEqual(*self.pids([results[0], results[2]]))
+
+    def testEngineReturnedAfterCrash(self):
+        pool = self.newPool(1, 10)
+        self.assertRaises(matlab_engine.MatlabEngineError, pool.run, *self.job("crash"))
+        self.assertEqual(pool.idle.qsize(), 1)
+
+        succeeded, output = pool.run(*self.job("disp('recovered')"))
+        self.assertTrue(succeeded)
+        self.assertTrue("recovered\n" in output)
+        self.assertEqual(pool.idle.qsize(), 1)
+
+if __name__ == "__main__":
+    unittest.main()